@@ -0,0 +1,371 @@
+"""
+HTTP API cho pipeline generate (asyncio, chỉ dùng thư viện chuẩn): cho hệ thống nội bộ khác
+(vd. ticketing gửi email xin lỗi khách hàng) sinh email mà không qua trang Streamlit.
+
+    python api.py --port 8080
+    curl -s localhost:8080/v1/generate -d '{"purpose": "Customer reply / Phản hồi khách hàng",
+                                            "tone": "Apologetic", "details": "Đơn hàng giao trễ 3 ngày"}'
+
+Endpoints:
+    POST /v1/generate          1 email → {"subject", "body", "subject_raw", "candidates"?, "trace"}
+    POST /v1/generate/stream   Server-sent events: "partial" khi text về dần, "result" khi xong
+    POST /v1/generate/bulk     {"requests": [...]} → {"results": [...]} theo đúng thứ tự;
+                               Accept: text/event-stream → mỗi kết quả 1 event "result" ngay khi xong
+    GET  /healthz              {"status": "ok"}
+    GET  /metrics              Histogram theo stage + event (Prometheus text)
+
+Request JSON giống các field ở sidebar: purpose, tone, lang, recipient, details (bắt buộc), signature,
+audience, length, require_cta, cta_template, variables {order_id, delivery_date, hotline, meeting_link}
+(hoặc khai báo phẳng như cột batch), temperature (mặc định theo tone), n_variants (1-5).
+Mọi request xếp hàng qua scheduler dùng chung (hàng đợi, budget theo client/ngày): tên client lấy từ
+header X-Client-Id, không có thì "anon:<IP>".
+
+Request giống hệt nhau (cùng prompt + temperature) đang chạy đồng thời dùng chung 1 lời gọi
+Gemini (single-flight trong call_gemini_json), kể cả các dòng trùng nhau trong 1 bulk.
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_API_WORKERS   = số thread chạy pipeline (mặc định 16)
+    EMAILGEN_API_MAX_BULK  = số request tối đa trong 1 bulk (mặc định 100)
+"""
+import os, json, asyncio, argparse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from batch import VAR_COLUMNS, row_to_kwargs
+from email_core import (
+    TONE_TEMPERATURE, WORDS_BY_LENGTH, generate_email, generate_email_variants, stream_generate_email,
+)
+from metrics import get_metrics
+from scheduler import QueueTimeout, SchedulerError, use_scheduler
+
+MAX_BODY_BYTES = 1 << 20
+MAX_VARIANTS = 5
+REQUEST_FIELDS = {
+    "purpose", "tone", "lang", "recipient", "details", "signature", "audience", "length", "require_cta",
+    "cta_template", "variables", "temperature", "n_variants", *VAR_COLUMNS,
+}
+ALLOWED_VALUES = {
+    "tone": set(TONE_TEMPERATURE),
+    "audience": {"B2B", "B2C"},
+    "length": set(WORDS_BY_LENGTH),
+}
+RESULT_FIELDS = ("subject", "body", "subject_raw", "candidates", "model", "repair", "trace")
+# Field phải là chuỗi (giá trị sai kiểu sẽ làm row_to_kwargs / build_vars_map lỗi giữa chừng)
+STRING_FIELDS = ("purpose", "tone", "lang", "recipient", "details", "signature", "audience", "length",
+                 "cta_template", *VAR_COLUMNS)
+
+
+class RequestError(ValueError):
+    """Request không hợp lệ (→ HTTP 400)"""
+
+
+def parse_request(payload) -> tuple[dict, int]:
+    """Validate 1 request JSON → (kwargs cho generate_email, n_variants)"""
+    if not isinstance(payload, dict):
+        raise RequestError("Request must be a JSON object")
+    unknown = set(payload) - REQUEST_FIELDS
+    if unknown:
+        raise RequestError(f"Unknown field(s): {', '.join(sorted(unknown))}")
+    for field in STRING_FIELDS:
+        if payload.get(field) is not None and not isinstance(payload[field], str):
+            raise RequestError(f"'{field}' must be a string")
+    variables = payload.get("variables")
+    if variables is not None and not isinstance(variables, dict):
+        raise RequestError("'variables' must be an object")
+    for key, value in (variables or {}).items():
+        if value is not None and not isinstance(value, str):
+            raise RequestError(f"'variables.{key}' must be a string")
+    require_cta = payload.get("require_cta")
+    if require_cta is not None and not isinstance(require_cta, (bool, str)):
+        raise RequestError("'require_cta' must be a boolean")
+    if not (payload.get("details") or "").strip():
+        raise RequestError("'details' is required")
+
+    # Cùng cách map field → tham số với batch.py (mặc định, biến phẳng, require_cta dạng chuỗi)
+    kwargs = row_to_kwargs({**payload, "variables": dict(payload.get("variables") or {})}, {})
+    for field, allowed in ALLOWED_VALUES.items():
+        if kwargs[field] not in allowed:
+            raise RequestError(f"'{field}' must be one of: {', '.join(sorted(allowed))}")
+
+    temperature = payload.get("temperature")
+    if temperature is not None:
+        if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2:
+            raise RequestError("'temperature' must be a number between 0 and 2")
+        kwargs["temperature"] = float(temperature)
+    n_variants = payload.get("n_variants", 1)
+    if isinstance(n_variants, bool) or not isinstance(n_variants, int) or not 1 <= n_variants <= MAX_VARIANTS:
+        raise RequestError(f"'n_variants' must be an integer between 1 and {MAX_VARIANTS}")
+    return kwargs, n_variants
+
+
+def public_result(result: dict) -> dict:
+    return {k: result[k] for k in RESULT_FIELDS if k in result}
+
+
+def error_status(exc: BaseException) -> int:
+    if isinstance(exc, RequestError):
+        return 400
+    if isinstance(exc, QueueTimeout):
+        return 503
+    if isinstance(exc, SchedulerError):
+        return 429
+    return 502
+
+
+def error_body(exc: BaseException) -> dict:
+    return {"error": {"type": type(exc).__name__, "message": str(exc)}}
+
+
+def client_identity(request: "HttpRequest", writer: asyncio.StreamWriter) -> str:
+    """Tên client cho scheduler: X-Client-Id, không có → theo IP (request ẩn danh vẫn bị giới hạn)"""
+    client_id = request.headers.get("x-client-id", "").strip()
+    if client_id:
+        return client_id
+    peer = writer.get_extra_info("peername")
+    return f"anon:{peer[0] if peer else 'unknown'}"
+
+
+def run_generate(kwargs: dict, n_variants: int = 1, client_id: str = "anon:local") -> dict:
+    """Chạy pipeline đồng bộ (trong thread của executor), lời gọi model đi qua scheduler dưới tên client_id"""
+    with use_scheduler(client_id):
+        if n_variants > 1:
+            return public_result(generate_email_variants(n_variants=n_variants, **kwargs))
+        return public_result(generate_email(**kwargs))
+
+
+class HttpRequest:
+    __slots__ = ("method", "path", "headers", "body")
+
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        try:
+            return json.loads(self.body.decode("utf-8") or "null")
+        except (UnicodeDecodeError, ValueError):
+            raise RequestError("Request body is not valid JSON") from None
+
+    @property
+    def wants_events(self) -> bool:
+        return "text/event-stream" in self.headers.get("accept", "")
+
+
+async def read_request(reader: asyncio.StreamReader) -> HttpRequest | None:
+    """Đọc 1 request HTTP/1.1 (chỉ Content-Length, không chunked); None khi client đóng kết nối"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise RequestError("Request headers too large") from None
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _version = lines[0].split(" ", 2)
+    except ValueError:
+        raise RequestError("Malformed request line") from None
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise RequestError("Chunked request bodies are not supported; send Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise RequestError("Invalid Content-Length") from None
+    if length > MAX_BODY_BYTES:
+        raise RequestError(f"Request body larger than {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return HttpRequest(method.upper(), urlsplit(target).path, headers, body)
+
+
+def _head(status: int, content_type: str, length: int | None = None) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}"]
+    if length is None:
+        lines.append("Cache-Control: no-cache")
+    else:
+        lines.append(f"Content-Length: {length}")
+    lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer: asyncio.StreamWriter, status: int, payload):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(_head(status, "application/json; charset=utf-8", len(data)) + data)
+    await writer.drain()
+
+
+async def send_text(writer: asyncio.StreamWriter, status: int, text: str, content_type: str = "text/plain"):
+    data = text.encode("utf-8")
+    writer.write(_head(status, f"{content_type}; charset=utf-8", len(data)) + data)
+    await writer.drain()
+
+
+async def start_events(writer: asyncio.StreamWriter):
+    writer.write(_head(200, "text/event-stream; charset=utf-8"))
+    await writer.drain()
+
+
+async def send_event(writer: asyncio.StreamWriter, event: str, payload):
+    writer.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+    await writer.drain()
+
+
+class ApiServer:
+    def __init__(self, workers: int | None = None, max_bulk: int | None = None):
+        # Pipeline (Gemini client, hậu xử lý) là code đồng bộ → chạy trong thread pool, event loop chỉ lo I/O
+        workers = workers or int(os.getenv("EMAILGEN_API_WORKERS", 16))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="emailgen-api")
+        self.max_bulk = max_bulk or int(os.getenv("EMAILGEN_API_MAX_BULK", 100))
+        self.routes = {
+            ("GET", "/healthz"): self.healthz,
+            ("GET", "/metrics"): self.metrics,
+            ("POST", "/v1/generate"): self.generate,
+            ("POST", "/v1/generate/stream"): self.generate_stream,
+            ("POST", "/v1/generate/bulk"): self.generate_bulk,
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request = await read_request(reader)
+            except RequestError as e:
+                return await send_json(writer, 400, error_body(e))
+            if request is None:
+                return
+            handler = self.routes.get((request.method, request.path))
+            if handler is None:
+                allowed = any(path == request.path for _, path in self.routes)
+                status = 405 if allowed else 404
+                return await send_json(writer, status, {"error": {"type": HTTPStatus(status).phrase,
+                                                                  "message": f"{request.method} {request.path}"}})
+            try:
+                await handler(request, writer)
+            except (RequestError, SchedulerError) as e:
+                await send_json(writer, error_status(e), error_body(e))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # client đã ngắt kết nối
+        finally:
+            writer.close()
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def healthz(self, request: HttpRequest, writer):
+        await send_json(writer, 200, {"status": "ok"})
+
+    async def metrics(self, request: HttpRequest, writer):
+        await send_text(writer, 200, get_metrics().prometheus_text(), "text/plain; version=0.0.4")
+
+    async def generate(self, request: HttpRequest, writer):
+        kwargs, n_variants = parse_request(request.json())
+        try:
+            result = await self._run(run_generate, kwargs, n_variants, client_identity(request, writer))
+        except Exception as e:
+            return await send_json(writer, error_status(e), error_body(e))
+        await send_json(writer, 200, result)
+
+    async def generate_stream(self, request: HttpRequest, writer):
+        kwargs, n_variants = parse_request(request.json())
+        if n_variants > 1:
+            raise RequestError("Streaming supports a single variant; use /v1/generate for n_variants > 1")
+        client_id = client_identity(request, writer)
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+
+        def pump():
+            # Generator đồng bộ chạy trong thread; mỗi item được đẩy sang event loop.
+            # Client ngắt giữa chừng thì stream vẫn chạy hết (kết quả vẫn vào cache)
+            try:
+                with use_scheduler(client_id):
+                    for kind, payload in stream_generate_email(**kwargs):
+                        if kind == "result":
+                            payload = public_result(payload)
+                        loop.call_soon_threadsafe(events.put_nowait, (kind, payload))
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, ("error", e))
+            loop.call_soon_threadsafe(events.put_nowait, (None, None))
+
+        self._run(pump)
+        started = False
+        while True:
+            kind, payload = await events.get()
+            if kind is None:
+                break
+            if kind == "error" and not started:
+                # Lỗi trước khi có dữ liệu (vd. hết quota) → trả mã lỗi HTTP bình thường
+                return await send_json(writer, error_status(payload), error_body(payload))
+            if not started:
+                await start_events(writer)
+                started = True
+            await send_event(writer, kind, error_body(payload) if kind == "error" else payload)
+
+    async def generate_bulk(self, request: HttpRequest, writer):
+        payload = request.json()
+        items = payload.get("requests") if isinstance(payload, dict) else None
+        if not isinstance(items, list) or not items:
+            raise RequestError("'requests' must be a non-empty array")
+        if len(items) > self.max_bulk:
+            raise RequestError(f"At most {self.max_bulk} requests per bulk call")
+        client_id = client_identity(request, writer)
+
+        async def one(index: int, item) -> dict:
+            # Lỗi của 1 dòng không làm hỏng cả bulk (như status theo dòng của batch.py)
+            try:
+                kwargs, n_variants = parse_request(item)
+                result = await self._run(run_generate, kwargs, n_variants, client_id)
+                return {"index": index, "status": "ok", "result": result}
+            except Exception as e:
+                return {"index": index, "status": "error", "code": error_status(e), **error_body(e)}
+
+        tasks = [asyncio.ensure_future(one(i, item)) for i, item in enumerate(items)]
+        if not request.wants_events:
+            return await send_json(writer, 200, {"results": await asyncio.gather(*tasks)})
+
+        await start_events(writer)
+        counts = {"ok": 0, "error": 0}
+        for done in asyncio.as_completed(tasks):
+            record = await done
+            counts[record["status"]] += 1
+            await send_event(writer, "result", record)
+        await send_event(writer, "done", counts)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP API for email generation")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None, help="Số thread chạy pipeline")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    import gemini_client
+
+    load_dotenv()
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("Missing GEMINI_API_KEY in environment/.env")
+    gemini_client.configure(api_key)
+
+    async def run():
+        server = await ApiServer(workers=args.workers).serve(args.host, args.port)
+        print(f"Email API listening on http://{args.host}:{args.port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
-import os, re, json, textwrap
-from typing import Tuple
+import os, json, time, uuid, hashlib
 from dotenv import load_dotenv
 import streamlit as st
-import google.generativeai as genai
+from cache import get_response_cache
+from gemini_client import get_hedge_policy
+from routing import get_router
+from history import get_history
+from prefetch import Prefetcher, request_key
+from scheduler import SchedulerError, UserQuotaExceeded, get_scheduler, use_scheduler
+from token_usage import get_token_ledger
+from metrics import format_waterfall, get_metrics
+from email_core import (
+    TONE_TEMPERATURE, build_vars_map, generate_email, generate_email_variants, stream_generate_email,
+    subject_variants,
+)
+
+# Thời gian mỗi lần Streamlit chạy lại script (mục tiêu ở README, mục "Rerun của app")
+_RERUN_STARTED = time.perf_counter()
 
 
 
 # ---- Config & setup ----
+# Page này chỉ là lớp UI mỏng trên email_core; Gemini client tự khởi tạo ở lần gọi đầu tiên
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY:
+    st.error("⚠️ Thiếu GEMINI_API_KEY (đặt trong .env hoặc Streamlit Secrets).")
     st.stop()  # Dừng app nếu thiếu key
-genai.configure(api_key=API_KEY)
-
-MODEL_NAME = "gemini-2.5-flash"
-GENCFG = {"temperature": 0.6, "top_p": 0.9}
 
 # === Preset cấu hình test nhanh ===
 PRESETS = {
@@ -52,7 +63,73 @@ PRESETS = {
     },
 }
 
+
+def _is_sales(purpose: str) -> bool:
+    p = (purpose or "").lower()
+    return "sales" in p or "chào hàng" in p
+
+
+# Cookie XSRF server Streamlit đặt cho mỗi trình duyệt (server.enableXsrfProtection, mặc định bật)
+_BROWSER_COOKIE = "_streamlit_xsrf"
+# Prefetch tính vào budget của chính user nhưng chừa lại vài lượt cuối cho request thật
+_PREFETCH_RESERVE = 5
+
+
+def _http_request():
+    # Request HTTP của session (bản đang pin 1.28 chỉ có qua runtime nội bộ → thử, lỗi thì bỏ qua)
+    try:
+        from streamlit.runtime import get_instance
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+        return get_instance().get_client(get_script_run_ctx().session_id).request
+    except Exception:
+        return None
+
+
+def _client_ip() -> str | None:
+    ip = getattr(getattr(st, "context", None), "ip_address", None)
+    if ip:
+        return ip
+    return getattr(_http_request(), "remote_ip", None)
+
+
+def _browser_id() -> str | None:
+    """Id ổn định của trình duyệt (hash cookie XSRF): chung giữa các tab/reload, khác nhau dù chung IP"""
+    cookies = getattr(getattr(st, "context", None), "cookies", None)
+    if cookies is None:
+        cookies = getattr(_http_request(), "cookies", None)
+    try:
+        value = cookies.get(_BROWSER_COOKIE) if cookies is not None else None
+    except Exception:
+        return None
+    value = getattr(value, "value", value)  # tornado trả Morsel, st.context trả str
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16] if value else None
+
+
+def _client_identity() -> str:
+    """
+    Tên user trong scheduler, ổn định qua reload trang (budget theo ngày không reset khi mở tab mới):
+    tài khoản đăng nhập (st.user, nếu có auth) → cookie trình duyệt → session (không xác định được gì khác)
+    IP không dùng làm identity: sau proxy / NAT / mạng văn phòng nhiều người chung 1 IP (xem _client_group)
+    """
+    user = getattr(st, "user", None)
+    try:
+        if user is not None and user.get("is_logged_in") and user.get("email"):
+            return f"user-{user.get('email')}"
+    except Exception:
+        pass
+    browser = _browser_id()
+    return f"browser-{browser}" if browser else f"session-{uuid.uuid4().hex[:8]}"
+
+
+def _client_group() -> str | None:
+    # IP chỉ là trần thô thêm (EMAILGEN_SCHED_GROUP_DAILY) cho mọi identity cùng 1 IP, không chia fair queuing
+    ip = _client_ip()
+    return f"ip-{ip}" if ip else None
+
+
 # --- State defaults ---
+# Giá trị mặc định đặt qua session state (widget chỉ dùng key) → preset / lịch sử ghi đè được trước khi vẽ form
 if "purpose" not in st.session_state:
     st.session_state.purpose  = "Customer reply / Phản hồi khách hàng"
 if "tone" not in st.session_state:
@@ -69,663 +146,78 @@ if "recipient" not in st.session_state:
     st.session_state.recipient = ""
 if "signature" not in st.session_state:
     st.session_state.signature = "Best regards,\nPhuoc Doan"
+if "audience" not in st.session_state:
+    st.session_state.audience = "B2B"
+if "require_cta" not in st.session_state:
+    # CTA mặc định theo purpose (sales → bật); đổi purpose thì _on_purpose_change đặt lại
+    st.session_state.require_cta = _is_sales(st.session_state.purpose)
 if "cta_template" not in st.session_state:
     st.session_state.cta_template = "Đặt lịch demo"
+if "var_hotline" not in st.session_state:
+    st.session_state.var_hotline = "1900 xxxx"
 if "auto_subject" not in st.session_state:
     st.session_state.auto_subject = False
-
-
-
-def is_vi(lang: str) -> bool:
-    return str(lang).lower().startswith("vi")
-
-def localize_signature(signature: str, lang: str) -> str:
-    sig = (signature or "").strip()
-    if not sig:
-        return sig
-    if is_vi(lang) and sig.lower().startswith("best regards"):
-        return sig.replace("Best regards", "Trân trọng")
-    if not is_vi(lang) and sig.startswith("Trân trọng"):
-        return sig.replace("Trân trọng", "Best regards")
-    return sig
-
-
-
-
-def call_gemini(prompt: str, temperature: float = 0.6) -> str:
-    model = genai.GenerativeModel(MODEL_NAME, generation_config={"temperature": temperature})
-    resp = model.generate_content(prompt)
-    return resp.text.strip()
-
-def build_json_prompt_v2(purpose, tone, recipient, details, lang, 
-                         words=120, require_cta=True, salutation_line="", variables=None):
-    """
-    Version mới: KHÔNG yêu cầu model thêm signature
-    Signature sẽ được xử lý bởi code sau khi model trả về
-    """
-    cta_rule = "Include a clear call-to-action at the end." if require_cta else "Do not include a call-to-action."
-    
-    var_info = ""
-    if variables:
-        var_items = []
-        if variables.get("order_id"):
-            var_items.append(f"- Order ID: {variables['order_id']}")
-        if variables.get("delivery_date"):
-            var_items.append(f"- Delivery date: {variables['delivery_date']}")
-        if variables.get("hotline"):
-            var_items.append(f"- Hotline: {variables['hotline']}")
-        if variables.get("meeting_link"):
-            var_items.append(f"- Meeting/Form link: {variables['meeting_link']}")
-        if var_items:
-            var_info = "\nAvailable variables:\n" + "\n".join(var_items)
-    
-    return f"""
-You are an assistant that writes concise, professional business emails.
-Return STRICT JSON only. No markdown, no explanations, no code fences.
-
-Constraints (non-negotiable):
-- Language: {lang}
-- Tone: {tone}
-- Subject line ≤ 60 characters
-- Body around {words} words
-- Use the provided recipient if available; otherwise keep it natural
-- {cta_rule}
-- Start the body with this exact salutation line (if non-empty): "{salutation_line}"
-- Do NOT add any closing signature (like "Best regards" or "Trân trọng"). The body should end with the main content or CTA.
-- Do NOT use placeholders like [Link...] or [form...]. Use actual values from variables if available.
-
-Context:
-- Purpose: {purpose}
-- Recipient: {recipient or "N/A"}
-- Details: {details or "N/A"}{var_info}
-
-Return EXACTLY this JSON shape:
-{{"subject": "<one line>", "body": "<multi-line email body WITHOUT signature>"}}
-""".strip()
-
-
-
-def build_prompt(purpose, tone, recipient, details, lang, signature, words=120, require_cta=True):
-    cta_rule = "Include a clear call-to-action at the end." if require_cta else "Do not include a call-to-action."
-    return f"""
-System instructions (non-negotiable):
-- Output in {lang}.
-- Professional, polite, concise tone: {tone}.
-- Subject line ≤ 60 characters.
-- Body around {words} words.
-- Use the provided recipient if available; otherwise keep it generic but natural.
-- {cta_rule}
-- Strictly follow the output schema below.
-
-Context:
-- Purpose: {purpose}
-- Recipient: {recipient or "N/A"}
-- Details: {details or "N/A"}
-- Signature (must end the body): {signature}
-
-Output schema (do not add extra text):
-Subject: <one line>
-Body:
-<multiple lines, ready to paste into an email client>
-""".strip()
-
-
-def parse_email(text: str):
-    # Cố gắng tách Subject và Body nếu model trả đúng format
-    subj_match = re.search(r"^Subject:\s*(.+)", text, flags=re.IGNORECASE|re.MULTILINE)
-    body_match = re.search(r"^Body:\s*(.*)$", text, flags=re.IGNORECASE|re.DOTALL|re.MULTILINE)
-    subject = subj_match.group(1).strip() if subj_match else "Generated Email"
-    body = body_match.group(1).strip() if body_match else text
-    return subject, body
-
-def call_gemini_json(prompt: str, temperature: float = 0.6) -> dict:
-    cfg = dict(GENCFG)
-    cfg["temperature"] = temperature
-    model = genai.GenerativeModel(MODEL_NAME, generation_config=cfg)
-    resp = model.generate_content(prompt)
-    text = (resp.text or "").strip()
-
-    # Thử parse JSON thẳng
-    try:
-        return json.loads(text)
-    except Exception:
-        # Fallback: cố gắng trích khối {...} lớn nhất
-        start, end = text.find("{"), text.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            snippet = text[start:end+1]
-            try:
-                return json.loads(snippet)
-            except Exception:
-                pass
-        # Fallback cuối cùng: trả cấu trúc tối thiểu
-        return {"subject": "Generated Email", "body": text or "No content"}
-
-def has_cta_in_body(body: str, lang: str) -> bool:
-    """Kiểm tra xem body đã có CTA (bất kỳ loại) chưa"""
-    t = (body or "").lower()
-    if is_vi(lang):
-        patterns = [
-            # Form CTA
-            r"(điền form|điền biểu mẫu|điền vào|biểu mẫu ngắn gọn)",
-            # Đặt lịch/Hẹn lịch
-            r"(đặt lịch|hẹn lịch|đặt hẹn|trao đổi.*?phút|thời gian phù hợp|cho tôi biết thời gian|lịch trình)",
-            # Phản hồi/Xác nhận
-            r"(phản hồi email|xác nhận)",
-            # Tải tài liệu
-            r"(tải tài liệu|tải file|download|xem thêm)",
-            # CTA do model sinh ra
-            r"(hãy đăng ký|đăng ký tại|đăng ký ngay|liên hệ hotline|liên hệ.*?hotline|vui lòng liên hệ)",
-            # Link CTA
-            r"(https?://|www\.)",
-        ]
-    else:
-        patterns = [
-            r"(fill out|fill in the form|form)",
-            r"(schedule|book a call|demo|time that works)",
-            r"(reply to|confirm)",
-            r"(download|view the|brief deck)",
-            # CTA do model sinh ra
-            r"(please.*?register|register.*?here|sign up|click.*?link|visit.*?link)",
-            # Link CTA
-            r"(https?://|www\.)",
-        ]
-    return any(re.search(p, t, re.IGNORECASE) for p in patterns)
-
-def enforce_rules_v2(subject: str,
-                     body: str,
-                     require_cta: bool = True,
-                     purpose: str = None,
-                     lang: str = "Vietnamese",
-                     audience: str = "B2B",
-                     variables: dict | None = None):
-    """
-    Version mới: KHÔNG xử lý signature
-    Chỉ xử lý: subject length, CTA, placeholder cleanup
-    """
-    subject = (subject or "Generated Email").strip()
-    if len(subject) > 70:
-        subject = subject[:67].rstrip() + "..."
-
-    body = (body or "").strip()
-
-    # Gỡ CTA tiếng Anh khi đang viết tiếng Việt
-    if is_vi(lang):
-        body = re.sub(
-            r"\n*Please let me know a suitable time to proceed\.\s*$",
-            "",
-            body,
-            flags=re.IGNORECASE
-        )
-
-    # Quy tắc CTA theo loại email
-    purpose = (purpose or "").strip()
-    purpose_vi = purpose.lower()
-
-    is_leave = "leave request" in purpose_vi or "xin nghỉ" in purpose_vi
-    
-    # Xử lý CTA
-    if require_cta and not is_leave:
-        if not has_cta_in_body(body, lang):
-            tpl = (variables or {}).get("_cta_template")
-            pronoun = "Quý vị" if audience == "B2B" else "Anh/chị"
-            
-            if is_vi(lang):
-                if tpl == "Phản hồi xác nhận":
-                    body += f"\n\n{pronoun} vui lòng phản hồi email này để xác nhận giúp tôi nhé."
-                elif tpl == "Điền form":
-                    link = (variables or {}).get("meeting_link") or ""
-                    if link:
-                        body += f"\n\n{pronoun} có thể điền form tại đây để chúng tôi chuẩn bị nội dung phù hợp: {link}"
-                    else:
-                        body += f"\n\n{pronoun} có thể điền form để chúng tôi chuẩn bị nội dung phù hợp."
-                elif tpl == "Tải tài liệu":
-                    link = (variables or {}).get("meeting_link") or ""
-                    if link:
-                        body += f"\n\n{pronoun} có thể tải tài liệu giới thiệu tại đây: {link}"
-                    else:
-                        body += f"\n\n{pronoun} có thể tải tài liệu giới thiệu của chúng tôi."
-                else:
-                    body += f"\n\n{pronoun} có thể cho tôi biết thời gian phù hợp để trao đổi ngắn 15–20 phút không?"
-            else:
-                if tpl == "Phản hồi xác nhận":
-                    body += "\n\nPlease reply to confirm at your convenience."
-                elif tpl == "Điền form":
-                    link = (variables or {}).get("meeting_link") or ""
-                    if link:
-                        body += f"\n\nCould you fill out this short form so we can tailor the demo: {link}"
-                    else:
-                        body += "\n\nCould you fill out this short form so we can tailor the demo?"
-                elif tpl == "Tải tài liệu":
-                    link = (variables or {}).get("meeting_link") or ""
-                    if link:
-                        body += f"\n\nYou can download our brief deck here: {link}"
-                    else:
-                        body += "\n\nYou can download our brief deck."
-                else:
-                    body += "\n\nWould you be open to a quick 15–20 min demo next week?"
-    
-    # Xóa placeholder
-    body = re.sub(r"\[.*?link.*?biểu mẫu.*?\]", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"\[.*?địa chỉ.*?form.*?\]", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"\[Link.*?\]", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"\[.*?form.*?\]", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"\[.*?\]", "", body)
-    body = re.sub(r"tại đây:\s*\.\s*", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"tại đây\s*:\s*$", "", body, flags=re.IGNORECASE | re.MULTILINE)
-    body = re.sub(r"here:\s*\.\s*", "", body, flags=re.IGNORECASE)
-    body = re.sub(r"here\s*:\s*$", "", body, flags=re.IGNORECASE | re.MULTILINE)
-    body = re.sub(r"\n\n+", "\n\n", body)
-    
-    return subject, body.rstrip()
-
-
-def normalize_signature_text(sig: str, lang: str) -> str:
-    """
-    Chuẩn hóa signature theo ngôn ngữ
-    LUÔN trả về format: "Salutation,\nName" (xuống hàng)
-    """
-    if not sig or not sig.strip():
-        return ""
-    
-    sig = sig.strip()
-    lines = sig.split('\n')
-    
-    # Lấy salutation (dòng đầu) và name (phần còn lại)
-    salutation = lines[0].strip() if lines else ""
-    name_part = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ""
-    
-    # Nếu chỉ có 1 dòng, cố gắng tách salutation và name
-    if not name_part and salutation:
-        # Pattern: "Best regards, Name" hoặc "Trân trọng, Name"
-        match = re.match(r'^(Best regards|Warm regards|Sincerely|Trân trọng),?\s+(.+)$', salutation, re.IGNORECASE)
-        if match:
-            salutation = match.group(1)
-            name_part = match.group(2)
-    
-    # Chuẩn hóa salutation theo ngôn ngữ
-    if is_vi(lang):
-        # EN → VI
-        if re.match(r'^(Best regards|Warm regards|Sincerely)', salutation, re.IGNORECASE):
-            salutation = "Trân trọng"
-        # Giữ nguyên nếu đã là VI
-    else:
-        # VI → EN
-        if re.match(r'^Trân trọng', salutation, re.IGNORECASE):
-            salutation = "Best regards"
-        # Giữ nguyên nếu đã là EN
-    
-    # Trả về format chuẩn: "Salutation,\nName"
-    if name_part:
-        return f"{salutation},\n{name_part}"
-    else:
-        return salutation
-
-def get_signature_canonical(sig: str) -> str:
-    """
-    Tạo dạng chuẩn để so sánh (loại bỏ noise nhưng GIỮ CẤU TRÚC)
-    Xử lý cả 2 format: "Salutation, Name" (cùng dòng) và "Salutation,\nName" (xuống dòng)
-    """
-    if not sig:
-        return ""
-    
-    sig = sig.strip()
-    
-    # Xử lý format cùng dòng: "Best regards, Name" → "Best regards,\nName"
-    sig = re.sub(
-        r'^(Best regards|Warm regards|Sincerely|Trân trọng),?\s+(.+)$',
-        r'\1,\n\2',
-        sig,
-        flags=re.IGNORECASE | re.MULTILINE
-    )
-    
-    lines = sig.split('\n')
-    canonical = []
-    
-    for line in lines:
-        # Chuẩn hóa whitespace
-        line = re.sub(r'\s+', ' ', line.strip())
-        
-        # Loại bỏ dấu câu cuối dòng (nhưng GIỮ dấu phẩy sau salutation)
-        if not re.match(r'^(Best regards|Trân trọng|Warm regards|Sincerely)', line, re.IGNORECASE):
-            line = line.rstrip('.,;:')
-        
-        # Lowercase để so sánh không phân biệt hoa thường
-        if line:
-            canonical.append(line.lower())
-    
-    return '||'.join(canonical)  # Dùng delimiter rõ ràng
-
-def _canonicalize_signature_lines(lines: list[str]) -> list[str]:
-    canon = []
-    for line in lines:
-        simplified = re.sub(r"\s+", " ", line.strip())
-        simplified = simplified.strip(" ,.;:-")
-        if not simplified:
-            continue
-        canon.append(simplified.lower())
-    return canon
-
-
-def _collect_tail_block(lines: list[str], sig_len: int) -> tuple[list[str], list[int]]:
-    idx = len(lines) - 1
-    collected: list[str] = []
-    positions: list[int] = []
-
-    while idx >= 0 and len(collected) < sig_len:
-        raw = lines[idx]
-        if raw.strip():
-            collected.append(raw)
-            positions.append(idx)
-        idx -= 1
-
-    if len(collected) < sig_len:
-        return [], []
-
-    collected.reverse()
-    positions.reverse()
-    return collected, positions
-
-
-def dedupe_signature(body: str, normalized_sig: str) -> str:
-    if not body or not normalized_sig:
-        return body
-
-    sig_lines = [line for line in normalized_sig.strip().splitlines() if line.strip()]
-    if not sig_lines:
-        return body
-
-    sig_canon = _canonicalize_signature_lines(sig_lines)
-    if not sig_canon:
-        return body
-
-    lines = body.rstrip().splitlines()
-
-    while len(lines) >= len(sig_lines):
-        tail_lines, positions = _collect_tail_block(lines, len(sig_canon))
-        if not tail_lines:
-            break
-
-        tail_canon = _canonicalize_signature_lines(tail_lines)
-        if tail_canon != sig_canon:
-            break
-
-        for pos in reversed(positions):
-            del lines[pos]
-        while lines and not lines[-1].strip():
-            lines.pop()
-
-    return "\n".join(lines).rstrip()
-
-
-def has_signature(body: str, signature: str) -> bool:
-    """
-    Kiểm tra xem body ĐÃ CÓ signature chưa (so sánh canonical)
-    """
-    if not body or not signature:
-        return False
-    
-    sig_canonical = get_signature_canonical(signature)
-    if not sig_canonical:
-        return False
-    
-    # Lấy N dòng cuối của body (N = số dòng của signature)
-    sig_lines = [l for l in signature.strip().split('\n') if l.strip()]
-    num_lines = len(sig_lines)
-    
-    body_lines = body.rstrip().split('\n')
-    if len(body_lines) < num_lines:
-        return False
-    
-    # Lấy tail và so sánh canonical
-    tail_lines = body_lines[-num_lines:]
-    tail_text = '\n'.join(tail_lines)
-    tail_canonical = get_signature_canonical(tail_text)
-    
-    return tail_canonical == sig_canonical
-
-
-def remove_signature(body: str, signature: str) -> str:
-    """
-    Xóa signature khỏi body (nếu có) - dùng canonical matching
-    """
-    if not body or not signature:
-        return body
-    
-    sig_canonical = get_signature_canonical(signature)
-    if not sig_canonical:
-        return body
-    
-    sig_lines = [l for l in signature.strip().split('\n') if l.strip()]
-    num_lines = len(sig_lines)
-    
-    body_lines = body.rstrip().split('\n')
-    
-    # Xóa từ cuối lên, chỉ xóa nếu match canonical
-    while len(body_lines) >= num_lines:
-        tail_lines = body_lines[-num_lines:]
-        tail_text = '\n'.join(tail_lines)
-        tail_canonical = get_signature_canonical(tail_text)
-        
-        if tail_canonical == sig_canonical:
-            # Xóa signature
-            body_lines = body_lines[:-num_lines]
-            # Xóa dòng trống thừa
-            while body_lines and not body_lines[-1].strip():
-                body_lines.pop()
-        else:
-            break
-    
-    return '\n'.join(body_lines)
-
-
-def add_signature(body: str, signature: str) -> str:
-    """
-    Thêm signature vào body (CHỈ KHI chưa có)
-    Format: body + 2 dòng trống + signature (với xuống hàng)
-    """
-    if not signature:
-        return body
-    
-    # Kiểm tra xem đã có chưa
-    if has_signature(body, signature):
-        return body
-    
-    # Đảm bảo signature có format chuẩn (xuống hàng)
-    sig_lines = signature.strip().split('\n')
-    if len(sig_lines) == 1:
-        # Nếu chỉ có 1 dòng, giữ nguyên (có thể là chỉ salutation)
-        formatted_sig = signature.strip()
-    else:
-        # Nếu có nhiều dòng, đảm bảo format: "Salutation,\nName"
-        formatted_sig = '\n'.join(sig_lines)
-    
-    # Thêm với format chuẩn: body + 2 dòng trống + signature
-    body = body.rstrip()
-    return f"{body}\n\n{formatted_sig}" if body else formatted_sig
-
-def has_cta_invite(body: str, lang: str) -> bool:
-    t = (body or "").lower()
-    if is_vi(lang):
-        patterns = [
-            r"anh/chị.*(có thể|vui lòng).*(hẹn|đặt lịch|trao đổi|demo)",
-            r"(hẹn|lịch|trao đổi|demo).*(tuần này|ngày|thời gian|phút)",
-            r"(thời gian).*?(phù hợp|thuận tiện)",
-        ]
-    else:
-        patterns = [
-            r"would you be (available|open)",
-            r"could (we|you) (schedule|set up)",
-            r"(does|would) .* (work|suit) for you",
-            r"quick (15|20)[–-]?(min| minute) (call|demo)",
-        ]
-    return any(re.search(p, t, re.IGNORECASE) for p in patterns)
-
-
-
-def soften_claims(text: str, lang: str) -> str:
-    s = text
-
-    if is_vi(lang):
-        # "lên đến 20%" -> "khoảng/đã ghi nhận tới ~20% ở một số trường hợp"
-        s = re.sub(r"lên đến\s*(\d+%)", r"đã ghi nhận tới khoảng \1 ở một số trường hợp", s, flags=re.IGNORECASE)
-        # "cam kết" -> "nỗ lực/định hướng mang lại"
-        s = re.sub(r"\bcam kết\b", "nỗ lực", s, flags=re.IGNORECASE)
-        # "giải pháp tiên tiến" -> giữ 1 lần, tránh lặp
-        s = re.sub(r"giải pháp tiên tiến(,?\s*)", "giải pháp phù hợp, ", s, flags=re.IGNORECASE)
-    else:
-        s = re.sub(r"up to\s*(\d+%)", r"we’ve seen up to around \1 in some cases", s, flags=re.IGNORECASE)
-        s = re.sub(r"\bguarantee\b", "aim to", s, flags=re.IGNORECASE)
-        s = re.sub(r"\bcutting-edge solution\b", "a suitable solution", s, flags=re.IGNORECASE)
-
-    return s
-
-
-
-def suggest_subject(purpose: str, lang: str) -> str:
-    pv = (purpose or "").lower()
-    if is_vi(lang):
-        if "sales outreach" in pv or "chào hàng" in pv:
-            return "Mời demo giải pháp giúp tối ưu hiệu suất (15–20’)"
-        if "customer reply" in pv or "phản hồi khách hàng" in pv:
-            return "Thư xin lỗi về đơn hàng và ưu đãi đính kèm"
-        if "status update" in pv or "cập nhật tiến độ" in pv:
-            return "Cập nhật tiến độ công việc"
-        if "leave request" in pv or "xin nghỉ" in pv:
-            return "Đề nghị xin nghỉ phép"
-        return "Thông tin trao đổi"
-    else:
-        if "sales outreach" in pv:
-            return "Quick 15–20’ demo to improve efficiency"
-        if "customer reply" in pv:
-            return "Apology for your order – with a voucher"
-        if "status update" in pv:
-            return "Project status update"
-        if "leave request" in pv:
-            return "Leave request"
-        return "Regarding our discussion"
-
-
-def trim_pleasantries(body: str, lang: str, purpose: str) -> str:
-    if not body or not purpose:
-        return body
-    s = body
-
-    if is_vi(lang):
-        patterns = [
-            # Câu mở đầu
-            r"^(Kính gửi.*?,\s*)?Hy vọng (anh|chị|bạn|quý.*) có một ngày (tốt lành|hiệu quả)\.?\s*\n",
-            r"^(Kính gửi.*?,\s*)?Chúc (anh|chị|bạn|quý.*) một ngày (tốt lành|hiệu quả)\.?\s*\n",
-            r"^(Kính gửi.*?,\s*)\s*(Chúng tôi|Tôi|Bên tôi)\s+hy vọng\s+.*?\.\s*\n",
-            # Câu ở giữa body - "Hy vọng ... sẽ ..."
-            r"\n\s*Hy vọng (anh|chị|bạn|quý.*) sẽ (tiếp tục|ủng hộ|hợp tác|phát triển).*?\.\s*\n",
-            # Câu "Chúc ... có ..."
-            r"\n\s*Chúc (anh|chị|bạn|quý.*) (có một|một|thật)\s+(ngày|tuần|tháng)\s+(tốt lành|hiệu quả|thành công).*?\.\s*\n",
-            # Câu "Hy vọng được ..."
-            r"\n\s*Hy vọng được (nghe|nhận|trao đổi).*?\.\s*(?=\n\n|$)",
-            # Câu "Hy vọng ..." (generic)
-            r"\n\s*Hy vọng.*?\.\s*\n",
-        ]
-    else:
-        patterns = [
-            r"^(Dear .*?,\s*)?I hope (this email )?finds you well\.?\s*\n",
-            r"^(Dear .*?,\s*)?Hope you are doing well\.?\s*\n",
-            r"\n\s*I hope you will (continue|support|work).*?\.\s*\n",
-            r"\n\s*Wishing you (a great|a wonderful).*?\.\s*\n",
-            r"\n\s*I hope.*?\.\s*\n",
-        ]
-
-    for p in patterns:
-        s = re.sub(p, "\n", s, flags=re.IGNORECASE)
-    
-    # Xóa dòng trống thừa
-    s = re.sub(r"\n\n+", "\n\n", s)
-    return s.strip()
-
-
-
-def build_salutation(recipient: str, lang: str) -> str:
-    if not recipient or not recipient.strip():
-        return ""
-    name = recipient.strip()
-    if is_vi(lang):
-        # VI: không ép “quý công ty” ở đây để tránh cứng nhắc; salutation trung tính
-        return f"Kính gửi {name},"
-    else:
-        return f"Dear {name},"
-
-
-def tune_audience(body: str, audience: str, lang: str) -> str:
-    if not body:
-        return body
-    s = body
-    if is_vi(lang):
-        if audience == "B2B":
-            # Nâng mức trang trọng, thêm "quý công ty" nếu phù hợp
-            s = re.sub(r"\banh/chị\b", "anh/chị", s, flags=re.IGNORECASE)  # giữ nguyên
-            # Khi có “doanh nghiệp bạn/anh”, đổi thành “quý công ty”
-            s = re.sub(r"\b(doanh nghiệp|công ty)\s+(anh|bạn)\b", "quý công ty", s, flags=re.IGNORECASE)
-        else:  # B2C
-            # Hạ bớt những cụm quá trang trọng
-            s = re.sub(r"\bquý\s*công\s*ty\b", "anh/chị", s, flags=re.IGNORECASE)
-            s = re.sub(r"\bquý\s*đơn vị\b", "anh/chị", s, flags=re.IGNORECASE)
-    else:
-        # English: B2B nhẹ tính formal; B2C nhẹ friendly
-        if audience == "B2B":
-            s = re.sub(r"\byou\b", "your team", s, flags=re.IGNORECASE)
-        else:
-            s = re.sub(r"\byour team\b", "you", s, flags=re.IGNORECASE)
-    return s
-
-
-def interpolate_variables(text: str, variables: dict) -> str:
-    if not text:
-        return text
-    s = text
-    for k, v in variables.items():
-        s = s.replace("{{" + k + "}}", v or "")
-    return s
-
-def subject_variants(base: str, purpose: str, lang: str) -> list:
-    base = (base or "").strip()
-    cand = []
-    if is_vi(lang):
-        if "sales outreach" in purpose.lower() or "chào hàng" in purpose.lower():
-            cand += ["Mời demo giải pháp (15–20’)", "Giới thiệu giải pháp tối ưu hiệu suất", "Hẹn trao đổi nhanh về nhu cầu"]
-        elif "customer reply" in purpose.lower() or "phản hồi khách hàng" in purpose.lower():
-            cand += ["Thành thật xin lỗi về sự chậm trễ đơn hàng", "Cập nhật đơn hàng & ưu đãi"]
-        elif "status update" in purpose.lower() or "cập nhật tiến độ" in purpose.lower():
-            cand += ["Cập nhật tiến độ dự án", "Tình trạng các mốc công việc"]
-        elif "leave request" in purpose.lower() or "xin nghỉ" in purpose.lower():
-            cand += ["Đề nghị xin nghỉ phép", "Xin phép nghỉ 1 ngày"]
-        else:
-            cand += ["Thông tin trao đổi", "Trao đổi nhanh"]
-    else:
-        if "sales outreach" in purpose.lower():
-            cand += ["Quick 15–20’ demo request", "Intro to our solution", "Brief chat about your needs"]
-        elif "customer reply" in purpose.lower():
-            cand += ["Sincere apology for the delay", "Order update with a voucher"]
-        elif "status update" in purpose.lower():
-            cand += ["Project status update", "Milestone progress update"]
-        elif "leave request" in purpose.lower():
-            cand += ["Leave request", "Requesting one day off"]
-        else:
-            cand += ["Regarding our discussion", "Quick follow-up"]
-
-    if base and base.lower() not in {"subject", "generated email"}:
-        cand = [base] + cand
-
-    uniq = []
-    for x in cand:
-        x = x.strip()
-        if not x:
-            continue
-        if len(x) > 60:
-            x = x[:57].rstrip() + "..."
-        if x not in uniq:
-            uniq.append(x)
-    return uniq[:5]
-
-
+if "stream_mode" not in st.session_state:
+    st.session_state.stream_mode = True
+if "n_variants" not in st.session_state:
+    st.session_state.n_variants = 1
+if "prefetch_mode" not in st.session_state:
+    st.session_state.prefetch_mode = False
+if "user_id" not in st.session_state:
+    # 1 "user" trong scheduler dùng chung (fair queuing + budget theo ngày); các tab / lần reload của
+    # cùng trình duyệt chung 1 budget. Trần theo IP client: EMAILGEN_SCHED_GROUP_DAILY, cả process: EMAILGEN_SCHED_DAILY
+    st.session_state.user_id = _client_identity()
+    st.session_state.user_group = _client_group()
+if "prefetcher" not in st.session_state:
+    def _prefetch_generate(_user=st.session_state.user_id, _group=st.session_state.user_group, **kwargs):
+        # Prefetch chạy ở thread nền: xếp hàng qua scheduler dưới chính user (tính vào budget của user, không
+        # nhân đôi budget), nhường request thật nhờ weight thấp hơn và không dùng _PREFETCH_RESERVE lượt cuối
+        left = get_scheduler().remaining(_user, _group)
+        if left is not None and left <= _PREFETCH_RESERVE:
+            raise UserQuotaExceeded(f"Last {_PREFETCH_RESERVE} requests of {_user} are kept for Generate")
+        with use_scheduler(_user, weight=0.5, group=_group):
+            return generate_email(**kwargs)
+    st.session_state.prefetcher = Prefetcher(_prefetch_generate)
+
+
+def _on_purpose_change():
+    # Như bản trước khi có form: CTA đi theo purpose (người dùng vẫn tự tắt/bật được sau đó)
+    st.session_state.require_cta = _is_sales(st.session_state.purpose)
+
+
+def _apply_preset():
+    # Callback chạy trước lần rerun kế tiếp → ghi thẳng vào key của widget, không cần st.rerun() thêm 1 lượt
+    preset_name = st.session_state.preset_name
+    st.session_state.last_preset = preset_name
+    if preset_name == "None":
+        return
+    p = PRESETS[preset_name]
+    for key in ("purpose", "tone", "lang", "style", "length", "details"):
+        st.session_state[key] = p[key]
+    st.session_state.require_cta = _is_sales(p["purpose"])
+    st.session_state.prefetch_now = True  # preset vừa load → prefetch ngay, không chờ debounce
+
+
+def _reuse_history_inputs(entry_id: int):
+    # Callback chạy trước khi widget được tạo ở lần rerun kế tiếp → ghi được vào key của widget
+    entry = get_history().get(entry_id)
+    if entry is None:
+        return
+    inputs = entry["inputs"]
+    variables = inputs.get("variables") or {}
+    for key in ("purpose", "tone", "lang", "audience", "length", "recipient", "details", "signature", "require_cta"):
+        if inputs.get(key) is not None:
+            st.session_state[key] = inputs[key]
+    for key in ("order_id", "delivery_date", "hotline", "meeting_link"):
+        st.session_state[f"var_{key}"] = variables.get(key, "")
+    if variables.get("_cta_template"):
+        st.session_state.cta_template = variables["_cta_template"]
+    st.session_state.n_variants = int(inputs.get("n_variants") or 1)
+
+
+# Fragment (Streamlit ≥ 1.37; experimental từ 1.33): đổi lựa chọn trong phần kết quả chỉ chạy lại phần đó.
+# Bản cũ hơn: chạy lại cả script - vẫn rẻ vì kết quả lấy từ session state, không gọi model
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
 
 
 
@@ -734,57 +226,29 @@ st.set_page_config(page_title="AI Email Generator", page_icon="📧", layout="ce
 st.title("📧 AI Email Generator (Gemini)")
 
 with st.sidebar:
-
-    preset_name = st.selectbox("🎯 Chọn kịch bản mẫu (optional)", ["None"] + list(PRESETS.keys()), key="preset_name")
-    audience = st.selectbox("Đối tượng (Audience)", ["B2B", "B2C"], key="audience")
-    st.markdown("**Biến (optional) để chèn vào Details/body:**")
-    v_order_id      = st.text_input("{{order_id}}", key="var_order_id")
-    v_delivery_date = st.text_input("{{delivery_date}}", key="var_delivery_date")
-    v_hotline       = st.text_input("{{hotline}}", value="1900 xxxx", key="var_hotline")
-    v_meeting_link  = st.text_input("{{meeting_link}}", key="var_meeting_link")
-    
-
-
-    if preset_name != "None":
-        p = PRESETS[preset_name]
-        # chỉ apply khi chọn preset mới (tránh vòng lặp rerun)
-        if st.session_state.get("last_preset") != preset_name:
-            st.session_state.purpose   = p["purpose"]
-            st.session_state.tone      = p["tone"]
-            st.session_state.lang      = p["lang"]
-            st.session_state.style     = p["style"]
-            st.session_state.length    = p["length"]
-            st.session_state.details   = p["details"]
-            st.session_state.last_preset = preset_name
-            st.rerun()
-
+    st.selectbox("🎯 Chọn kịch bản mẫu (optional)", ["None"] + list(PRESETS.keys()), key="preset_name",
+                 on_change=_apply_preset)
     if st.session_state.get("last_preset") and st.session_state.last_preset != "None":
         st.info(f"Preset đã load: {st.session_state.last_preset}")
 
+    st.subheader("Chế độ")
+    st.checkbox("⚡ Streaming (hiển thị body dần khi model trả về)", key="stream_mode")
+    # >1: sinh nhiều phương án trong 1 request (không stream)
+    st.number_input("Số phương án (variants)", min_value=1, max_value=5, step=1, key="n_variants")
+    st.checkbox("🔮 Prefetch (sinh trước ở nền khi settings đứng yên)", key="prefetch_mode")
 
-    st.subheader("Settings")
-    tone = st.selectbox("Tone (tông giọng)", ["Formal", "Friendly", "Apologetic", "Neutral"], key="tone")
-    lang = st.selectbox("Language / Ngôn ngữ", ["English", "Vietnamese"], key="lang")
-    signature = st.text_input("Signature / Chữ ký", key="signature")
-    # chuẩn hoá chữ ký theo ngôn ngữ (ghi lại vào state)
-    style = st.selectbox("Phong cách viết", ["Ngắn gọn", "Chuyên nghiệp", "Thân thiện"], key="style")
-    length = st.radio("Độ dài email", ["Ngắn", "Trung bình", "Chi tiết"], key="length")
-
-    words = {"Ngắn": 80, "Trung bình": 120, "Chi tiết": 160}[st.session_state.length]
-
-        # Điều chỉnh temperature theo tone
-    tone_temp_map = {"Formal": 0.4, "Friendly": 0.7, "Apologetic": 0.5, "Neutral": 0.6}
-    temperature = tone_temp_map.get(st.session_state.tone, 0.6)
-
-
-
+    sched_stats = get_scheduler().stats()
+    st.caption(f"Hàng đợi Gemini: {sched_stats['queue_depth']} chờ · {sched_stats['in_flight']} đang chạy · "
+               f"còn {get_scheduler().remaining(st.session_state.user_id, st.session_state.user_group)} lượt hôm nay")
 
 
 st.markdown("Nhập thông tin bên dưới để tạo email.")
 
+# Lựa chọn (purpose, tone, ngôn ngữ, audience, độ dài) nằm ngoài form: đổi là rerun 1 lần (rẻ, không gọi model)
+# và prefetch (debounce) sinh trước theo settings mới. Ô nhập text nằm trong form: gõ không rerun
 col1, col2 = st.columns(2)
 with col1:
-    purpose = st.selectbox("Loại email (Purpose)", [
+    st.selectbox("Loại email (Purpose)", [
         "Sales outreach / Chào hàng",
         "Customer reply / Phản hồi khách hàng",
         "Leave request / Xin nghỉ phép",
@@ -793,140 +257,271 @@ with col1:
         "Feedback request / Yêu cầu phản hồi",
         "Partnership inquiry / Hợp tác",
         "Generic business email / Chung"
-    ], key="purpose")
-
-    recipient = st.text_input("Người nhận (Recipient) - optional", key="recipient")
-
-is_sales = ("sales" in st.session_state.purpose.lower()) or ("chào hàng" in st.session_state.purpose.lower())
-
-# Luôn hiển thị CTA toggle (cho phép user bật/tắt CTA ở bất kỳ loại email nào)
-default_cta = True if is_sales else False
-require_cta = st.checkbox("Include call-to-action (CTA)", value=default_cta, key="require_cta")
-
-# CTA templates (chỉ khi CTA đang bật)
-if st.session_state.get("require_cta", False):
-    st.selectbox(
-        "CTA template",
-        ["Đặt lịch demo", "Phản hồi xác nhận", "Điền form", "Tải tài liệu"],
-        key="cta_template"
-    )
-
-
-
-
-auto_subject = st.checkbox("🔄 Tự chọn tiêu đề (ẩn hộp chọn)", value=st.session_state.auto_subject, key="auto_subject")
-
-details = st.text_area("Nội dung/Chi tiết thêm (Details) – càng cụ thể kết quả càng tốt",
-                       value=st.session_state.details, key="details")
-
-
-gen_btn = st.button("Generate Email")
+    ], key="purpose", on_change=_on_purpose_change)
+    st.selectbox("Tone (tông giọng)", ["Formal", "Friendly", "Apologetic", "Neutral"], key="tone")
+    st.selectbox("Phong cách viết", ["Ngắn gọn", "Chuyên nghiệp", "Thân thiện"], key="style")
+with col2:
+    st.selectbox("Language / Ngôn ngữ", ["English", "Vietnamese"], key="lang")
+    st.selectbox("Đối tượng (Audience)", ["B2B", "B2C"], key="audience")
+    st.radio("Độ dài email", ["Ngắn", "Trung bình", "Chi tiết"], key="length", horizontal=True)
+
+with st.form("email_form"):
+    st.text_input("Người nhận (Recipient) - optional", key="recipient")
+    st.text_area("Nội dung/Chi tiết thêm (Details) – càng cụ thể kết quả càng tốt", key="details")
+
+    # Form không chạy lại khi tick → CTA template luôn hiển thị, chỉ dùng khi CTA bật
+    col_cta, col_tpl = st.columns(2)
+    col_cta.checkbox("Include call-to-action (CTA)", key="require_cta")
+    col_tpl.selectbox("CTA template", ["Đặt lịch demo", "Phản hồi xác nhận", "Điền form", "Tải tài liệu"],
+                      key="cta_template")
+
+    with st.expander("⚙️ Chữ ký & biến"):
+        st.text_input("Signature / Chữ ký", key="signature")
+        st.markdown("**Biến (optional) để chèn vào Details/body:**")
+        col_v1, col_v2 = st.columns(2)
+        col_v1.text_input("{{order_id}}", key="var_order_id")
+        col_v1.text_input("{{delivery_date}}", key="var_delivery_date")
+        col_v2.text_input("{{hotline}}", key="var_hotline")
+        col_v2.text_input("{{meeting_link}}", key="var_meeting_link")
+
+    gen_btn = st.form_submit_button("Generate Email", type="primary")
+
+# Điều chỉnh temperature theo tone
+temperature = TONE_TEMPERATURE.get(st.session_state.tone, 0.6)
+
+vars_map = build_vars_map(
+    order_id=st.session_state.get("var_order_id", ""),
+    delivery_date=st.session_state.get("var_delivery_date", ""),
+    hotline=st.session_state.var_hotline,
+    meeting_link=st.session_state.get("var_meeting_link", ""),
+    cta_template=st.session_state.get("cta_template"),
+)
+gen_kwargs = dict(
+    recipient=st.session_state.recipient,
+    details=st.session_state.details,
+    signature=st.session_state.signature,
+    audience=st.session_state.audience,
+    length=st.session_state.length,
+    require_cta=st.session_state.get("require_cta", False),
+    variables=vars_map,
+    temperature=temperature,
+)
+prefetch_kwargs = dict(purpose=st.session_state.purpose, tone=st.session_state.tone,
+                       lang=st.session_state.lang, **gen_kwargs)
+prefetcher = st.session_state.prefetcher
+
+# Prefetch chỉ cho luồng 1 phương án; input đổi ở rerun sau sẽ tự bỏ prefetch cũ.
+# Rerun do đổi lựa chọn ngoài form / sidebar → prefetch theo settings mới + details đã gửi gần nhất
+prefetch_now = st.session_state.pop("prefetch_now", False)
+if st.session_state.prefetch_mode and st.session_state.n_variants == 1 and st.session_state.details.strip():
+    prefetcher.schedule(prefetch_kwargs, immediate=prefetch_now)
+else:
+    prefetcher.cancel()
 
 if gen_btn:
     if not st.session_state.details or not st.session_state.details.strip():
         st.error("⚠️ Vui lòng nhập nội dung chi tiết (Details) trước khi generate!")
     else:
-        with st.spinner("Generating..."):
-            # 1. CHUẨN HÓA SIGNATURE THEO NGÔN NGỮ
-            normalized_sig = normalize_signature_text(
-                st.session_state.signature, 
-                st.session_state.lang
-            )
-            
-            # 2. XÂY DỰNG PROMPT (KHÔNG bao gồm signature trong prompt nữa)
-            #    Để tránh model tự thêm signature
-            salutation_line = build_salutation(
-                st.session_state.recipient, 
-                st.session_state.lang
-            )
-            
-            vars_map = {
-                "order_id": st.session_state.var_order_id.strip() if st.session_state.var_order_id else "",
-                "delivery_date": st.session_state.var_delivery_date.strip() if st.session_state.var_delivery_date else "",
-                "hotline": st.session_state.var_hotline.strip() if st.session_state.var_hotline else "",
-                "meeting_link": st.session_state.var_meeting_link.strip() if st.session_state.var_meeting_link else "",
-                "_cta_template": st.session_state.get("cta_template")
-            }
-            
-            details_filled = interpolate_variables(st.session_state.details, vars_map)
-            
-            # 3. GỌI MODEL (signature KHÔNG trong prompt)
-            prompt = build_json_prompt_v2(  # Version mới, không có signature parameter
-                st.session_state.purpose,
-                st.session_state.tone,
-                st.session_state.recipient,
-                details_filled,
-                st.session_state.lang,
-                words=words,
-                require_cta=st.session_state.get("require_cta", False),
-                salutation_line=salutation_line,
-                variables=vars_map
-            )
-            
-            data = call_gemini_json(prompt, temperature=temperature)
-            subject_raw = data.get("subject", "")
-            body_raw = data.get("body", "")
-            
-            # 4. XỬ LÝ BODY
-            # 4a. Làm sạch pleasantries
-            body_clean = trim_pleasantries(body_raw, st.session_state.lang, st.session_state.purpose)
-            
-            # 4b. XÓA MỌI SIGNATURE CŨ (nếu model tự thêm)
-            body_clean = remove_signature(body_clean, normalized_sig)
-            
-            # 4c. Tune audience
-            body_clean = tune_audience(body_clean, st.session_state.audience, st.session_state.lang)
-            
-            # 4d. Enforce rules (CTA, etc) - KHÔNG xử lý signature ở đây nữa
-            subject, body = enforce_rules_v2(
-                subject_raw,
-                body_clean,
-                require_cta=st.session_state.get("require_cta", False),
-                purpose=st.session_state.purpose,
-                lang=st.session_state.lang,
-                audience=st.session_state.audience,
-                variables=vars_map
-            )
-            
-            # 4e. Soften claims
-            body = soften_claims(body, st.session_state.lang)
-            
-            # 5. THÊM SIGNATURE (BƯỚC CUỐI CÙNG, DUY NHẤT)
-            body = add_signature(body, normalized_sig)
-            
-            # 6. Suggest subject nếu cần
-            if not subject or subject.strip().lower() in {"generated email", "subject", ""}:
-                subject = suggest_subject(st.session_state.purpose, st.session_state.lang)
-            
-            # Trim subject length
-            if len(subject) > 60:
-                subject = subject[:57].rstrip() + "..."
-
-        # Render UI (ngoài spinner)
+        queue_note = st.empty()
+
+        def show_queue_position(position, waited):
+            queue_note.info(f"⏳ Đang xếp hàng: vị trí #{position} (đã chờ {waited:.0f}s)")
+
+        try:
+            with use_scheduler(st.session_state.user_id, on_wait=show_queue_position,
+                               group=st.session_state.user_group):
+                result = None
+                if st.session_state.prefetch_mode and st.session_state.n_variants == 1:
+                    with st.spinner("Generating..."):
+                        result = prefetcher.take(prefetch_kwargs)
+
+                # Prompt → Gemini → hậu xử lý (signature được thêm ở bước cuối)
+                if result is not None:
+                    st.caption("⚡ Lấy từ prefetch")
+                elif st.session_state.n_variants > 1:
+                    with st.spinner(f"Generating {st.session_state.n_variants} variants..."):
+                        result = generate_email_variants(
+                            st.session_state.purpose, st.session_state.tone, st.session_state.lang,
+                            n_variants=int(st.session_state.n_variants), **gen_kwargs
+                        )
+                elif st.session_state.stream_mode:
+                    # Hiển thị body dần trong lúc stream; hậu xử lý chạy khi stream đóng
+                    preview = st.empty()
+                    result = None
+                    for kind, payload in stream_generate_email(
+                        st.session_state.purpose, st.session_state.tone, st.session_state.lang, **gen_kwargs
+                    ):
+                        if kind == "partial":
+                            preview.text(payload["body"] or "Generating...")
+                        else:
+                            result = payload
+                    preview.empty()
+                else:
+                    with st.spinner("Generating..."):
+                        result = generate_email(
+                            st.session_state.purpose, st.session_state.tone, st.session_state.lang, **gen_kwargs
+                        )
+        except SchedulerError as e:
+            queue_note.empty()
+            st.error(f"⚠️ {e}")
+            st.stop()
+        queue_note.empty()
+        # Bấm Generate lại với cùng input = regenerate (thường do output lỗi) → theo dõi tỉ lệ qua metrics
+        current_key = request_key(prefetch_kwargs)
+        regenerated = st.session_state.get("last_request_key") == current_key
+        st.session_state.last_request_key = current_key
+        get_metrics().count("generate", "regenerate" if regenerated else "new")
+        history = get_history()
+        if history is not None:
+            history.add({"purpose": st.session_state.purpose, "tone": st.session_state.tone,
+                         "lang": st.session_state.lang, "n_variants": int(st.session_state.n_variants),
+                         **gen_kwargs}, result)
+        # Giữ kết quả (kèm purpose/lang lúc generate) qua các lần rerun; lựa chọn cũ không còn hợp lệ
+        st.session_state.result = result
+        st.session_state.result_context = {"purpose": st.session_state.purpose, "lang": st.session_state.lang}
+        for key in ("variant_pick", "subject_pick"):
+            st.session_state.pop(key, None)
         st.success("Generated successfully!")
-        
-        # Subject picker - chỉ hiển thị nếu auto_subject = False
-        if not st.session_state.auto_subject:
-            choices = subject_variants(subject, st.session_state.purpose, st.session_state.lang)
-            picked = st.radio("Chọn tiêu đề", choices, index=0, key="subject_pick")
-            if picked and picked != subject:
-                subject = picked
-        
-        st.markdown(f"**Subject:** {subject}")
-        if "Generated Email" in subject_raw or subject_raw.lower().strip() in {"generated email", "subject"}:
-            st.caption("⚠️ Subject được sinh tự động từ gợi ý fallback vì model không trả về.")
-        st.text_area("Body", value=body, height=260)
-        st.caption(f"Subject length: {len(subject)} chars | Body words: {len(body.split())}")
-        st.download_button(
-            "Download .txt",
-            data=(f"Subject: {subject}\n\n{body}").encode("utf-8"),
-            file_name="generated_email.txt",
-            mime="text/plain"
-        )
-        with st.expander("Debug (prompt & raw response)"):
-            st.code(prompt, language="markdown")
-            st.code(json.dumps(data, ensure_ascii=False, indent=2), language="json")
 
 
+@_fragment
+def render_result():
+    """Kết quả gần nhất từ session state: chọn phương án / tiêu đề không gọi lại model"""
+    result = st.session_state.get("result")
+    if result is None:
+        return
+    context = st.session_state.result_context
+    subject, body = result["subject"], result["body"]
+    subject_raw = result["subject_raw"]
+    prompt, data = result["prompt"], result["data"]
+    repair = result.get("repair")
+    candidates = result.get("candidates") or []
+
+    # Body picker - chọn 1 trong các phương án model trả về
+    if len(candidates) > 1:
+        labels = [f"#{i + 1}: {c['subject']}" for i, c in enumerate(candidates)]
+        picked_idx = st.radio("Chọn phương án", range(len(candidates)),
+                              format_func=lambda i: labels[i], index=0, key="variant_pick")
+        subject, body = candidates[picked_idx]["subject"], candidates[picked_idx]["body"]
+        subject_raw = candidates[picked_idx]["subject_raw"]
+        repair = candidates[picked_idx].get("repair")
+
+    # Subject picker - chỉ hiển thị nếu auto_subject = False
+    st.checkbox("🔄 Tự chọn tiêu đề (ẩn hộp chọn)", key="auto_subject")
+    if not st.session_state.auto_subject:
+        choices = subject_variants(subject, context["purpose"], context["lang"])
+        # Subject của các phương án khác cũng là lựa chọn
+        choices += [c["subject"] for c in candidates if c["subject"] not in choices]
+        if st.session_state.get("subject_pick") not in choices:
+            # Đổi phương án → bộ lựa chọn mới, bỏ lựa chọn cũ
+            st.session_state.pop("subject_pick", None)
+        picked = st.radio("Chọn tiêu đề", choices, index=0, key="subject_pick")
+        if picked and picked != subject:
+            subject = picked
+
+    st.markdown(f"**Subject:** {subject}")
+    if "Generated Email" in subject_raw or subject_raw.lower().strip() in {"generated email", "subject"}:
+        st.caption("⚠️ Subject được sinh tự động từ gợi ý fallback vì model không trả về.")
+    st.text_area("Body", value=body, height=260)
+    st.caption(f"Subject length: {len(subject)} chars | Body words: {len(body.split())}")
+    if repair and repair["violations"]:
+        fixed = [code for code in repair["violations"] if code not in repair["remaining"]]
+        note = f"🔧 Đã tự sửa: {', '.join(fixed) or '—'}"
+        if repair["followup"]:
+            note += f" (gọi lại model cho: {', '.join(repair['followup'])})"
+        if repair["remaining"]:
+            note += f" | Còn lỗi: {', '.join(repair['remaining'])}"
+        st.caption(note)
+    st.download_button(
+        "Download .txt",
+        data=(f"Subject: {subject}\n\n{body}").encode("utf-8"),
+        file_name="generated_email.txt",
+        mime="text/plain"
+    )
+    with st.expander("Debug (prompt & raw response)"):
+        st.code(prompt, language="markdown")
+        st.code(json.dumps(data, ensure_ascii=False, indent=2), language="json")
+        if result.get("trace"):
+            # Waterfall từng stage: phân biệt chậm do mạng (call_gemini) hay do xử lý cục bộ
+            st.caption("Timing (waterfall)")
+            st.code(format_waterfall(result["trace"]), language="text")
+        stage_metrics = get_metrics()
+        col_prom, col_jsonl = st.columns(2)
+        col_prom.download_button("metrics.prom", data=stage_metrics.prometheus_text(),
+                                 file_name="emailgen_metrics.prom", mime="text/plain")
+        col_jsonl.download_button("metrics.jsonl", data=stage_metrics.export_jsonl(),
+                                  file_name="emailgen_metrics.jsonl", mime="application/x-ndjson")
+        rerun = stage_metrics.summary().get("app_rerun")
+        if rerun:
+            st.caption(f"Rerun (không gọi model): p50 {rerun['p50_ms']:.0f} ms · p95 {rerun['p95_ms']:.0f} ms"
+                       f" · {rerun['count']} lần")
+        cache = get_response_cache()
+        if cache is not None:
+            st.caption("Response cache")
+            st.json(cache.stats())
+        st.caption("Scheduler")
+        st.json(get_scheduler().stats())
+        st.caption("Token usage (process)")
+        st.json(get_token_ledger().summary())
+        st.caption("JSON decode / regenerate")
+        st.json(stage_metrics.events())
+        if get_hedge_policy() is not None:
+            st.caption("Hedging")
+            st.json(get_hedge_policy().stats())
+        if get_router() is not None:
+            st.caption("Model routing")
+            st.json(get_router().stats())
+        if st.session_state.prefetch_mode:
+            st.caption("Prefetch")
+            st.json(st.session_state.prefetcher.stats())
+
+
+render_result()
+
+
+
+# ---- Lịch sử: tìm lại email đã tạo (SQLite FTS, không gọi API) ----
+history = get_history()
+if history is not None:
+    with st.expander("🕘 Lịch sử (tìm lại email đã tạo)"):
+        history_query = st.text_input("Tìm theo details / subject / body (gõ không dấu cũng được)",
+                                      key="history_query")
+        facets = history.facets()
+        filter_labels = {"purpose": "Purpose", "lang": "Language", "audience": "Audience"}
+        filter_cols = st.columns(3)
+        history_filters = {
+            field: col.selectbox(filter_labels[field], ["Tất cả"] + facets[field], key=f"history_{field}")
+            for col, field in zip(filter_cols, filter_labels)
+        }
+        lookup_started = time.perf_counter()
+        entries = history.search(history_query,
+                                 **{k: v for k, v in history_filters.items() if v != "Tất cả"})
+        st.caption(f"{len(entries)} kết quả · {(time.perf_counter() - lookup_started) * 1000:.1f} ms")
+        if entries:
+            by_id = {e["id"]: e for e in entries}
+            picked_id = st.radio(
+                "Email đã tạo", list(by_id), key="history_pick",
+                format_func=lambda i: f"{time.strftime('%d/%m %H:%M', time.localtime(by_id[i]['created_at']))}"
+                                      f" · {by_id[i]['subject']}",
+            )
+            entry = history.get(picked_id)
+            if history_query.strip():
+                st.markdown(f"…{by_id[picked_id]['snippet']}…")
+            st.markdown(f"**Subject:** {entry['subject']}")
+            st.text_area("Body", value=entry["body"], height=220, key=f"history_body_{picked_id}")
+            col_dl, col_reuse = st.columns(2)
+            col_dl.download_button(
+                "Download .txt", data=(f"Subject: {entry['subject']}\n\n{entry['body']}").encode("utf-8"),
+                file_name="generated_email.txt", mime="text/plain", key=f"history_download_{picked_id}",
+            )
+            col_reuse.button("↩️ Dùng lại input", on_click=_reuse_history_inputs, args=(picked_id,),
+                             key="history_reuse")
+            st.caption(f"{entry['purpose']} · {entry['tone']} · {entry['lang']} · {entry['audience']}"
+                       + (f" · {entry['total_ms']:.0f} ms" if entry["total_ms"] else ""))
+
 
 st.caption("Built with Streamlit + Gemini · Demo for internal email/proposal generation.")
+
+# Rerun do tương tác (không gọi model); lượt Generate có timing riêng trong trace của request
+if not gen_btn:
+    get_metrics().observe("app_rerun", time.perf_counter() - _RERUN_STARTED)
@@ -0,0 +1,232 @@
+"""
+Chế độ batch (headless): đọc CSV/JSONL các dòng cấu hình email, gọi Gemini song song
+qua worker pool giới hạn và ghi kết quả ra file ngay khi từng email hoàn tất.
+
+Ví dụ:
+    python batch.py rows.csv -o out.jsonl --workers 8 --rpm 10 --daily-quota 250
+    python batch.py campaign.csv -o out.csv --skeleton   # chiến dịch: 1 lời gọi / cấu hình
+"""
+import os, csv, json, time, argparse, threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date
+
+from email_core import build_vars_map, generate_email
+from skeletons import generate_email_from_skeleton
+
+# Các cột biến có thể khai báo phẳng trong CSV thay cho cột "variables" (JSON)
+VAR_COLUMNS = ("order_id", "delivery_date", "hotline", "meeting_link")
+OUTPUT_FIELDS = ["id", "status", "subject", "body", "error", "elapsed_s"]
+
+
+class QuotaExceeded(Exception):
+    """Đã dùng hết quota trong ngày"""
+
+
+class RateLimiter:
+    """
+    Token bucket theo requests/phút + bộ đếm quota theo ngày (thread-safe)
+    acquire() chặn đến khi có token; raise QuotaExceeded khi hết quota ngày
+    """
+
+    def __init__(self, rpm: float = 10, daily_quota: int | None = 250, burst: int | None = None):
+        self.rate = rpm / 60.0
+        self.capacity = float(burst or max(1, int(rpm)))
+        self.tokens = self.capacity
+        self.daily_quota = daily_quota
+        self.used_today = 0
+        self._day = date.today()
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        today = date.today()
+        if today != self._day:
+            self._day, self.used_today = today, 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.daily_quota is not None and self.used_today >= self.daily_quota:
+                    raise QuotaExceeded(f"Daily quota of {self.daily_quota} requests reached")
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+
+def _truthy(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in {"1", "true", "yes", "y", "x"}
+
+
+def read_rows(path: str):
+    """Đọc từng dòng input (generator) từ .csv hoặc .jsonl"""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def row_to_kwargs(row: dict, defaults: dict) -> dict:
+    """Chuyển 1 dòng input thành tham số cho generate_email()"""
+    variables = row.get("variables") or {}
+    if isinstance(variables, str):
+        variables = json.loads(variables) if variables.strip() else {}
+    for col in VAR_COLUMNS:
+        if row.get(col):
+            variables.setdefault(col, row[col])
+
+    def pick(key):
+        value = row.get(key)
+        return value if value not in (None, "") else defaults.get(key)
+
+    require_cta = pick("require_cta")
+    return {
+        "purpose": pick("purpose") or "Generic business email / Chung",
+        "tone": pick("tone") or "Formal",
+        "lang": pick("lang") or "Vietnamese",
+        "recipient": pick("recipient") or "",
+        "details": pick("details") or "",
+        "signature": pick("signature") or "",
+        "audience": pick("audience") or "B2B",
+        "length": pick("length") or "Trung bình",
+        "require_cta": _truthy(require_cta),
+        "variables": build_vars_map(cta_template=pick("cta_template"),
+                                    **{k: variables.get(k, "") for k in VAR_COLUMNS}),
+    }
+
+
+class ResultWriter:
+    """Ghi kết quả tăng dần (JSONL hoặc CSV) và flush sau mỗi dòng"""
+
+    def __init__(self, path: str, fields: list[str] | None = None):
+        self.path = path
+        self.is_csv = path.lower().endswith(".csv")
+        self._f = open(path, "w", encoding="utf-8", newline="")
+        self._csv = None
+        if self.is_csv:
+            self._csv = csv.DictWriter(self._f, fieldnames=fields or OUTPUT_FIELDS, extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write(self, record: dict):
+        if self._csv:
+            self._csv.writerow(record)
+        else:
+            self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def generate_row(row_id, kwargs: dict, limiter: RateLimiter, skeleton: bool = False) -> dict:
+    started = time.perf_counter()
+    try:
+        # limiter.acquire chạy trước MỖI request API (retry, escalation, repair...), không phải 1 lần mỗi dòng
+        if skeleton:
+            # Chỉ dòng đầu tiên của mỗi cấu hình gọi model (và tốn quota)
+            result = generate_email_from_skeleton(before_call=limiter.acquire, **kwargs)
+        else:
+            result = generate_email(before_call=limiter.acquire, **kwargs)
+        record = {"id": row_id, "status": "ok", "subject": result["subject"],
+                  "body": result["body"], "error": ""}
+    except QuotaExceeded as e:
+        record = {"id": row_id, "status": "skipped", "subject": "", "body": "", "error": str(e)}
+    except Exception as e:
+        record = {"id": row_id, "status": "error", "subject": "", "body": "",
+                  "error": f"{type(e).__name__}: {e}"}
+    record["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(rows, writer: ResultWriter, limiter: RateLimiter, workers: int = 4,
+              defaults: dict | None = None, on_result=None, skeleton: bool = False) -> dict:
+    """
+    Chạy song song các dòng qua ThreadPoolExecutor; số task đang chờ được giới hạn
+    để input lớn (vài nghìn dòng) không bị nạp hết vào bộ nhớ
+    skeleton=True: 1 lời gọi model cho mỗi cấu hình, cá nhân hóa từng dòng tại chỗ (skeletons.py)
+    """
+    defaults = defaults or {}
+    stats = {"ok": 0, "error": 0, "skipped": 0}
+    max_pending = workers * 2
+
+    def drain(pending):
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            record = fut.result()
+            stats[record["status"]] += 1
+            writer.write(record)
+            if on_result:
+                on_result(record, stats)
+        return pending
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for idx, row in enumerate(rows):
+            row_id = row.get("id") if row.get("id") not in (None, "") else idx
+            pending.add(pool.submit(generate_row, row_id, row_to_kwargs(row, defaults), limiter, skeleton))
+            if len(pending) >= max_pending:
+                pending = drain(pending)
+        while pending:
+            pending = drain(pending)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch email generation with Gemini")
+    parser.add_argument("input", help="Input .csv or .jsonl (purpose, tone, lang, audience, recipient, details, variables)")
+    parser.add_argument("-o", "--output", default="batch_output.jsonl", help="Output .jsonl or .csv")
+    parser.add_argument("--workers", type=int, default=4, help="Số request song song")
+    parser.add_argument("--rpm", type=float, default=10, help="Giới hạn requests/phút")
+    parser.add_argument("--daily-quota", type=int, default=250, help="Quota requests/ngày (0 = không giới hạn)")
+    parser.add_argument("--signature", default="Best regards,\nPhuoc Doan", help="Signature mặc định")
+    parser.add_argument("--skeleton", action="store_true",
+                        help="1 lời gọi model cho mỗi cấu hình (purpose/tone/lang/length/details), "
+                             "cá nhân hóa người nhận + biến tại chỗ")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    import gemini_client
+
+    load_dotenv()
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("Missing GEMINI_API_KEY in environment/.env")
+    gemini_client.configure(api_key)
+
+    limiter = RateLimiter(rpm=args.rpm, daily_quota=args.daily_quota or None)
+
+    def progress(record, stats):
+        total = sum(stats.values())
+        print(f"[{total}] {record['id']}: {record['status']} ({record['elapsed_s']}s)", flush=True)
+
+    started = time.perf_counter()
+    with ResultWriter(args.output) as writer:
+        stats = run_batch(read_rows(args.input), writer, limiter, workers=args.workers,
+                          defaults={"signature": args.signature}, on_result=progress,
+                          skeleton=args.skeleton)
+    print(f"Done in {time.perf_counter() - started:.1f}s: {stats} → {args.output}")
+    from token_usage import get_token_ledger
+
+    print(f"Tokens: {get_token_ledger().summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark input xấu nhất cho các rule regex của hậu xử lý (ReDoS): mỗi rule (pattern của mọi language pack
++ rule không phụ thuộc ngôn ngữ) chạy trên bộ input bệnh lý và phải dưới trần latency; chuỗi
+postprocess_email + validate_email cũng phải dưới trần trên cùng bộ input (kể cả body vượt MAX_BODY_CHARS).
+
+Bộ input được sinh tất định: input cấu trúc ("[" không đóng, chuỗi xuống dòng / khoảng trắng dài...)
++ input lặp từ khóa lấy từ chính các pattern (pack mới được thử tự động, không cần sửa file này).
+
+    python benchmarks/bench_pathological.py                      # exit code 1 nếu có rule vượt trần
+    python benchmarks/bench_pathological.py --size 50000 --rule-ceiling-ms 120 --json out.json
+"""
+import os, sys, re, json, time, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rules import available_languages, get_rules, global_patterns  # noqa: E402
+from email_core import MAX_BODY_CHARS, postprocess_email, validate_email  # noqa: E402
+
+# Trần (ms) cho 1 rule chạy hết 1 input kích thước --size, và cho cả chuỗi hậu xử lý 1 email.
+# Rule tuyến tính ("A trong vòng 80 ký tự trước B") tốn vài chục ms ở 20k ký tự; rule bậc 2 tốn hàng giây
+RULE_CEILING_MS = 50
+PIPELINE_CEILING_MS = 150
+
+# Từ khóa trong pattern: chuỗi chữ (có thể gồm khoảng trắng, "/") giữa các ký tự regex (bỏ escape như \b, \s)
+_LITERAL = re.compile(r"[^\W\d_][^\W\d_/]*(?:[ /][^\W\d_]+)*")
+_ESCAPE = re.compile(r"\\.")
+PURPOSE = "Sales outreach / Chào hàng"
+
+
+def all_rules() -> list[tuple[str, object]]:
+    """[(nhãn, pattern)] — pattern có .sub(repl, text) (re.Pattern hoặc matcher tuyến tính của rules.py)"""
+    out = [(f"global.{label}", p) for label, p in global_patterns()]
+    for code in available_languages():
+        out += [(f"{code}.{label}", p) for label, p in get_rules(code).patterns()]
+    return out
+
+
+def _repeat(unit: str, size: int) -> str:
+    return (unit * (size // max(1, len(unit)) + 1))[:size]
+
+
+def build_corpus(rules: list[tuple[str, object]], size: int) -> dict[str, str]:
+    """Input bệnh lý kích thước size: {tên: text}"""
+    corpus = {
+        "open_brackets": _repeat("[", size),
+        "open_brackets_words": _repeat("[a ", size),
+        "newlines": _repeat("\n", size),
+        "newline_spaces": _repeat("\n ", size),
+        "spaces": _repeat(" ", size),
+        "one_line": _repeat("a", size),
+        "commas": _repeat(", ", size),
+        "dots": _repeat(". ", size),
+        "dots_newlines": _repeat(".\n", size),
+        "digits_percent": _repeat("9", size - 1) + "%",
+    }
+    keywords = sorted({m.group(0) for _, p in rules for m in _LITERAL.finditer(_ESCAPE.sub(" ", p.pattern)) if len(m.group(0)) > 1})
+    for kw in keywords:
+        # Từ khóa lặp trên 1 dòng không có dấu kết thúc; sau "["; sau mỗi xuống dòng; theo sau là khoảng trắng dài
+        corpus[f"kw:{kw}"] = _repeat(f"{kw} ", size)
+        corpus[f"kw[:{kw}"] = _repeat(f"[{kw} ", size)
+        corpus[f"kw\\n:{kw}"] = _repeat(f"{kw},\n", size)
+        corpus[f"kw_ws:{kw}"] = (f"{kw}, " + " " * size)[:size]
+    return corpus
+
+
+def timed(fn, repeats: int) -> float:
+    # min của nhiều lần đo: lọc nhiễu scheduler, thứ cần đo là độ phức tạp của rule
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def run(size: int, rule_ceiling_ms: float, pipeline_ceiling_ms: float, repeats: int = 2) -> dict:
+    rules = all_rules()
+    corpus = build_corpus(rules, size)
+    report = {"size": size, "inputs": len(corpus), "rule_ceiling_ms": rule_ceiling_ms,
+              "pipeline_ceiling_ms": pipeline_ceiling_ms, "rules": {}, "pipeline": {}, "failed": []}
+
+    print(f"{len(rules)} rules × {len(corpus)} inputs ({size} chars)")
+    for label, pattern in rules:
+        worst_ms, worst_input = 0.0, ""
+        for name, text in corpus.items():
+            ms = timed(lambda: pattern.sub("", text), repeats)
+            if ms > worst_ms:
+                worst_ms, worst_input = ms, name
+        report["rules"][label] = {"worst_ms": round(worst_ms, 2), "input": worst_input}
+        over = worst_ms > rule_ceiling_ms
+        if over:
+            report["failed"].append(label)
+        print(f"{label:<32} {worst_ms:8.2f} ms  {worst_input:<36} {'OVER CEILING' if over else 'ok'}")
+
+    # Cả chuỗi: body bệnh lý (và body gấp 5 lần giới hạn để thử guard) cho từng ngôn ngữ
+    oversized = {"oversized": _repeat("[link biểu mẫu Hy vọng trao đổi \n", MAX_BODY_CHARS * 5)}
+    for code in available_languages():
+        worst_ms, worst_input = 0.0, ""
+        for name, text in {**corpus, **oversized}.items():
+            def pipeline():
+                subject, body = postprocess_email({"subject": "Subject", "body": text}, PURPOSE, code,
+                                                  signature="Trân trọng,\nPhuoc Doan", require_cta=True)
+                validate_email(subject, body, PURPOSE, code, require_cta=True)
+
+            ms = timed(pipeline, repeats)
+            if ms > worst_ms:
+                worst_ms, worst_input = ms, name
+        report["pipeline"][code] = {"worst_ms": round(worst_ms, 2), "input": worst_input}
+        over = worst_ms > pipeline_ceiling_ms
+        if over:
+            report["failed"].append(f"pipeline.{code}")
+        print(f"{'pipeline.' + code:<32} {worst_ms:8.2f} ms  {worst_input:<36} {'OVER CEILING' if over else 'ok'}")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worst-case input benchmark for post-processing regex rules")
+    parser.add_argument("--size", type=int, default=MAX_BODY_CHARS or 20000,
+                        help="Độ dài mỗi input (mặc định = EMAILGEN_MAX_BODY_CHARS)")
+    parser.add_argument("--rule-ceiling-ms", type=float, default=RULE_CEILING_MS, help="Trần mỗi rule (ms)")
+    parser.add_argument("--pipeline-ceiling-ms", type=float, default=PIPELINE_CEILING_MS,
+                        help="Trần chuỗi hậu xử lý 1 email (ms)")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.size, args.rule_ceiling_ms, args.pipeline_ceiling_ms, args.repeats)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report["failed"]:
+        print(f"\n{len(report['failed'])} rule(s) over ceiling: {', '.join(report['failed'])}")
+        return 1
+    print("\nAll rules under ceiling")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
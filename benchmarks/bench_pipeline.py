@@ -0,0 +1,226 @@
+"""
+Benchmark offline cho chuỗi hậu xử lý email (không gọi network).
+
+Đo throughput/latency từng hàm (parse_email, decode_json_response, trim_pleasantries, remove_signature,
+dedupe_signature, enforce_rules_v2, tune_audience, soften_claims, add_signature)
+và cả chuỗi postprocess_email trên body tổng hợp + body ghi lại từ model (corpus/recorded.jsonl).
+
+    python benchmarks/bench_pipeline.py --save benchmarks/baselines/main.json
+    python benchmarks/bench_pipeline.py --compare benchmarks/baselines/main.json --threshold 0.15
+"""
+import os, sys, json, time, random, argparse, platform, statistics
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from email_core import (  # noqa: E402
+    parse_email, decode_json_response, trim_pleasantries, remove_signature, dedupe_signature, enforce_rules_v2,
+    tune_audience, soften_claims, add_signature, normalize_signature_text, postprocess_email,
+    validate_email, repair_locally,
+)
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus", "recorded.jsonl")
+SIZES = {"short": 80, "medium": 160, "long": 600, "xlong": 3000}
+
+_FRAGMENTS = {
+    "Vietnamese": {
+        "salutation": "Kính gửi anh Minh,",
+        "opener": "Hy vọng anh có một ngày tốt lành.",
+        "sentences": [
+            "Chúng tôi xin cập nhật tình hình triển khai hệ thống trong tuần này.",
+            "Đội ngũ kỹ thuật đã hoàn tất việc tích hợp dữ liệu với doanh nghiệp bạn.",
+            "Giải pháp tiên tiến của chúng tôi giúp giảm chi phí vận hành lên đến 20%.",
+            "Chúng tôi cam kết hỗ trợ quý công ty trong suốt quá trình chuyển đổi.",
+            "Vui lòng xem thêm chi tiết tại [Link tài liệu] trước buổi họp.",
+            "Hy vọng anh sẽ tiếp tục ủng hộ chúng tôi trong thời gian tới.",
+            "Mọi thắc mắc xin liên hệ hotline 1900 5555 để được hỗ trợ nhanh nhất.",
+        ],
+        "cta": "Anh có thể cho tôi biết thời gian phù hợp để trao đổi ngắn 15–20 phút không?",
+        "signature": "Trân trọng,\nPhuoc Doan",
+        "purpose": "Sales outreach / Chào hàng",
+    },
+    "English": {
+        "salutation": "Dear Sarah,",
+        "opener": "I hope this email finds you well.",
+        "sentences": [
+            "I wanted to share a quick update on the rollout this week.",
+            "Our engineers have finished integrating the data pipeline with your team.",
+            "Our cutting-edge solution can reduce operating costs by up to 20%.",
+            "We guarantee support for you throughout the migration.",
+            "Please review the details at [Link to deck] before our meeting.",
+            "I hope you will continue to work with us in the coming months.",
+            "Feel free to reach out to our hotline if anything comes up.",
+        ],
+        "cta": "Would you be open to a quick 15–20 min demo next week?",
+        "signature": "Best regards,\nPhuoc Doan",
+        "purpose": "Sales outreach / Chào hàng",
+    },
+}
+
+
+def synthetic_case(lang: str, words: int, seed: int = 0) -> dict:
+    """Body tổng hợp ~words từ, có pleasantries, placeholder, claim và signature lặp"""
+    f = _FRAGMENTS[lang]
+    rng = random.Random(f"{lang}-{words}-{seed}")
+    paragraphs, count = [], 0
+    while count < words:
+        para = " ".join(rng.choice(f["sentences"]) for _ in range(3))
+        paragraphs.append(para)
+        count += len(para.split())
+    body = "\n\n".join([f["salutation"], f["opener"], *paragraphs, f["cta"], f["signature"], f["signature"]])
+    return {
+        "lang": lang, "purpose": f["purpose"], "audience": "B2B", "signature": f["signature"],
+        "require_cta": True, "data": {"subject": "Quick update on the rollout", "body": body},
+    }
+
+
+def load_cases() -> dict:
+    cases = {}
+    for lang in _FRAGMENTS:
+        code = "vi" if lang == "Vietnamese" else "en"
+        for size, words in SIZES.items():
+            cases[f"{code}/{size}"] = synthetic_case(lang, words)
+    if os.path.exists(CORPUS_PATH):
+        with open(CORPUS_PATH, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    cases[f"recorded/{rec.pop('name')}"] = rec
+    return cases
+
+
+def stage_calls(case: dict) -> dict:
+    """Trả về {tên stage: callable không tham số} cho 1 case"""
+    lang, purpose, audience = case["lang"], case["purpose"], case["audience"]
+    data = case["data"]
+    body, subject = data["body"], data["subject"]
+    sig = normalize_signature_text(case["signature"], lang)
+    raw_text = f"Subject: {subject}\nBody:\n{body}"
+    json_text = json.dumps(data, ensure_ascii=False)
+    fenced_text = f"Here is the email:\n```json\n{json_text}\n```"
+    variables = {"meeting_link": "https://calendly.com/demo", "_cta_template": "Đặt lịch demo"}
+    check = dict(purpose=purpose, lang=lang, words=case.get("words", 120), require_cta=case["require_cta"],
+                 required={"meeting_link": variables["meeting_link"]})
+    violations = validate_email(subject, body, **check)
+    return {
+        "parse_email": lambda: parse_email(raw_text),
+        "decode_json": lambda: decode_json_response(json_text),
+        "decode_json_fenced": lambda: decode_json_response(fenced_text),
+        "trim_pleasantries": lambda: trim_pleasantries(body, lang, purpose),
+        "remove_signature": lambda: remove_signature(body, sig),
+        "dedupe_signature": lambda: dedupe_signature(body, sig),
+        "enforce_rules_v2": lambda: enforce_rules_v2(subject, body, require_cta=case["require_cta"],
+                                                     purpose=purpose, lang=lang, audience=audience,
+                                                     variables=variables),
+        "tune_audience": lambda: tune_audience(body, audience, lang),
+        "soften_claims": lambda: soften_claims(body, lang),
+        "add_signature": lambda: add_signature(body, sig),
+        "validate_email": lambda: validate_email(subject, body, **check),
+        "repair_local": lambda: repair_locally(subject, body, violations, purpose, lang, subject_raw=subject,
+                                               require_cta=case["require_cta"], variables=variables,
+                                               required=check["required"]),
+        "full_chain": lambda: postprocess_email(data, purpose, lang, audience=audience,
+                                                signature=case["signature"],
+                                                require_cta=case["require_cta"], variables=variables),
+    }
+
+
+def measure(fn, min_time: float = 0.05, repeats: int = 5) -> dict:
+    """Tự chọn số vòng lặp để mỗi lần đo ≥ min_time, lấy median trên các lần lặp"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 5 or number >= 1_000_000:
+            break
+        number *= 4
+    number = max(1, int(number * (min_time / max(elapsed, 1e-9))))
+
+    per_call = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - start) / number)
+    median = statistics.median(per_call)
+    return {
+        "median_us": round(median * 1e6, 3),
+        "min_us": round(min(per_call) * 1e6, 3),
+        "ops_per_s": round(1 / median, 1) if median else None,
+        "loops": number,
+    }
+
+
+def run(filter_: str | None = None, min_time: float = 0.05, repeats: int = 5) -> dict:
+    results = {}
+    for case_name, case in load_cases().items():
+        chars = len(case["data"]["body"])
+        for stage, fn in stage_calls(case).items():
+            key = f"{stage}/{case_name}"
+            if filter_ and filter_ not in key:
+                continue
+            results[key] = {**measure(fn, min_time=min_time, repeats=repeats), "chars": chars}
+            print(f"{key:<50} {results[key]['median_us']:>12.1f} µs  {results[key]['ops_per_s']:>12.0f} ops/s",
+                  flush=True)
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "min_time": min_time,
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[tuple[str, float]]:
+    """Trả về danh sách (key, % chậm hơn) vượt ngưỡng threshold"""
+    regressions = []
+    print(f"\n{'benchmark':<50} {'baseline µs':>12} {'current µs':>12} {'change':>8}")
+    for key, cur in sorted(current["results"].items()):
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        change = cur["median_us"] / base["median_us"] - 1 if base["median_us"] else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{key:<50} {base['median_us']:>12.1f} {cur['median_us']:>12.1f} {change:>+7.1%}{flag}")
+        if change > threshold:
+            regressions.append((key, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the email post-processing pipeline")
+    parser.add_argument("--save", help="Ghi kết quả ra file JSON baseline")
+    parser.add_argument("--compare", help="So sánh với file JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Ngưỡng regression (0.15 = chậm hơn 15%%)")
+    parser.add_argument("--filter", help="Chỉ chạy benchmark có key chứa chuỗi này")
+    parser.add_argument("--min-time", type=float, default=0.05, help="Thời gian tối thiểu mỗi lần đo (giây)")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    current = run(args.filter, min_time=args.min_time, repeats=args.repeats)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"\nSaved baseline → {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}")
+            return 1
+        print(f"\nNo regressions above {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Cache 2 tầng cho response của Gemini:
+- Tầng 1: LRU trong bộ nhớ (giới hạn số entry)
+- Tầng 2: SQLite trên đĩa (sống qua các lần restart)
+
+Key = hash(model, prompt đã chuẩn hóa, temperature, top_p).
+Cùng key đó dùng cho single-flight: các request giống hệt nhau đang chạy đồng thời
+(cache chưa kịp có) chờ chung 1 lời gọi upstream thay vì mỗi request 1 lời gọi.
+Cấu hình qua biến môi trường:
+    EMAILGEN_CACHE            = "0" để tắt cache
+    EMAILGEN_CACHE_PATH       = đường dẫn file SQLite (mặc định .cache/gemini_responses.sqlite3)
+    EMAILGEN_CACHE_TTL        = thời gian sống (giây), 0 = không hết hạn (mặc định 7 ngày)
+    EMAILGEN_CACHE_MEM_SIZE   = số entry tối đa trong bộ nhớ (mặc định 256)
+    EMAILGEN_CACHE_DISK_SIZE  = số entry tối đa trên đĩa (mặc định 10000)
+"""
+import os, re, json, time, hashlib, threading
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Gộp khoảng trắng để 2 prompt chỉ khác whitespace dùng chung 1 key"""
+    return re.sub(r"\s+", " ", (prompt or "").strip())
+
+
+def make_cache_key(model_name: str, prompt: str, temperature: float, top_p: float | None) -> str:
+    payload = json.dumps(
+        [model_name, normalize_prompt(prompt), round(float(temperature), 3),
+         None if top_p is None else round(float(top_p), 3)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str | None = None, ttl: float | None = 7 * 24 * 3600,
+                 memory_size: int = 256, disk_size: int = 10000):
+        self.path = path
+        self.ttl = ttl or None
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._mem: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if path:
+            import sqlite3
+
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _remember(self, key: str, created_at: float, value: str):
+        self._mem[key] = (created_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_size:
+            self._mem.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._mem.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return json.loads(entry[1])
+                del self._mem[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._remember(key, created_at, value)
+                        self.counters["disk_hits"] += 1
+                        return json.loads(value)
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.counters["misses"] += 1
+            return None
+
+    def set(self, key: str, data: dict):
+        now = time.time()
+        value = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, now, value)
+            self.counters["stores"] += 1
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl is not None:
+                self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            # Xóa các entry ít dùng nhất khi vượt giới hạn
+            cur = self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.disk_size,),
+            )
+            self.counters["evictions"] += max(cur.rowcount, 0)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                **self.counters,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._mem),
+                "disk_entries": disk_entries,
+            }
+
+
+_default_cache: ResponseCache | None = None
+_default_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Cache dùng chung trong process (tạo 1 lần, cấu hình từ biến môi trường)"""
+    global _default_cache
+    if os.getenv("EMAILGEN_CACHE", "1") == "0":
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                path=os.getenv("EMAILGEN_CACHE_PATH", os.path.join(".cache", "gemini_responses.sqlite3")) or None,
+                ttl=float(os.getenv("EMAILGEN_CACHE_TTL", 7 * 24 * 3600)),
+                memory_size=int(os.getenv("EMAILGEN_CACHE_MEM_SIZE", 256)),
+                disk_size=int(os.getenv("EMAILGEN_CACHE_DISK_SIZE", 10000)),
+            )
+        return _default_cache
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi cùng key đang chạy đồng thời: thread đầu tiên gọi fn(), các thread sau
+    chờ và nhận chung kết quả (hoặc chung exception). Kết quả dùng chung → caller không sửa tại chỗ.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: dict[str, _Flight] = {}
+        self.counters = {"calls": 0, "shared": 0}
+
+    def do(self, key: str, fn) -> tuple[object, bool]:
+        """Trả về (kết quả, shared) - shared=True khi dùng lại lời gọi của thread khác"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.counters["calls"] += 1
+            else:
+                self.counters["shared"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "in_flight": len(self._flights)}
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
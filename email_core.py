@@ -0,0 +1,1046 @@
+"""
+Lõi sinh email: dựng prompt, gọi Gemini và chuỗi hậu xử lý (post-processing).
+Dùng chung cho Streamlit UI (app.py) và chế độ batch (batch.py).
+"""
+import os, re, json
+from functools import lru_cache
+
+from cache import get_response_cache, get_single_flight, make_cache_key
+from scheduler import call_charger, scheduled
+from token_usage import token_tags
+from metrics import get_metrics, stage, start_trace
+from routing import WORDS_TOLERANCE, check_candidates, get_router
+from gemini_client import before_each_call, generate_text, stream_text
+from streaming import PartialEmailParser
+from rules import is_vi, get_rules, clean_placeholders
+from signatures import (
+    normalize_signature_text, get_signature_canonical, signature_matcher_for,
+    dedupe_signature, has_signature, remove_signature, add_signature,
+)
+
+
+MODEL_NAME = "gemini-2.5-flash"
+GENCFG = {"temperature": 0.6, "top_p": 0.9}
+
+# Structured output: model trả JSON đúng schema (response_mime_type/response_schema)
+# thay vì chỉ dặn trong prompt; tắt bằng EMAILGEN_STRUCTURED_OUTPUT=0 nếu endpoint không hỗ trợ
+STRUCTURED_OUTPUT = os.getenv("EMAILGEN_STRUCTURED_OUTPUT", "1") != "0"
+EMAIL_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"subject": {"type": "STRING"}, "body": {"type": "STRING"}},
+    "required": ["subject", "body"],
+}
+VARIANTS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"variants": {"type": "ARRAY", "items": EMAIL_SCHEMA}},
+    "required": ["variants"],
+}
+
+# Số từ mục tiêu theo độ dài email
+WORDS_BY_LENGTH = {"Ngắn": 80, "Trung bình": 120, "Chi tiết": 160}
+
+# Điều chỉnh temperature theo tone
+TONE_TEMPERATURE = {"Formal": 0.4, "Friendly": 0.7, "Apologetic": 0.5, "Neutral": 0.6}
+
+
+def localize_signature(signature: str, lang: str) -> str:
+    sig = (signature or "").strip()
+    if not sig:
+        return sig
+    if is_vi(lang) and sig.lower().startswith("best regards"):
+        return sig.replace("Best regards", "Trân trọng")
+    if not is_vi(lang) and sig.startswith("Trân trọng"):
+        return sig.replace("Trân trọng", "Best regards")
+    return sig
+
+
+
+
+def call_gemini(prompt: str, temperature: float = 0.6) -> str:
+    return generate_text(prompt, MODEL_NAME, {"temperature": temperature})
+
+# Biến được đưa vào prompt (nhãn hiển thị cho model)
+PROMPT_VARIABLE_LABELS = (
+    ("order_id", "Order ID"),
+    ("delivery_date", "Delivery date"),
+    ("hotline", "Hotline"),
+    ("meeting_link", "Meeting/Form link"),
+)
+
+
+def _prompt_variables(variables: dict | None) -> list[tuple[str, str]]:
+    return [(label, variables[key]) for key, label in PROMPT_VARIABLE_LABELS if (variables or {}).get(key)]
+
+
+def build_json_prompt_v2(purpose, tone, recipient, details, lang, 
+                         words=120, require_cta=True, salutation_line="", variables=None,
+                         n_variants=1):
+    """
+    Version mới: KHÔNG yêu cầu model thêm signature
+    Signature sẽ được xử lý bởi code sau khi model trả về
+    n_variants > 1: yêu cầu nhiều phương án trong 1 response (JSON array)
+    """
+    cta_rule = "Include a clear call-to-action at the end." if require_cta else "Do not include a call-to-action."
+    
+    var_info = ""
+    var_items = [f"- {label}: {value}" for label, value in _prompt_variables(variables)]
+    if var_items:
+        var_info = "\nAvailable variables:\n" + "\n".join(var_items)
+
+    if n_variants > 1:
+        output_spec = f"""Write {n_variants} distinct variants (different subject and wording, same facts).
+Return EXACTLY this JSON shape with {n_variants} items:
+{{"variants": [{{"subject": "<one line>", "body": "<multi-line email body WITHOUT signature>"}}, ...]}}"""
+    else:
+        output_spec = """Return EXACTLY this JSON shape:
+{"subject": "<one line>", "body": "<multi-line email body WITHOUT signature>"}"""
+    
+    return f"""
+You are an assistant that writes concise, professional business emails.
+Return STRICT JSON only. No markdown, no explanations, no code fences.
+
+Constraints (non-negotiable):
+- Language: {lang}
+- Tone: {tone}
+- Subject line ≤ 60 characters
+- Body around {words} words
+- Use the provided recipient if available; otherwise keep it natural
+- {cta_rule}
+- Start the body with this exact salutation line (if non-empty): "{salutation_line}"
+- Do NOT add any closing signature (like "Best regards" or "Trân trọng"). The body should end with the main content or CTA.
+- Do NOT use placeholders like [Link...] or [form...]. Use actual values from variables if available.
+
+Context:
+- Purpose: {purpose}
+- Recipient: {recipient or "N/A"}
+- Details: {details or "N/A"}{var_info}
+
+{output_spec}
+""".strip()
+
+
+def build_json_prompt_compact(purpose, tone, recipient, details, lang,
+                              words=120, require_cta=True, salutation_line="", variables=None,
+                              n_variants=1):
+    """
+    Cùng ràng buộc với build_json_prompt_v2 nhưng viết gọn (khoảng một nửa số input token)
+    Chọn bằng EMAILGEN_PROMPT_VARIANT=compact; kiểm tra độ tương đương: tools/prompt_fidelity.py
+    """
+    rules = [
+        f"Language: {lang}; tone: {tone}; subject ≤60 chars; body ~{words} words",
+        "end with a clear call-to-action" if require_cta else "no call-to-action",
+        "no closing/signature (e.g. Best regards, Trân trọng)",
+        "no [placeholders]" + ("; use the values below" if _prompt_variables(variables) else ""),
+    ]
+    if salutation_line:
+        rules.append(f'body starts with "{salutation_line}"')
+    context = [f"Purpose: {purpose}", f"Recipient: {recipient or 'N/A'}", f"Details: {details or 'N/A'}"]
+    if variables:
+        context += [f"{label}: {value}" for label, value in _prompt_variables(variables)]
+
+    if n_variants > 1:
+        shape = (f'Write {n_variants} distinct variants (different subject and wording, same facts) as '
+                 '{"variants":[{"subject":"...","body":"..."}, ...]}')
+    else:
+        shape = '{"subject":"...","body":"..."}'
+    return (
+        "Write a business email. Reply with strict JSON only (no markdown): " + shape + "\n"
+        + "Rules: " + "; ".join(rules) + ".\n"
+        + "\n".join(context)
+    )
+
+
+# Biến thể prompt (EMAILGEN_PROMPT_VARIANT); "full" là mặc định
+PROMPT_BUILDERS = {"full": build_json_prompt_v2, "compact": build_json_prompt_compact}
+PROMPT_VARIANT = os.getenv("EMAILGEN_PROMPT_VARIANT", "full")
+
+
+
+def build_prompt(purpose, tone, recipient, details, lang, signature, words=120, require_cta=True):
+    cta_rule = "Include a clear call-to-action at the end." if require_cta else "Do not include a call-to-action."
+    return f"""
+System instructions (non-negotiable):
+- Output in {lang}.
+- Professional, polite, concise tone: {tone}.
+- Subject line ≤ 60 characters.
+- Body around {words} words.
+- Use the provided recipient if available; otherwise keep it generic but natural.
+- {cta_rule}
+- Strictly follow the output schema below.
+
+Context:
+- Purpose: {purpose}
+- Recipient: {recipient or "N/A"}
+- Details: {details or "N/A"}
+- Signature (must end the body): {signature}
+
+Output schema (do not add extra text):
+Subject: <one line>
+Body:
+<multiple lines, ready to paste into an email client>
+""".strip()
+
+
+def parse_email(text: str):
+    # Cố gắng tách Subject và Body nếu model trả đúng format
+    subj_match = re.search(r"^Subject:\s*(.+)", text, flags=re.IGNORECASE|re.MULTILINE)
+    body_match = re.search(r"^Body:\s*(.*)$", text, flags=re.IGNORECASE|re.DOTALL|re.MULTILINE)
+    subject = subj_match.group(1).strip() if subj_match else "Generated Email"
+    body = body_match.group(1).strip() if body_match else text
+    return subject, body
+
+# strict=False: chấp nhận xuống dòng thật (control char) bên trong string JSON
+_JSON_DECODER = json.JSONDecoder(strict=False)
+# Số lần thử lại từ dấu "{" kế tiếp khi câu dẫn phía trước cũng chứa "{"
+_MAX_DECODE_STARTS = 4
+
+
+def parse_model_json(text: str) -> tuple[object, str]:
+    """
+    Giải mã JSON trong text của model trong 1 lượt quét (raw_decode từ dấu "{" đầu tiên)
+    - Code fence ```json ... ``` và câu dẫn / giải thích trước-sau JSON được bỏ qua
+    - JSON bị encode 2 lần ("{\"subject\": ...}") được giải mã thêm 1 lần
+    Trả về (obj, outcome): outcome "json" = text là JSON sạch, "recovered" = phải bỏ phần thừa,
+    (None, "fallback") = không tìm được JSON
+    """
+    text = (text or "").strip()
+    start = 0 if text[:1] in ("{", "[", '"') else text.find("{")
+    for _ in range(_MAX_DECODE_STARTS):
+        if start == -1:
+            break
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            obj = None
+        if isinstance(obj, str) and obj.lstrip().startswith("{"):
+            inner, _ = parse_model_json(obj)
+            return inner, "fallback" if inner is None else "recovered"
+        if isinstance(obj, (dict, list)):
+            clean = start == 0 and end == len(text)
+            return obj, "json" if clean else "recovered"
+        start = text.find("{", start + 1)
+    return None, "fallback"
+
+
+def _unescape_newlines(value):
+    # Model đôi khi escape 2 lần → body chứa chuỗi "\n" thay vì xuống dòng thật
+    if isinstance(value, str) and "\\n" in value and "\n" not in value:
+        return value.replace("\\r\\n", "\n").replace("\\n", "\n").replace("\\t", "\t")
+    return value
+
+
+def _normalize_email_fields(item):
+    if isinstance(item, dict):
+        for field in ("subject", "body"):
+            if field in item:
+                item[field] = _unescape_newlines(item[field])
+    return item
+
+
+def decode_json_response(text: str) -> tuple[dict, bool]:
+    """
+    Parse JSON từ text của model
+    Trả về (data, ok) - ok=False khi phải dùng fallback tối thiểu
+    Kết quả được đếm vào metrics: event "json_decode", outcome json / recovered / labeled / fallback
+    """
+    obj, outcome = parse_model_json(text)
+    if isinstance(obj, list):
+        # Mảng phương án không bọc trong {"variants": ...}
+        obj = {"variants": obj}
+    if isinstance(obj, dict):
+        for item in obj.get("variants") or []:
+            _normalize_email_fields(item)
+        data = _normalize_email_fields(obj)
+    else:
+        # Model trả dạng "Subject: ...\nBody: ..." (bỏ qua JSON) vẫn dùng được
+        subject, body = parse_email(text or "")
+        if subject != "Generated Email":
+            data, outcome = {"subject": subject, "body": body}, "labeled"
+        else:
+            # Fallback cuối cùng: trả cấu trúc tối thiểu
+            data, outcome = {"subject": "Generated Email", "body": text or "No content"}, "fallback"
+    get_metrics().count("json_decode", outcome)
+    return data, outcome != "fallback"
+
+
+def json_generation_config(temperature: float, schema: dict | None = EMAIL_SCHEMA) -> dict:
+    cfg = dict(GENCFG)
+    cfg["temperature"] = temperature
+    if STRUCTURED_OUTPUT:
+        cfg["response_mime_type"] = "application/json"
+        if schema is not None:
+            cfg["response_schema"] = schema
+    return cfg
+
+
+def call_gemini_json(prompt: str, temperature: float = 0.6, use_cache: bool = True,
+                     schema: dict | None = EMAIL_SCHEMA, model_name: str | None = None) -> dict:
+    cfg = json_generation_config(temperature, schema)
+    model_name = model_name or MODEL_NAME
+
+    # Cache theo (model, prompt, temperature, top_p) - prompt lặp lại không tốn quota
+    key = make_cache_key(model_name, prompt, cfg["temperature"], cfg.get("top_p"))
+    cache = get_response_cache() if use_cache else None
+    if cache is not None:
+        with stage("cache_lookup") as span:
+            cached = cache.get(key)
+            span.cache_hit = cached is not None
+        if cached is not None:
+            return cached
+
+    def fetch():
+        # Cache miss mới tốn quota → chỉ phần này xếp hàng qua scheduler (nếu caller đã gắn user)
+        # Retry dưới cùng slot cũng là request API → tính thêm vào budget (call_charger)
+        with scheduled() as ticket, stage("call_gemini", size_in=len(prompt)) as span:
+            text = generate_text(prompt, model_name, cfg, before_call=call_charger(ticket))
+            span.size_out = len(text)
+        # Latency theo từng model (so sánh các tier của routing.py)
+        get_metrics().observe(f"call_gemini:{model_name}", span.duration)
+
+        with stage("decode_json", size_in=len(text)):
+            data, ok = decode_json_response(text)
+        # Không cache kết quả fallback để lần generate sau còn cơ hội lấy JSON hợp lệ
+        if cache is not None and ok:
+            cache.set(key, data)
+        return data
+
+    if not use_cache:
+        return fetch()
+    # Request giống hệt đang chạy ở thread khác → chờ chung 1 lời gọi upstream
+    data, shared = get_single_flight().do(key, fetch)
+    if shared:
+        get_metrics().count("call_gemini", "coalesced")
+    return data
+
+def stream_gemini_json(prompt: str, temperature: float = 0.6, use_cache: bool = True,
+                       schema: dict | None = EMAIL_SCHEMA, model_name: str | None = None):
+    """
+    Phiên bản streaming của call_gemini_json
+    Generator: yield ("partial", {"subject", "body"}) trong lúc nhận, cuối cùng yield ("data", data)
+    """
+    cfg = json_generation_config(temperature, schema)
+    model_name = model_name or MODEL_NAME
+
+    cache = get_response_cache() if use_cache else None
+    if cache is not None:
+        with stage("cache_lookup") as span:
+            key = make_cache_key(model_name, prompt, cfg["temperature"], cfg.get("top_p"))
+            cached = cache.get(key)
+            span.cache_hit = cached is not None
+        if cached is not None:
+            yield "data", cached
+            return
+
+    parser = PartialEmailParser()
+    parts = []
+    # Span gồm cả thời gian caller render từng partial (generator tạm dừng ở yield)
+    with scheduled() as ticket, stage("stream_gemini", size_in=len(prompt)) as span:
+        for chunk in stream_text(prompt, model_name, cfg, before_call=call_charger(ticket)):
+            parts.append(chunk)
+            fields = parser.feed(chunk)
+            yield "partial", {"subject": fields.get("subject", ""), "body": fields.get("body", "")}
+        span.size_out = sum(len(p) for p in parts)
+    get_metrics().observe(f"call_gemini:{model_name}", span.duration)
+
+    # Stream đã đóng: parse lại toàn bộ text như call_gemini_json
+    with stage("decode_json", size_in=span.size_out):
+        data, ok = decode_json_response("".join(parts).strip())
+    if cache is not None and ok:
+        cache.set(key, data)
+    yield "data", data
+
+def call_gemini_routed(prompt: str, temperature: float, purpose: str, lang: str, length: str = "Trung bình",
+                       schema: dict | None = EMAIL_SCHEMA, start_tier: str | None = None,
+                       escalations: int = 0) -> tuple[dict, str]:
+    """
+    call_gemini_json qua router (routing.py): tier chọn theo length/purpose/lang; output thô không qua
+    kiểm tra cục bộ → gọi lại ở tier cao hơn (tổng cộng tối đa router.max_escalations lần)
+    Trả về (data, model_name); router tắt → luôn MODEL_NAME
+    """
+    router = get_router()
+    if router is None:
+        return call_gemini_json(prompt, temperature=temperature, schema=schema), MODEL_NAME
+    words = WORDS_BY_LENGTH.get(length, 120)
+    tier = start_tier or router.pick(purpose, lang, length)
+    while True:
+        model_name = router.model(tier)
+        # Mỗi tier là 1 request API riêng: call_gemini_json xếp hàng + tính budget lại từ đầu
+        with token_tags(model_tier=tier):
+            data = call_gemini_json(prompt, temperature=temperature, schema=schema, model_name=model_name)
+        issues = check_candidates(extract_candidates(data), words)
+        next_tier = router.next_tier(tier) if issues and escalations < router.max_escalations else None
+        router.record(tier, issues, escalated=next_tier is not None)
+        if next_tier is None:
+            return data, model_name
+        tier, escalations = next_tier, escalations + 1
+
+def has_cta_in_body(body: str, lang: str) -> bool:
+    """Kiểm tra xem body đã có CTA (bất kỳ loại) chưa"""
+    return get_rules(lang).has_cta(body)
+
+def enforce_rules_v2(subject: str,
+                     body: str,
+                     require_cta: bool = True,
+                     purpose: str = None,
+                     lang: str = "Vietnamese",
+                     audience: str = "B2B",
+                     variables: dict | None = None):
+    """
+    Version mới: KHÔNG xử lý signature
+    Chỉ xử lý: subject length, CTA, placeholder cleanup
+    """
+    subject = (subject or "Generated Email").strip()
+    if len(subject) > 70:
+        subject = subject[:67].rstrip() + "..."
+
+    body = (body or "").strip()
+
+    # Gỡ CTA tiếng Anh khi đang viết tiếng Việt
+    body = get_rules(lang).strip_foreign_cta(body)
+
+    # Quy tắc CTA theo loại email
+    purpose = (purpose or "").strip()
+    purpose_vi = purpose.lower()
+
+    is_leave = "leave request" in purpose_vi or "xin nghỉ" in purpose_vi
+    
+    # Xử lý CTA
+    if require_cta and not is_leave:
+        if not has_cta_in_body(body, lang):
+            # Câu CTA mẫu theo template + audience lấy từ language pack
+            variables = variables or {}
+            cta = get_rules(lang).cta_line(variables.get("_cta_template"), audience,
+                                           link=variables.get("meeting_link") or "")
+            body += f"\n\n{cta}"
+
+    # Xóa placeholder
+    body = clean_placeholders(body)
+    
+    return subject, body.rstrip()
+
+
+def has_cta_invite(body: str, lang: str) -> bool:
+    return get_rules(lang).has_cta_invite(body)
+
+
+
+def soften_claims(text: str, lang: str) -> str:
+    return get_rules(lang).soften_claims(text)
+
+
+
+def suggest_subject(purpose: str, lang: str) -> str:
+    return get_rules(lang).suggest_subject(purpose)
+
+
+def trim_pleasantries(body: str, lang: str, purpose: str) -> str:
+    if not body or not purpose:
+        return body
+    return get_rules(lang).trim_pleasantries(body).strip()
+
+
+
+def build_salutation(recipient: str, lang: str) -> str:
+    # Cache theo object rules → pack được reload thì cache cũ tự không dùng nữa
+    return _build_salutation(recipient or "", get_rules(lang))
+
+
+@lru_cache(maxsize=256)
+def _build_salutation(recipient: str, rules) -> str:
+    if not recipient.strip():
+        return ""
+    # VI: không ép “quý công ty” ở đây để tránh cứng nhắc; salutation trung tính
+    return rules.salutation(recipient.strip())
+
+
+def tune_audience(body: str, audience: str, lang: str) -> str:
+    if not body:
+        return body
+    return get_rules(lang).tune_audience(body, audience)
+
+
+def interpolate_variables(text: str, variables: dict) -> str:
+    if not text:
+        return text
+    s = text
+    for k, v in variables.items():
+        s = s.replace("{{" + k + "}}", v or "")
+    return s
+
+def subject_variants(base: str, purpose: str, lang: str) -> list:
+    # Bản cache trả tuple (dùng chung giữa các lần gọi) → trả list mới để caller sửa được
+    return list(_subject_variants(base or "", purpose or "", get_rules(lang)))
+
+
+@lru_cache(maxsize=256)
+def _subject_variants(base: str, purpose: str, rules) -> tuple:
+    base = base.strip()
+    cand = list(rules.subject_variants(purpose))
+
+    if base and base.lower() not in {"subject", "generated email"}:
+        cand = [base] + cand
+
+    uniq = []
+    for x in cand:
+        x = x.strip()
+        if not x:
+            continue
+        if len(x) > 60:
+            x = x[:57].rstrip() + "..."
+        if x not in uniq:
+            uniq.append(x)
+    return tuple(uniq[:5])
+
+
+
+# ---- Pipeline (dùng chung cho UI và batch) ----
+
+def build_vars_map(order_id: str = "", delivery_date: str = "", hotline: str = "",
+                   meeting_link: str = "", cta_template: str | None = None) -> dict:
+    return {
+        "order_id": (order_id or "").strip(),
+        "delivery_date": (delivery_date or "").strip(),
+        "hotline": (hotline or "").strip(),
+        "meeting_link": (meeting_link or "").strip(),
+        "_cta_template": cta_template,
+    }
+
+
+def build_request_prompt(purpose, tone, recipient, details, lang,
+                         words=120, require_cta=False, variables=None, n_variants=1,
+                         prompt_variant=None) -> str:
+    """
+    Dựng prompt JSON cho 1 email: salutation + interpolate biến vào Details
+    (signature KHÔNG nằm trong prompt để tránh model tự thêm)
+    prompt_variant: "full" | "compact" (mặc định theo EMAILGEN_PROMPT_VARIANT)
+    """
+    variables = variables or {}
+    with stage("build_salutation"):
+        salutation_line = build_salutation(recipient, lang)
+    with stage("interpolate_variables", size_in=len(details or "")) as span:
+        details_filled = interpolate_variables(details, variables)
+        span.size_out = len(details_filled or "")
+    builder = PROMPT_BUILDERS.get(prompt_variant or PROMPT_VARIANT, build_json_prompt_v2)
+    with stage("build_prompt") as span:
+        prompt = builder(
+            purpose,
+            tone,
+            recipient,
+            details_filled,
+            lang,
+            words=words,
+            require_cta=require_cta,
+            salutation_line=salutation_line,
+            variables=variables,
+            n_variants=n_variants
+        )
+        span.size_out = len(prompt)
+    return prompt
+
+
+# Body dài hơn mức này (model lặp vô hạn, output bất thường) bị cắt trước khi chạy các rule regex:
+# thời gian hậu xử lý tỉ lệ với độ dài body nên giới hạn độ dài = giới hạn CPU mỗi request
+MAX_BODY_CHARS = int(os.getenv("EMAILGEN_MAX_BODY_CHARS", 20000))
+
+
+def guard_body(body: str) -> str:
+    """Cắt body quá MAX_BODY_CHARS tại xuống dòng gần nhất trước giới hạn (không có thì cắt cứng)"""
+    if len(body) <= MAX_BODY_CHARS or MAX_BODY_CHARS <= 0:
+        return body
+    cut = body.rfind("\n", 0, MAX_BODY_CHARS)
+    if cut < MAX_BODY_CHARS // 2:
+        cut = MAX_BODY_CHARS
+    get_metrics().count("body_guard", "truncated")
+    return body[:cut].rstrip()
+
+
+def postprocess_email(data: dict, purpose: str, lang: str, audience: str = "B2B",
+                      signature: str = "", require_cta: bool = False,
+                      variables: dict | None = None) -> tuple[str, str]:
+    """
+    Chuỗi hậu xử lý sau khi model trả về JSON {"subject", "body"}
+    Trả về (subject, body) đã có signature
+    """
+    # Signature chuẩn hóa + canonicalize 1 lần cho mỗi (signature, lang)
+    with stage("normalize_signature"):
+        sig_matcher = signature_matcher_for(signature or "", lang)
+    subject_raw = data.get("subject", "")
+    body_raw = guard_body(data.get("body", "") or "")
+
+    # Làm sạch pleasantries
+    with stage("trim_pleasantries", size_in=len(body_raw)) as span:
+        body_clean = trim_pleasantries(body_raw, lang, purpose)
+        span.size_out = len(body_clean)
+    # Xóa mọi signature cũ (nếu model tự thêm)
+    with stage("remove_signature", size_in=len(body_clean)) as span:
+        body_clean = sig_matcher.strip(body_clean)
+        span.size_out = len(body_clean)
+    with stage("tune_audience", size_in=len(body_clean)) as span:
+        body_clean = tune_audience(body_clean, audience, lang)
+        span.size_out = len(body_clean)
+    # Enforce rules (CTA, placeholder) - KHÔNG xử lý signature ở đây
+    with stage("enforce_rules", size_in=len(body_clean)) as span:
+        subject, body = enforce_rules_v2(
+            subject_raw,
+            body_clean,
+            require_cta=require_cta,
+            purpose=purpose,
+            lang=lang,
+            audience=audience,
+            variables=variables
+        )
+        span.size_out = len(body)
+    with stage("soften_claims", size_in=len(body)) as span:
+        body = soften_claims(body, lang)
+        span.size_out = len(body)
+    # Thêm signature (bước cuối cùng, duy nhất)
+    with stage("add_signature", size_in=len(body)) as span:
+        body = sig_matcher.append(body)
+        span.size_out = len(body)
+
+    # Suggest subject nếu model không trả về
+    if not subject or subject.strip().lower() in {"generated email", "subject", ""}:
+        subject = suggest_subject(purpose, lang)
+    if len(subject) > 60:
+        subject = subject[:57].rstrip() + "..."
+    return subject, body
+
+
+# ---- Kiểm tra & sửa output (thay cho generate lại cả email) ----
+
+# "local" (mặc định) = chỉ sửa cục bộ, không tốn thêm lời gọi; "1" = field còn lỗi sau khi sửa cục bộ thì gọi
+# model thêm 1 lần (chỉ hỏi field đó) - chủ yếu do lệch số từ, tốn thêm tới ~50% quota; "0" = tắt
+REPAIR_MODE = os.getenv("EMAILGEN_REPAIR", "local")
+SUBJECT_MAX_CHARS = 60
+
+_ELLIPSIS = re.compile(r"\s*(\.\.\.|…)\s*$")
+_TEMPLATE_VAR = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_BLANK_RUNS = re.compile(r"\n{3,}")
+# Cắt subject ưu tiên tại ranh giới mệnh đề; từ nối ở cuối sau khi cắt bị bỏ
+_SUBJECT_SEPARATORS = (" – ", " — ", " - ", ": ", " | ", "; ", ", ")
+_DANGLING_WORDS = {"to", "for", "and", "or", "of", "the", "a", "an", "with", "on", "in",
+                   "và", "cho", "của", "với", "về", "để", "các", "những"}
+_VARIABLE_LABELS = dict(PROMPT_VARIABLE_LABELS)
+# Mô tả lỗi cho prompt sửa (detail của vi phạm được format vào)
+_VIOLATION_TEXT = {
+    "subject_missing": "missing",
+    "subject_truncated": "cut off with an ellipsis; write a complete subject",
+    "subject_too_long": "too long ({})",
+    "salutation_missing": 'must start with the salutation line "{}"',
+    "variable_missing": "must contain {}",
+    "variable_unresolved": "contains an unfilled {{{{{}}}}} template variable",
+    "cta_missing": "must end with a clear call-to-action",
+    "body_too_short": "too short ({} words)",
+    "body_too_long": "too long ({} words)",
+}
+
+
+def _is_leave_request(purpose: str) -> bool:
+    p = (purpose or "").lower()
+    return "leave request" in p or "xin nghỉ" in p
+
+
+def required_variables(details: str, variables: dict | None) -> dict:
+    """Biến có giá trị mà body phải chứa: được nhắc trong details ({{key}}) hoặc link của CTA form/tài liệu"""
+    variables = variables or {}
+    keys = set(_TEMPLATE_VAR.findall(details or ""))
+    if variables.get("_cta_template") in ("Điền form", "Tải tài liệu"):
+        keys.add("meeting_link")
+    return {k: variables[k] for k in sorted(keys) if not k.startswith("_") and variables.get(k)}
+
+
+def validate_email(subject: str, body: str, purpose: str, lang: str, words: int = 120,
+                   require_cta: bool = False, salutation_line: str = "",
+                   required: dict | None = None) -> list[dict]:
+    """
+    Kiểm tra email (body chưa có signature) theo các ràng buộc của build_json_prompt_v2
+    Trả về danh sách vi phạm {"field", "code", "detail"} (rỗng = đạt)
+    """
+    violations = []
+
+    def add(field, code, detail=""):
+        violations.append({"field": field, "code": code, "detail": detail})
+
+    subject = (subject or "").strip()
+    if not subject or subject.lower() in {"generated email", "subject"}:
+        add("subject", "subject_missing")
+    elif _ELLIPSIS.search(subject):
+        add("subject", "subject_truncated", subject)
+    elif len(subject) > SUBJECT_MAX_CHARS:
+        add("subject", "subject_too_long", f"{len(subject)} > {SUBJECT_MAX_CHARS} chars")
+
+    body = (body or "").strip()
+    if salutation_line and not get_rules(lang).starts_with_greeting(body):
+        add("body", "salutation_missing", salutation_line)
+    for key, value in (required or {}).items():
+        if value not in body:
+            add("body", "variable_missing", key)
+    for key in _TEMPLATE_VAR.findall(body):
+        add("body", "variable_unresolved", key)
+    if require_cta and not _is_leave_request(purpose) and not has_cta_in_body(body, lang):
+        add("body", "cta_missing")
+    n_words = len(body.split())
+    if n_words < WORDS_TOLERANCE[0] * words:
+        add("body", "body_too_short", f"{n_words}/{words}")
+    elif n_words > WORDS_TOLERANCE[1] * words:
+        add("body", "body_too_long", f"{n_words}/{words}")
+    return violations
+
+
+def shorten_subject(subject: str, limit: int = SUBJECT_MAX_CHARS) -> str:
+    """Rút subject về ≤ limit ký tự tại ranh giới mệnh đề/từ, không thêm "..."; "" nếu phải cắt quá nửa"""
+    s = _ELLIPSIS.sub("", subject or "").strip()
+    if len(s) <= limit:
+        return s
+    for sep in _SUBJECT_SEPARATORS:
+        i = s.rfind(sep, 0, limit)
+        if i >= limit // 2:
+            return s[:i].rstrip()
+    words = s[:limit + 1].split()[:-1]
+    while words and words[-1].lower().strip(",;:-–—|") in _DANGLING_WORDS | {""}:
+        words.pop()
+    cut = " ".join(words).rstrip(" ,;:-–—|")
+    return cut if len(cut) >= limit // 2 else ""
+
+
+def _dedupe_sentences(body: str) -> str:
+    # Câu lặp lại nguyên văn (model hay lặp khi viết dài) → giữ lần đầu
+    seen, lines = set(), []
+    for line in body.split("\n"):
+        kept = []
+        for sentence in _SENTENCE_END.split(line):
+            key = " ".join(sentence.lower().split())
+            if key and key in seen:
+                continue
+            seen.add(key)
+            kept.append(sentence)
+        if kept or not line.strip():
+            lines.append(" ".join(kept))
+    return _BLANK_RUNS.sub("\n\n", "\n".join(lines)).strip()
+
+
+def repair_locally(subject: str, body: str, violations: list[dict], purpose: str, lang: str,
+                   subject_raw: str = "", audience: str = "B2B", require_cta: bool = False,
+                   salutation_line: str = "", variables: dict | None = None,
+                   required: dict | None = None) -> tuple[str, str]:
+    """
+    Sửa tất định các vi phạm sửa được mà không cần model (body chưa có signature)
+    Không sửa được cục bộ: subject quá dài không có chỗ cắt hợp lý, body quá ngắn/dài (trừ câu lặp)
+    """
+    codes = {v["code"] for v in violations}
+    if codes & {"subject_truncated", "subject_too_long"}:
+        # Cắt lại từ subject gốc của model thay vì subject đã bị cắt "..."
+        subject = shorten_subject(subject_raw if len(subject_raw or "") > len(subject) else subject) or subject
+    if "subject_missing" in codes:
+        subject = suggest_subject(purpose, lang)
+
+    if "variable_unresolved" in codes:
+        body = interpolate_variables(body, {k: v for k, v in (variables or {}).items() if not k.startswith("_")})
+        body = _TEMPLATE_VAR.sub("", body)
+    if "salutation_missing" in codes:
+        body = f"{salutation_line}\n\n{body.lstrip()}"
+    if "cta_missing" in codes:
+        _, body = enforce_rules_v2(subject, body, require_cta=True, purpose=purpose, lang=lang,
+                                   audience=audience, variables=variables)
+    if "variable_missing" in codes:
+        rules = get_rules(lang)
+        missing = [v["detail"] for v in violations if v["code"] == "variable_missing"]
+        lines = [rules.variable_line(key, required[key]) for key in missing if key in (required or {})]
+        if lines:
+            body = body.rstrip() + "\n\n" + "\n".join(lines)
+    if "body_too_long" in codes:
+        body = _dedupe_sentences(body)
+    return subject, body
+
+
+def build_repair_prompt(violations: list[dict], subject: str, body: str, lang: str, words: int = 120,
+                        salutation_line: str = "", required: dict | None = None) -> str:
+    """Prompt sửa chỉ các field còn lỗi; model trả JSON chỉ gồm các field đó"""
+    fields = [f for f in ("subject", "body") if any(v["field"] == f for v in violations)]
+    problems = "\n".join(
+        f"- {v['field']}: " + _VIOLATION_TEXT[v["code"]].format(
+            f"{_VARIABLE_LABELS.get(v['detail'], v['detail'])}: {required[v['detail']]}"
+            if v["code"] == "variable_missing" else v["detail"])
+        for v in violations
+    )
+    rules = []
+    if "subject" in fields:
+        rules.append(f"- subject: one line, ≤ {SUBJECT_MAX_CHARS} characters, same topic")
+    if "body" in fields:
+        keep = "; ".join(f"{_VARIABLE_LABELS.get(k, k)}: {v}" for k, v in (required or {}).items())
+        rules.append(f"- body: around {words} words, keep the content and facts"
+                     + (f', start with "{salutation_line}"' if salutation_line else "")
+                     + (f", include verbatim: {keep}" if keep else "")
+                     + ", no closing signature, no [placeholders]")
+    keys = ", ".join(f'"{f}"' for f in fields)
+    return f"""
+Fix only the listed problems in this business email. Language: {lang}.
+Return STRICT JSON only with exactly these keys: {keys}. No markdown, no explanations.
+
+Problems:
+{problems}
+
+Rules:
+{chr(10).join(rules)}
+
+Current email:
+Subject: {subject}
+Body:
+{body}
+""".strip()
+
+
+def repair_email(subject: str, body: str, purpose: str, lang: str, subject_raw: str = "",
+                 audience: str = "B2B", signature: str = "", words: int = 120, require_cta: bool = False,
+                 salutation_line: str = "", details: str = "", variables: dict | None = None,
+                 temperature: float = 0.6, followup: bool = True) -> tuple[str, str, dict]:
+    """
+    Kiểm tra email đã hậu xử lý → sửa cục bộ → (followup=True) còn lỗi thì 1 lời gọi model chỉ cho field lỗi
+    → cuối cùng subject vẫn lỗi thì lấy gợi ý của subject_variants
+    Trả về (subject, body, info): info = {"violations", "remaining", "followup"} (mã lỗi)
+    Đếm vào metrics: event "repair" (clean / local / followup / unresolved), "repair_violation" (mã lỗi)
+    """
+    metrics = get_metrics()
+    sig_matcher = signature_matcher_for(signature or "", lang)
+    required = required_variables(details, variables)
+    check = dict(purpose=purpose, lang=lang, words=words, require_cta=require_cta,
+                 salutation_line=salutation_line, required=required)
+    with stage("validate", size_in=len(body)):
+        core = sig_matcher.strip(body)
+        violations = validate_email(subject, core, **check)
+    if not violations:
+        metrics.count("repair", "clean")
+        return subject, body, {"violations": [], "remaining": [], "followup": []}
+    for v in violations:
+        metrics.count("repair_violation", v["code"])
+
+    fix = dict(purpose=purpose, lang=lang, audience=audience, require_cta=require_cta,
+               salutation_line=salutation_line, variables=variables, required=required)
+    with stage("repair_local", size_in=len(core)) as span:
+        subject, core = repair_locally(subject, core, violations, subject_raw=subject_raw, **fix)
+        remaining = validate_email(subject, core, **check)
+        span.size_out = len(core)
+
+    followup_fields = []
+    if remaining and followup:
+        followup_fields = [f for f in ("subject", "body") if any(v["field"] == f for v in remaining)]
+        schema = {"type": "OBJECT", "properties": {f: {"type": "STRING"} for f in followup_fields},
+                  "required": followup_fields}
+        prompt = build_repair_prompt(remaining, subject, core, lang, words=words,
+                                     salutation_line=salutation_line, required=required)
+        with stage("repair_followup", size_in=len(prompt)), token_tags(repair=",".join(followup_fields)):
+            data = call_gemini_json(prompt, temperature=temperature, schema=schema)
+        if "subject" in followup_fields and (data.get("subject") or "").strip():
+            subject = shorten_subject(data["subject"].strip()) or subject
+        if "body" in followup_fields and (data.get("body") or "").strip():
+            # Body mới đi lại các bước hậu xử lý (pleasantries, signature model tự thêm, CTA, placeholder)
+            _, new_body = postprocess_email({"subject": subject, "body": data["body"]}, purpose, lang,
+                                            audience=audience, signature=signature,
+                                            require_cta=require_cta, variables=variables)
+            core = sig_matcher.strip(new_body)
+        remaining = validate_email(subject, core, **check)
+        if remaining:
+            subject, core = repair_locally(subject, core, remaining, subject_raw=subject, **fix)
+            remaining = validate_email(subject, core, **check)
+
+    if any(v["field"] == "subject" for v in remaining):
+        fitting = [s for s in subject_variants("", purpose, lang) if not _ELLIPSIS.search(s)]
+        if fitting:
+            subject = fitting[0]
+            remaining = validate_email(subject, core, **check)
+
+    outcome = "unresolved" if remaining else "followup" if followup_fields else "local"
+    metrics.count("repair", outcome)
+    info = {
+        "violations": [v["code"] for v in violations],
+        "remaining": [v["code"] for v in remaining],
+        "followup": followup_fields,
+    }
+    return subject, sig_matcher.append(core), info
+
+
+def _repair_output(subject: str, body: str, subject_raw: str, purpose: str, lang: str, length: str,
+                   followup: bool = True, **kwargs) -> tuple[str, str, dict | None]:
+    # repair_email theo EMAILGEN_REPAIR (None khi tắt)
+    if REPAIR_MODE == "0":
+        return subject, body, None
+    with token_tags(purpose=purpose, lang=lang, length=length):
+        return repair_email(subject, body, purpose, lang, subject_raw=subject_raw,
+                            followup=followup and REPAIR_MODE == "1", **kwargs)
+
+
+def generate_email(purpose: str, tone: str, lang: str, recipient: str = "", details: str = "",
+                   signature: str = "", audience: str = "B2B", length: str = "Trung bình",
+                   require_cta: bool = False, variables: dict | None = None,
+                   temperature: float | None = None, before_call=None) -> dict:
+    """
+    Chạy trọn pipeline: prompt → Gemini → hậu xử lý
+    before_call: chạy trước mỗi request API của email (lần đầu, retry, escalation, repair) - vd. rate limiter
+    Trả về dict gồm subject, body, subject_raw, prompt, data (raw response)
+    """
+    variables = variables or build_vars_map()
+    words = WORDS_BY_LENGTH.get(length, 120)
+    if temperature is None:
+        temperature = TONE_TEMPERATURE.get(tone, 0.6)
+
+    with before_each_call(before_call), start_trace("generate_email") as trace:
+        prompt = build_request_prompt(purpose, tone, recipient, details, lang,
+                                      words=words, require_cta=require_cta, variables=variables)
+        with token_tags(purpose=purpose, lang=lang, length=length, prompt_variant=PROMPT_VARIANT):
+            data, model_name = call_gemini_routed(prompt, temperature, purpose, lang, length)
+        subject, body = postprocess_email(data, purpose, lang, audience=audience, signature=signature,
+                                          require_cta=require_cta, variables=variables)
+        subject, body, repair = _repair_output(
+            subject, body, data.get("subject", ""), purpose, lang, length, audience=audience,
+            signature=signature, words=words, require_cta=require_cta,
+            salutation_line=build_salutation(recipient, lang), details=details, variables=variables,
+            temperature=temperature,
+        )
+    return {
+        "subject": subject,
+        "body": body,
+        "subject_raw": data.get("subject", ""),
+        "prompt": prompt,
+        "data": data,
+        "model": model_name,
+        "repair": repair,
+        "trace": trace.to_dict(),
+    }
+
+
+
+def stream_generate_email(purpose: str, tone: str, lang: str, recipient: str = "", details: str = "",
+                          signature: str = "", audience: str = "B2B", length: str = "Trung bình",
+                          require_cta: bool = False, variables: dict | None = None,
+                          temperature: float | None = None):
+    """
+    Giống generate_email nhưng stream: yield ("partial", {"subject", "body"}) khi text về dần,
+    hậu xử lý chạy 1 lần sau khi stream đóng rồi yield ("result", dict như generate_email)
+    """
+    variables = variables or build_vars_map()
+    words = WORDS_BY_LENGTH.get(length, 120)
+    if temperature is None:
+        temperature = TONE_TEMPERATURE.get(tone, 0.6)
+
+    with start_trace("stream_generate_email") as trace:
+        prompt = build_request_prompt(purpose, tone, recipient, details, lang,
+                                      words=words, require_cta=require_cta, variables=variables)
+        data = {}
+        router = get_router()
+        tier = router.pick(purpose, lang, length) if router is not None else None
+        model_name = router.model(tier) if router is not None else MODEL_NAME
+        with token_tags(purpose=purpose, lang=lang, length=length, prompt_variant=PROMPT_VARIANT):
+            with token_tags(model_tier=tier):
+                for kind, payload in stream_gemini_json(prompt, temperature=temperature, model_name=model_name):
+                    if kind == "partial":
+                        yield "partial", payload
+                    else:
+                        data = payload
+            if router is not None:
+                # Stream đã hiển thị xong mà output không đạt → gọi lại (không stream) ở tier cao hơn
+                issues = check_candidates(extract_candidates(data), words)
+                next_tier = router.next_tier(tier) if issues and router.max_escalations > 0 else None
+                router.record(tier, issues, escalated=next_tier is not None)
+                if next_tier is not None:
+                    data, model_name = call_gemini_routed(prompt, temperature, purpose, lang, length,
+                                                          start_tier=next_tier, escalations=1)
+
+        subject, body = postprocess_email(data, purpose, lang, audience=audience, signature=signature,
+                                          require_cta=require_cta, variables=variables)
+        subject, body, repair = _repair_output(
+            subject, body, data.get("subject", ""), purpose, lang, length, audience=audience,
+            signature=signature, words=words, require_cta=require_cta,
+            salutation_line=build_salutation(recipient, lang), details=details, variables=variables,
+            temperature=temperature,
+        )
+    yield "result", {
+        "subject": subject,
+        "body": body,
+        "subject_raw": data.get("subject", ""),
+        "prompt": prompt,
+        "data": data,
+        "model": model_name,
+        "repair": repair,
+        "trace": trace.to_dict(),
+    }
+
+
+
+def extract_candidates(data) -> list[dict]:
+    """Lấy danh sách {"subject", "body"} từ response nhiều phương án (hoặc 1 phương án)"""
+    if isinstance(data, dict) and isinstance(data.get("variants"), list):
+        items = data["variants"]
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = [data]
+    return [c for c in items if isinstance(c, dict) and (c.get("subject") or c.get("body"))] or [
+        {"subject": "Generated Email", "body": "No content"}
+    ]
+
+
+def postprocess_candidates(candidates: list[dict], purpose: str, lang: str, audience: str = "B2B",
+                           signature: str = "", require_cta: bool = False,
+                           variables: dict | None = None) -> list[tuple[str, str]]:
+    """Hậu xử lý từng phương án song song (giữ nguyên thứ tự)"""
+    def run(candidate):
+        return postprocess_email(candidate, purpose, lang, audience=audience, signature=signature,
+                                 require_cta=require_cta, variables=variables)
+
+    if len(candidates) <= 1:
+        return [run(c) for c in candidates]
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=min(len(candidates), 8)) as pool:
+        return list(pool.map(run, candidates))
+
+
+def generate_email_variants(purpose: str, tone: str, lang: str, recipient: str = "", details: str = "",
+                            signature: str = "", audience: str = "B2B", length: str = "Trung bình",
+                            require_cta: bool = False, variables: dict | None = None,
+                            temperature: float | None = None, n_variants: int = 3, before_call=None) -> dict:
+    """
+    Sinh nhiều phương án subject/body trong 1 request (1 lần latency, 1 lần quota)
+    before_call: như generate_email
+    Trả về dict như generate_email + "candidates": [{"subject", "body", "subject_raw"}, ...]
+    """
+    variables = variables or build_vars_map()
+    words = WORDS_BY_LENGTH.get(length, 120)
+    if temperature is None:
+        temperature = TONE_TEMPERATURE.get(tone, 0.6)
+
+    with before_each_call(before_call), start_trace("generate_email_variants") as trace:
+        prompt = build_request_prompt(purpose, tone, recipient, details, lang, words=words,
+                                      require_cta=require_cta, variables=variables, n_variants=n_variants)
+        with token_tags(purpose=purpose, lang=lang, length=length, prompt_variant=PROMPT_VARIANT,
+                        n_variants=n_variants):
+            data, model_name = call_gemini_routed(prompt, temperature, purpose, lang, length,
+                                                  schema=VARIANTS_SCHEMA if n_variants > 1 else EMAIL_SCHEMA)
+        raw = extract_candidates(data)[:n_variants]
+        # Stage con của từng phương án chạy ở thread pool → chỉ vào histogram, không vào trace này
+        with stage("postprocess_candidates", size_in=len(raw)):
+            processed = postprocess_candidates(raw, purpose, lang, audience=audience, signature=signature,
+                                               require_cta=require_cta, variables=variables)
+        # Phương án lỗi chỉ sửa cục bộ (không gọi thêm model cho từng phương án)
+        candidates = []
+        salutation_line = build_salutation(recipient, lang)
+        for c, (subject, body) in zip(raw, processed):
+            subject, body, repair = _repair_output(
+                subject, body, c.get("subject", ""), purpose, lang, length, followup=False,
+                audience=audience, signature=signature, words=words, require_cta=require_cta,
+                salutation_line=salutation_line, details=details, variables=variables,
+            )
+            candidates.append({"subject": subject, "body": body, "subject_raw": c.get("subject", ""),
+                               "repair": repair})
+    return {
+        "subject": candidates[0]["subject"],
+        "body": candidates[0]["body"],
+        "subject_raw": candidates[0]["subject_raw"],
+        "prompt": prompt,
+        "data": data,
+        "candidates": candidates,
+        "model": model_name,
+        "repair": candidates[0]["repair"],
+        "trace": trace.to_dict(),
+    }
@@ -0,0 +1,494 @@
+"""
+Lớp client Gemini dùng chung:
+- Tái sử dụng GenerativeModel theo (model name, generation config) cho mọi lần gọi / mọi session
+- Deadline cho từng request: truyền xuống transport (request_options của SDK / timeout của urlopen) để
+  request quá hạn tự hủy và trả thread; future.result(timeout) của thread pool chỉ là lớp chặn dự phòng
+- Retry lỗi tạm thời (429, 5xx, timeout) với exponential backoff + jitter
+- Hook before_call của caller (rate limiter, budget của scheduler) chạy trước MỖI request thật gửi đi,
+  kể cả retry → quota/RPM được tính theo số request API, không theo số email
+- Ghi số token của mỗi lời gọi thành công vào token_usage
+- Hedging (tùy chọn): request chưa trả lời sau ngưỡng ≈ p90 latency gần đây → gửi thêm 1 bản,
+  bản nào về trước thắng; số lời gọi thêm bị giới hạn theo tỉ lệ trên tổng số lời gọi. Mỗi bản hedge là
+  1 request tính tiền: đi qua before_call như mọi request (budget scheduler, rate limiter), hết budget → không hedge
+
+Cấu hình qua biến môi trường:
+    GEMINI_TIMEOUT       = deadline mỗi request (giây, mặc định 30)
+    GEMINI_MAX_RETRIES   = số lần retry tối đa (mặc định 3)
+    GEMINI_API_ENDPOINT  = gọi REST API trực tiếp tới endpoint này thay vì qua SDK
+                           (vd. server giả lập tools/fake_gemini.py: http://127.0.0.1:8765)
+    GEMINI_HEDGE              = "1" để bật hedging (mặc định tắt)
+    GEMINI_HEDGE_PERCENTILE   = percentile latency dùng làm ngưỡng hedge (mặc định 0.9)
+    GEMINI_HEDGE_MAX_EXTRA    = số lời gọi hedge tối đa / số lời gọi (mặc định 0.1 = +10% quota)
+    GEMINI_HEDGE_MIN_DELAY    = ngưỡng tối thiểu (giây, mặc định 0.3)
+"""
+import os, json, time, queue, random, threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from types import SimpleNamespace
+
+from metrics import get_metrics
+from token_usage import record_call
+
+
+DEFAULT_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 30))
+DEFAULT_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 3))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+
+# Lỗi tạm thời theo tên class của google.api_core.exceptions (tránh import trực tiếp)
+TRANSIENT_ERRORS = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "Aborted", "TimeoutError", "ConnectionError",
+}
+TRANSIENT_CODES = {429, 500, 502, 503, 504}
+
+# SDK, urllib và thread pool chỉ được import/tạo ở lần gọi đầu tiên
+# để import module này (và email_core) không làm chậm cold start của CLI/worker
+_configured_key: str | None = None
+_configure_lock = threading.Lock()
+_executor = None
+_STREAM_END = object()
+_call_hooks: ContextVar[tuple] = ContextVar("gemini_call_hooks", default=())
+
+
+class GeminiTimeout(TimeoutError):
+    """Request vượt quá deadline"""
+
+
+class GeminiHTTPError(Exception):
+    """Lỗi HTTP từ REST endpoint (code = HTTP status)"""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+
+class _RestResponse:
+    def __init__(self, payload: dict):
+        self.payload = payload
+        parts = []
+        for cand in (payload.get("candidates") or [])[:1]:
+            for part in (cand.get("content") or {}).get("parts") or []:
+                parts.append(part.get("text", ""))
+        self.text = "".join(parts)
+        # Cùng tên field với usage_metadata của SDK
+        usage = payload.get("usageMetadata") or {}
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=usage.get("promptTokenCount", 0),
+            candidates_token_count=usage.get("candidatesTokenCount", 0),
+            total_token_count=usage.get("totalTokenCount", 0),
+        ) if usage else None
+
+
+def _camel(key: str) -> str:
+    head, *rest = key.split("_")
+    return head + "".join(w.title() for w in rest)
+
+
+class _RestModel:
+    """
+    Client REST tối giản cho generateContent / streamGenerateContent, cùng interface với
+    phần genai.GenerativeModel mà app dùng (bật khi đặt GEMINI_API_ENDPOINT)
+    """
+
+    def __init__(self, endpoint: str, api_key: str, model_name: str, generation_config: dict):
+        self.endpoint = endpoint.rstrip("/")
+        self.api_key = api_key
+        self.model_name = model_name
+        self.generation_config = {_camel(k): v for k, v in generation_config.items()}
+
+    def _request(self, method: str, prompt: str, query: str = "", timeout: float | None = None):
+        import urllib.request, urllib.error
+
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        if self.generation_config:
+            body["generationConfig"] = self.generation_config
+        url = f"{self.endpoint}/v1beta/models/{self.model_name}:{method}?key={self.api_key}{query}"
+        req = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(req, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read().decode("utf-8"))["error"]["message"]
+            except Exception:
+                message = e.reason
+            raise GeminiHTTPError(e.code, message) from None
+
+    def _stream(self, prompt: str, timeout: float | None = None):
+        # timeout của urlopen áp cho từng lần đọc socket → stream bị treo giữa chừng cũng tự đóng
+        with self._request("streamGenerateContent", prompt, "&alt=sse", timeout) as resp:
+            for raw in resp:
+                line = raw.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    yield _RestResponse(json.loads(line[5:]))
+
+    def generate_content(self, prompt: str, stream: bool = False, request_options: dict | None = None):
+        timeout = (request_options or {}).get("timeout")
+        if stream:
+            return self._stream(prompt, timeout)
+        with self._request("generateContent", prompt, timeout=timeout) as resp:
+            return _RestResponse(json.loads(resp.read().decode("utf-8")))
+
+
+def configure(api_key: str | None = None):
+    """Cấu hình API key 1 lần cho cả process"""
+    global _configured_key
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Missing GEMINI_API_KEY")
+    with _configure_lock:
+        if api_key != _configured_key:
+            if not os.getenv("GEMINI_API_ENDPOINT"):
+                import google.generativeai as genai
+                genai.configure(api_key=api_key)
+            _configured_key = api_key
+            _get_model.cache_clear()
+
+
+def _ensure_configured():
+    """Khởi tạo client lười: tự configure từ GEMINI_API_KEY ở lần gọi đầu tiên"""
+    if _configured_key is None:
+        configure()
+
+
+def _get_executor():
+    # Thread pool để áp deadline cho lời gọi SDK (SDK không tự hủy request bị treo)
+    global _executor
+    if _executor is None:
+        with _configure_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini")
+    return _executor
+
+
+class _FrozenJSON(str):
+    """Giá trị dict/list của generation config (vd. response_schema) ở dạng JSON để làm key lru_cache"""
+
+
+def _freeze_config(generation_config: dict | None) -> tuple:
+    return tuple(sorted(
+        (k, _FrozenJSON(json.dumps(v, sort_keys=True)) if isinstance(v, (dict, list)) else v)
+        for k, v in (generation_config or {}).items()
+    ))
+
+
+def _thaw_config(frozen_cfg: tuple) -> dict:
+    return {k: json.loads(v) if isinstance(v, _FrozenJSON) else v for k, v in frozen_cfg}
+
+
+@lru_cache(maxsize=32)
+def _get_model(model_name: str, frozen_cfg: tuple):
+    endpoint = os.getenv("GEMINI_API_ENDPOINT")
+    if endpoint:
+        return _RestModel(endpoint, _configured_key,
+                          model_name, _thaw_config(frozen_cfg))
+    import google.generativeai as genai
+    return genai.GenerativeModel(model_name, generation_config=_thaw_config(frozen_cfg))
+
+
+def get_model(model_name: str, generation_config: dict | None = None):
+    """GenerativeModel dùng chung theo (model name, generation config)"""
+    _ensure_configured()
+    return _get_model(model_name, _freeze_config(generation_config))
+
+
+def is_transient(exc: Exception) -> bool:
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    if type(exc).__name__ in TRANSIENT_ERRORS:
+        return True
+    code = getattr(exc, "code", None)
+    code = getattr(code, "value", code)
+    return code in TRANSIENT_CODES
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full jitter: random trong [0, min(cap, base * 2^attempt)]"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+@contextmanager
+def before_each_call(hook):
+    """
+    Trong block, hook() chạy ngay trước mỗi request thật gửi tới API (lần đầu, retry, escalation, repair...)
+    ở thread của caller; hook raise (vd. hết quota) → request không được gửi. hook=None: không làm gì
+    """
+    if hook is None:
+        yield
+        return
+    token = _call_hooks.set(_call_hooks.get() + (hook,))
+    try:
+        yield
+    finally:
+        _call_hooks.reset(token)
+
+
+def _before_request(before_call=None):
+    for hook in _call_hooks.get():
+        hook()
+    if before_call is not None:
+        before_call()
+
+
+def _request_options(timeout: float | None) -> dict | None:
+    # Cùng dạng tham số với SDK (generate_content(..., request_options={"timeout": ...}))
+    return {"timeout": timeout} if timeout else None
+
+
+def _call_with_deadline(fn, timeout: float | None):
+    if not timeout:
+        return fn()
+    from concurrent.futures import TimeoutError as FutureTimeout
+
+    future = _get_executor().submit(fn)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        raise GeminiTimeout(f"Gemini request exceeded {timeout:.1f}s deadline") from None
+
+
+class HedgePolicy:
+    """
+    Ngưỡng hedge thích ứng + ngân sách lời gọi thêm (thread-safe)
+    - delay(): percentile latency của các lời gọi thành công gần đây (chưa đủ mẫu → initial_delay)
+    - try_hedge(): token bucket, mỗi lời gọi chính nạp max_extra token, mỗi hedge tốn 1
+      → về lâu dài số hedge ≤ max_extra × số lời gọi
+    Token bucket chỉ giới hạn tỉ lệ; mỗi hedge vẫn là 1 request tính vào quota API (max_extra=0.1 → tới +10%
+    request) nên try_hedge(charge) còn tính hedge vào budget của caller (daily cap của scheduler...)
+    """
+
+    def __init__(self, percentile: float = 0.9, max_extra: float = 0.1, min_delay: float = 0.3,
+                 initial_delay: float = 3.0, window: int = 200, min_samples: int = 20):
+        self.percentile = percentile
+        self.max_extra = max_extra
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._tokens = 1.0
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "hedged": 0, "hedge_wins": 0, "cancelled": 0, "over_budget": 0,
+                         "over_quota": 0}
+
+    def delay(self) -> float:
+        with self._lock:
+            self.counters["calls"] += 1
+            self._tokens = min(2.0, self._tokens + self.max_extra)
+            if len(self._latencies) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(self._latencies)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def try_hedge(self, charge=None) -> bool:
+        """charge(): tính hedge vào budget của caller, raise (hết quota) → không hedge, hoàn token"""
+        with self._lock:
+            if self._tokens < 1.0:
+                outcome = "over_budget"
+            else:
+                self._tokens -= 1.0
+                outcome = "fired"
+        if outcome == "fired" and charge is not None:
+            try:
+                charge()
+            except Exception:
+                outcome = "over_quota"
+                with self._lock:
+                    self._tokens += 1.0
+        with self._lock:
+            self.counters["hedged" if outcome == "fired" else outcome] += 1
+        get_metrics().count("hedge", outcome)
+        return outcome == "fired"
+
+    def record(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+        if counter == "hedge_wins":
+            get_metrics().count("hedge", "won")
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = sorted(self._latencies)
+            counters = dict(self.counters)
+        p = samples[min(len(samples) - 1, int(self.percentile * len(samples)))] if samples else None
+        return {**counters, "samples": len(samples),
+                f"p{int(self.percentile * 100)}_ms": round(p * 1000, 1) if p is not None else None}
+
+
+_hedge_policy: HedgePolicy | None = None
+
+
+def get_hedge_policy() -> HedgePolicy | None:
+    """HedgePolicy dùng chung (None khi GEMINI_HEDGE chưa bật)"""
+    global _hedge_policy
+    if os.getenv("GEMINI_HEDGE", "0") != "1":
+        return None
+    if _hedge_policy is None:
+        with _configure_lock:
+            if _hedge_policy is None:
+                _hedge_policy = HedgePolicy(
+                    percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", 0.9)),
+                    max_extra=float(os.getenv("GEMINI_HEDGE_MAX_EXTRA", 0.1)),
+                    min_delay=float(os.getenv("GEMINI_HEDGE_MIN_DELAY", 0.3)),
+                )
+    return _hedge_policy
+
+
+def _call_hedged(fn, timeout: float | None, policy: HedgePolicy, before_call=None):
+    """
+    Như _call_with_deadline nhưng gửi thêm 1 bản khi bản đầu chưa về sau policy.delay()
+    Bản về trước (thành công) thắng; bản thua được cancel nếu chưa chạy, nếu đã gửi đi thì
+    kết quả bị bỏ (SDK không hủy được request đang chạy)
+    Bản hedge qua before_call / before_each_call như request thường; hook raise (hết budget) → chỉ chạy bản đầu
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    executor = _get_executor()
+    deadline = time.monotonic() + timeout if timeout else None
+    started = {}
+
+    def submit():
+        future = executor.submit(fn)
+        started[future] = time.monotonic()
+        return future
+
+    primary = submit()
+    delay = policy.delay()
+    if deadline is not None:
+        delay = min(delay, max(0.0, deadline - time.monotonic()))
+    wait([primary], timeout=delay)
+    pending = {primary}
+    hedge = None
+    if not primary.done() and policy.try_hedge(lambda: _before_request(before_call)):
+        hedge = submit()
+        pending.add(hedge)
+
+    error = None
+    while pending:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            policy.observe(time.monotonic() - started[future])
+            for loser in pending:
+                if loser.cancel():
+                    policy.record("cancelled")
+            if future is hedge:
+                policy.record("hedge_wins")
+            return future.result()
+    if pending or error is None:
+        raise GeminiTimeout(f"Gemini request exceeded {timeout:.1f}s deadline")
+    raise error
+
+
+def generate_content(prompt: str, model_name: str, generation_config: dict | None = None,
+                     timeout: float | None = None, retries: int | None = None, before_call=None):
+    """
+    Gọi generate_content với deadline + retry (+ hedging nếu bật)
+    before_call: chạy trước mỗi lần gửi (cùng các hook của before_each_call)
+    Trả về response gốc của SDK
+    """
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    retries = DEFAULT_RETRIES if retries is None else retries
+    model = get_model(model_name, generation_config)
+    hedge = get_hedge_policy()
+    options = _request_options(timeout)
+
+    def call():
+        return model.generate_content(prompt, request_options=options)
+
+    attempt = 0
+    while True:
+        # Ngoài try: hết quota/budget không phải lỗi tạm thời để retry
+        _before_request(before_call)
+        try:
+            if hedge is not None:
+                return _call_hedged(call, timeout, hedge, before_call)
+            return _call_with_deadline(call, timeout)
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+
+def generate_text(prompt: str, model_name: str, generation_config: dict | None = None,
+                  timeout: float | None = None, retries: int | None = None, before_call=None) -> str:
+    resp = generate_content(prompt, model_name, generation_config, timeout=timeout, retries=retries,
+                            before_call=before_call)
+    text = (resp.text or "").strip()
+    record_call(prompt, text, getattr(resp, "usage_metadata", None))
+    return text
+
+
+def _chunk_text(chunk) -> str:
+    # Chunk cuối (finish_reason, safety...) có thể không có text part
+    try:
+        return chunk.text or ""
+    except ValueError:
+        return ""
+
+
+def stream_text(prompt: str, model_name: str, generation_config: dict | None = None,
+                timeout: float | None = None, retries: int | None = None, before_call=None):
+    """
+    Generator các đoạn text khi gọi generate_content(stream=True)
+    - timeout: deadline cho toàn bộ stream
+    - Chỉ retry khi lỗi xảy ra TRƯỚC chunk đầu tiên (tránh lặp nội dung đã hiển thị)
+    - before_call: chạy trước mỗi lần mở stream (cùng các hook của before_each_call)
+    """
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    retries = DEFAULT_RETRIES if retries is None else retries
+    model = get_model(model_name, generation_config)
+
+    attempt = 0
+    while True:
+        chunks = queue.Queue()
+        # usage_metadata đầy đủ nằm ở chunk cuối
+        usage = [None]
+
+        def pump():
+            try:
+                for chunk in model.generate_content(prompt, stream=True, request_options=_request_options(timeout)):
+                    usage[0] = getattr(chunk, "usage_metadata", None) or usage[0]
+                    chunks.put(_chunk_text(chunk))
+            except Exception as e:
+                chunks.put(e)
+                return
+            chunks.put(_STREAM_END)
+
+        _before_request(before_call)
+        _get_executor().submit(pump)
+        deadline = time.monotonic() + timeout if timeout else None
+        received = []
+        try:
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = chunks.get(timeout=remaining)
+                except queue.Empty:
+                    raise GeminiTimeout(f"Gemini stream exceeded {timeout:.1f}s deadline") from None
+                if item is _STREAM_END:
+                    record_call(prompt, "".join(received), usage[0])
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                if item:
+                    received.append(item)
+                    yield item
+        except Exception as e:
+            if received or attempt >= retries or not is_transient(e):
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
@@ -0,0 +1,157 @@
+"""
+Lịch sử generate lưu trong SQLite (sống qua các lần rerun/restart): input, prompt, raw data,
+subject/body cuối cùng và timing. Tìm lại bằng full-text search (FTS5) trên details/subject/body
++ lọc theo purpose/lang/audience → dùng lại email cũ trong vài ms, không gọi API.
+
+Tokenizer unicode61 remove_diacritics: gõ không dấu ("giao hang") vẫn tìm được "giao hàng";
+mỗi từ được match theo tiền tố nên tìm được ngay khi đang gõ.
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_HISTORY       = "0" để tắt lịch sử
+    EMAILGEN_HISTORY_PATH  = đường dẫn file SQLite (mặc định .cache/history.sqlite3)
+    EMAILGEN_HISTORY_MAX   = số bản ghi tối đa, bản cũ nhất bị xóa trước (mặc định 5000)
+"""
+import os, re, json, time, threading
+
+FILTER_FIELDS = ("purpose", "lang", "audience")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    purpose TEXT, tone TEXT, lang TEXT, audience TEXT, length TEXT, recipient TEXT,
+    details TEXT, subject TEXT, body TEXT,
+    inputs TEXT NOT NULL, prompt TEXT, data TEXT, trace TEXT, total_ms REAL
+);
+CREATE INDEX IF NOT EXISTS generations_filters ON generations (purpose, lang, audience);
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5(
+    details, subject, body,
+    content='generations', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS generations_ai AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, details, subject, body) VALUES (new.id, new.details, new.subject, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_ad AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, details, subject, body)
+    VALUES ('delete', old.id, old.details, old.subject, old.body);
+END;
+"""
+
+_SUMMARY_COLUMNS = "g.id, g.created_at, g.purpose, g.tone, g.lang, g.audience, g.recipient, g.subject"
+
+
+def fts_query(text: str) -> str:
+    """Chuỗi người dùng gõ → câu MATCH an toàn: mỗi từ 1 token tiền tố ("giao"* "hang"*)"""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text or ""))
+
+
+class HistoryStore:
+    def __init__(self, path: str = ":memory:", max_entries: int = 5000):
+        import sqlite3
+
+        self.path = path
+        self.max_entries = max_entries
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def add(self, inputs: dict, result: dict) -> int:
+        """Lưu 1 lần generate: inputs = tham số generate_email, result = dict generate_email trả về"""
+        trace = result.get("trace") or {}
+        row = (
+            time.time(), inputs.get("purpose"), inputs.get("tone"), inputs.get("lang"), inputs.get("audience"),
+            inputs.get("length"), inputs.get("recipient"), inputs.get("details"),
+            result.get("subject"), result.get("body"),
+            json.dumps(inputs, ensure_ascii=False, default=str), result.get("prompt"),
+            json.dumps(result.get("data"), ensure_ascii=False), json.dumps(trace, ensure_ascii=False),
+            trace.get("total_ms"),
+        )
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO generations (created_at, purpose, tone, lang, audience, length, recipient, details,"
+                " subject, body, inputs, prompt, data, trace, total_ms)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row,
+            )
+            entry_id = cur.lastrowid
+            # id tăng dần → xóa bản cũ theo rowid (trigger cập nhật FTS)
+            if self.max_entries:
+                self._db.execute("DELETE FROM generations WHERE id <= ?", (entry_id - self.max_entries,))
+            self._db.commit()
+        return entry_id
+
+    def search(self, query: str = "", limit: int = 20, **filters) -> list[dict]:
+        """
+        Tìm theo từ khóa (FTS, xếp theo độ liên quan) hoặc mới nhất trước khi query rỗng
+        filters: purpose / lang / audience (giá trị rỗng/None = không lọc)
+        """
+        where, params = [], []
+        for field in FILTER_FIELDS:
+            if filters.get(field):
+                where.append(f"g.{field} = ?")
+                params.append(filters[field])
+        match = fts_query(query)
+        if match:
+            sql = (f"SELECT {_SUMMARY_COLUMNS}, snippet(generations_fts, -1, '**', '**', '…', 16) AS snippet"
+                   " FROM generations_fts JOIN generations g ON g.id = generations_fts.rowid"
+                   " WHERE generations_fts MATCH ?" + "".join(f" AND {w}" for w in where) +
+                   " ORDER BY bm25(generations_fts, 2.0, 3.0, 1.0), g.id DESC LIMIT ?")
+            params = [match, *params, limit]
+        else:
+            sql = (f"SELECT {_SUMMARY_COLUMNS}, substr(g.body, 1, 160) AS snippet FROM generations g"
+                   + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY g.id DESC LIMIT ?")
+            params.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params)]
+
+    def get(self, entry_id: int) -> dict | None:
+        """Bản ghi đầy đủ (inputs, prompt, data, trace đã parse JSON)"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM generations WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        for field in ("inputs", "data", "trace"):
+            entry[field] = json.loads(entry[field]) if entry[field] else None
+        return entry
+
+    def facets(self) -> dict[str, list[str]]:
+        """Các giá trị đã có của purpose/lang/audience (cho bộ lọc)"""
+        with self._lock:
+            return {
+                field: [r[0] for r in self._db.execute(
+                    f"SELECT DISTINCT {field} FROM generations WHERE {field} IS NOT NULL ORDER BY {field}")]
+                for field in FILTER_FIELDS
+            }
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM generations")
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        return {"entries": count, "max_entries": self.max_entries, "path": self.path}
+
+
+_default_history: HistoryStore | None = None
+_default_lock = threading.Lock()
+
+
+def get_history() -> HistoryStore | None:
+    """Lịch sử dùng chung trong process (tạo 1 lần, cấu hình từ biến môi trường)"""
+    global _default_history
+    if os.getenv("EMAILGEN_HISTORY", "1") == "0":
+        return None
+    with _default_lock:
+        if _default_history is None:
+            _default_history = HistoryStore(
+                path=os.getenv("EMAILGEN_HISTORY_PATH") or os.path.join(".cache", "history.sqlite3"),
+                max_entries=int(os.getenv("EMAILGEN_HISTORY_MAX", 5000)),
+            )
+        return _default_history
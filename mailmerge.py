@@ -0,0 +1,131 @@
+"""
+Mail merge: 1 bản nháp đã duyệt → hàng nghìn người nhận, KHÔNG gọi thêm model.
+
+Bản nháp: file .txt tải từ app ("Subject: ...\\n\\n<body>") hoặc .json {"subject", "body"}.
+Lời chào và signature có sẵn trong bản nháp được bỏ đi, rồi dựng lại cho từng người nhận:
+build_salutation + tune_audience (theo audience của dòng) + {{biến}} + signature chuẩn hóa theo ngôn ngữ
+(normalize_signature_text + add_signature, qua SignatureMatcher đã cache).
+
+Danh sách người nhận (CSV/JSONL) được đọc và ghi từng dòng (generator) → bộ nhớ không đổi
+kể cả với 100k dòng. Cột: recipient (hoặc name), email, audience, signature,
+order_id / delivery_date / hotline / meeting_link hoặc variables (JSON).
+
+Ví dụ:
+    python mailmerge.py generated_email.txt recipients.csv -o merged.csv --lang Vietnamese \\
+        --signature "Trân trọng,\\nPhuoc Doan"
+"""
+import re, json, time, argparse
+
+from batch import VAR_COLUMNS, ResultWriter, read_rows
+from email_core import build_salutation, build_vars_map, interpolate_variables, tune_audience
+from signatures import signature_matcher_for
+
+MERGE_FIELDS = ["id", "recipient", "email", "audience", "subject", "body"]
+
+# Dòng chào ở đầu bản nháp (sẽ được thay bằng lời chào của từng người nhận): chỉ dòng ngắn kết thúc bằng
+# "," / ":" ("Hello there is an update..." là nội dung, giữ nguyên)
+_GREETING = re.compile(r"^\s*(Kính gửi|Kính chào|Chào|Dear|Hi|Hello)\b[^\n]{0,60}[,:][ \t]*\n+", re.IGNORECASE)
+# Khối ký tên ở cuối bản nháp (signature cũ, có thể khác signature của lần merge): dòng chỉ có lời chào kết
+# (+ dấu câu) rồi tối đa 3 dòng ngắn (tên, chức danh...); "Sincerely appreciate..." là nội dung, giữ nguyên
+_CLOSING = re.compile(r"\n[ \t]*(Best regards|Warm regards|Kind regards|Regards|Sincerely|Trân trọng)[ \t]*[,.!]?[ \t]*"
+                      r"(\n[^\n]{0,80}){0,3}\s*$", re.IGNORECASE)
+
+
+def load_draft(path: str) -> dict:
+    """Đọc bản nháp .json {"subject", "body"} hoặc .txt dạng "Subject: ...\\n\\n<body>" """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if path.lower().endswith(".json"):
+        data = json.loads(text)
+        return {"subject": data.get("subject", ""), "body": data.get("body", "")}
+    subject, body = "", text
+    first, _, rest = text.partition("\n")
+    if first.lower().startswith("subject:"):
+        subject, body = first.split(":", 1)[1].strip(), rest
+    return {"subject": subject, "body": body.strip()}
+
+
+class MergeTemplate:
+    """Bản nháp đã bỏ lời chào + signature; body theo từng audience được tính 1 lần rồi dùng lại"""
+
+    def __init__(self, subject: str, body: str, lang: str, signature: str = ""):
+        self.subject = (subject or "").strip()
+        self.lang = lang
+        self.signature = signature or ""
+        base = _GREETING.sub("", (body or "").strip(), count=1)
+        # Bỏ khối ký tên trong bản nháp (signature của lần merge nếu trùng, rồi khối ký tên khác);
+        # signature của lần merge được thêm lại ở render()
+        base = signature_matcher_for(self.signature, lang).strip(base)
+        self.base = _CLOSING.sub("", base).rstrip()
+        self._by_audience: dict[str, str] = {}
+
+    def body_for(self, audience: str) -> str:
+        if audience not in self._by_audience:
+            self._by_audience[audience] = tune_audience(self.base, audience, self.lang)
+        return self._by_audience[audience]
+
+    def render(self, recipient: str = "", audience: str = "B2B", variables: dict | None = None,
+               signature: str | None = None) -> tuple[str, str]:
+        variables = {**(variables or {}), "recipient": (recipient or "").strip()}
+        body = interpolate_variables(self.body_for(audience), variables)
+        salutation = build_salutation(recipient, self.lang)
+        if salutation:
+            body = f"{salutation}\n\n{body}"
+        # signature_matcher_for chuẩn hóa theo ngôn ngữ (normalize_signature_text) và cache theo (sig, lang)
+        sig = self.signature if signature is None else signature
+        body = signature_matcher_for(sig or "", self.lang).append(body)
+        return interpolate_variables(self.subject, variables), body
+
+
+def row_variables(row: dict) -> dict:
+    variables = row.get("variables") or {}
+    if isinstance(variables, str):
+        variables = json.loads(variables) if variables.strip() else {}
+    for col in VAR_COLUMNS:
+        if row.get(col):
+            variables.setdefault(col, row[col])
+    vars_map = build_vars_map(**{k: variables.get(k, "") for k in VAR_COLUMNS})
+    vars_map.pop("_cta_template", None)
+    return vars_map
+
+
+def merge_rows(template: MergeTemplate, rows, default_audience: str = "B2B"):
+    """Generator: 1 record cho mỗi dòng người nhận"""
+    for idx, row in enumerate(rows):
+        recipient = row.get("recipient") or row.get("name") or ""
+        audience = row.get("audience") or default_audience
+        subject, body = template.render(recipient, audience, row_variables(row), row.get("signature") or None)
+        yield {
+            "id": row.get("id") if row.get("id") not in (None, "") else idx,
+            "recipient": recipient,
+            "email": row.get("email", ""),
+            "audience": audience,
+            "subject": subject,
+            "body": body,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mail merge an approved draft over a recipient list")
+    parser.add_argument("draft", help="Bản nháp .txt (Download .txt từ app) hoặc .json")
+    parser.add_argument("recipients", help="File .csv hoặc .jsonl danh sách người nhận")
+    parser.add_argument("-o", "--output", required=True, help="File kết quả .jsonl hoặc .csv")
+    parser.add_argument("--lang", default="Vietnamese", help="Ngôn ngữ của bản nháp")
+    parser.add_argument("--audience", default="B2B", help="Audience mặc định (khi dòng không có)")
+    parser.add_argument("--signature", default="", help="Signature (dòng có cột signature sẽ ghi đè)")
+    args = parser.parse_args(argv)
+
+    draft = load_draft(args.draft)
+    template = MergeTemplate(draft["subject"], draft["body"], args.lang, args.signature.replace("\\n", "\n"))
+
+    started = time.perf_counter()
+    count = 0
+    with ResultWriter(args.output, fields=MERGE_FIELDS) as writer:
+        for record in merge_rows(template, read_rows(args.recipients), args.audience):
+            writer.write(record)
+            count += 1
+    print(f"Merged {count} recipients in {time.perf_counter() - started:.1f}s → {args.output}")
+
+
+if __name__ == "__main__":
+    main()
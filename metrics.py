@@ -0,0 +1,247 @@
+"""
+Đo thời gian từng stage của pipeline generate (prompt → Gemini → hậu xử lý).
+
+    with start_trace("generate_email") as trace:
+        with stage("build_prompt", size_in=len(details)) as span:
+            prompt = ...
+            span.size_out = len(prompt)
+    trace.waterfall()          # waterfall dạng text cho Debug expander
+
+Mỗi stage ghi wall time, kích thước input/output và cờ cache hit vào:
+- trace của request hiện tại (nếu có start_trace bao ngoài) → waterfall / JSON
+- histogram gộp cả process → prometheus_text() hoặc export_jsonl()
+Nhờ đó phân biệt được chậm do mạng (call_gemini) hay do xử lý cục bộ.
+Ngoài ra đếm sự kiện theo kết quả: count("json_decode", "fallback"), count("generate", "regenerate")...
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_METRICS_LOG = file JSONL ghi trace của từng request (mặc định rỗng = không ghi)
+"""
+import os, json, time, threading
+from contextvars import ContextVar
+
+# Bucket (giây) cho histogram: từ vài chục µs (stage cục bộ) đến vài chục giây (gọi model)
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current: ContextVar = ContextVar("emailgen_trace", default=None)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count", "max", "cache_hits")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.cache_hits = 0
+
+    def observe(self, seconds: float, cache_hit: bool):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+        if cache_hit:
+            self.cache_hits += 1
+
+    def quantile(self, q: float) -> float:
+        """Ước lượng quantile từ bucket (cận trên của bucket chứa quantile)"""
+        if not self.count:
+            return 0.0
+        target, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class StageMetrics:
+    """Histogram theo stage cho cả process (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: dict[str, _Histogram] = {}
+        self._events: dict[tuple[str, str], int] = {}
+
+    def observe(self, name: str, seconds: float, cache_hit: bool = False):
+        with self._lock:
+            hist = self._stages.get(name)
+            if hist is None:
+                hist = self._stages[name] = _Histogram()
+            hist.observe(seconds, cache_hit)
+
+    def count(self, event: str, outcome: str, n: int = 1):
+        with self._lock:
+            key = (event, outcome)
+            self._events[key] = self._events.get(key, 0) + n
+
+    def events(self) -> dict:
+        """{event: {outcome: count}}"""
+        with self._lock:
+            out: dict[str, dict[str, int]] = {}
+            for (event, outcome), n in sorted(self._events.items()):
+                out.setdefault(event, {})[outcome] = n
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._events.clear()
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                name: {
+                    "count": h.count,
+                    "avg_ms": round(h.sum / h.count * 1000, 3) if h.count else 0.0,
+                    "p50_ms": round(h.quantile(0.5) * 1000, 3),
+                    "p95_ms": round(h.quantile(0.95) * 1000, 3),
+                    "max_ms": round(h.max * 1000, 3),
+                    "cache_hits": h.cache_hits,
+                }
+                for name, h in self._stages.items()
+            }
+
+    def prometheus_text(self) -> str:
+        """Histogram theo định dạng text exposition của Prometheus"""
+        lines = [
+            "# HELP emailgen_stage_duration_seconds Wall time of each generate pipeline stage",
+            "# TYPE emailgen_stage_duration_seconds histogram",
+        ]
+        hits = [
+            "# HELP emailgen_stage_cache_hits_total Stage executions served from cache",
+            "# TYPE emailgen_stage_cache_hits_total counter",
+        ]
+        events = [
+            "# HELP emailgen_events_total Pipeline events by outcome (json decode, regenerate...)",
+            "# TYPE emailgen_events_total counter",
+        ]
+        with self._lock:
+            for (event, outcome), n in sorted(self._events.items()):
+                events.append(f'emailgen_events_total{{event="{event}",outcome="{outcome}"}} {n}')
+            for name in sorted(self._stages):
+                h = self._stages[name]
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'emailgen_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'emailgen_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {h.count}')
+                lines.append(f'emailgen_stage_duration_seconds_sum{{stage="{name}"}} {h.sum:.6f}')
+                lines.append(f'emailgen_stage_duration_seconds_count{{stage="{name}"}} {h.count}')
+                hits.append(f'emailgen_stage_cache_hits_total{{stage="{name}"}} {h.cache_hits}')
+        return "\n".join(lines + hits + events) + "\n"
+
+    def export_jsonl(self) -> str:
+        """1 dòng JSON cho mỗi stage (histogram đầy đủ)"""
+        ts = round(time.time(), 3)
+        with self._lock:
+            rows = [
+                {"ts": ts, "stage": name, "count": h.count, "sum_s": round(h.sum, 6), "max_s": round(h.max, 6),
+                 "cache_hits": h.cache_hits, "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], h.counts))}
+                for name, h in sorted(self._stages.items())
+            ]
+            rows += [{"ts": ts, "event": event, "outcome": outcome, "count": n}
+                     for (event, outcome), n in sorted(self._events.items())]
+        return "".join(json.dumps(r) + "\n" for r in rows)
+
+
+_metrics = StageMetrics()
+
+
+def get_metrics() -> StageMetrics:
+    return _metrics
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "size_in", "size_out", "cache_hit", "_trace")
+
+    def __init__(self, name: str, size_in: int | None = None):
+        self.name = name
+        self.size_in = size_in
+        self.size_out = None
+        self.cache_hit = False
+        self.duration = 0.0
+        self._trace = _current.get()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.start
+        _metrics.observe(self.name, self.duration, self.cache_hit)
+        if self._trace is not None:
+            self._trace.spans.append(self)
+        return False
+
+
+def stage(name: str, size_in: int | None = None) -> Span:
+    """Context manager đo 1 stage; gán span.size_out / span.cache_hit trong block nếu cần"""
+    return Span(name, size_in)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.spans: list[Span] = []
+        self.start = time.perf_counter()
+        self.total = 0.0
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total = time.perf_counter() - self.start
+        _current.reset(self._token)
+        _metrics.observe(self.name, self.total)
+        path = os.getenv("EMAILGEN_METRICS_LOG")
+        if path:
+            with _log_lock, open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"ts": round(time.time(), 3), **self.to_dict()}, ensure_ascii=False) + "\n")
+        return False
+
+    def to_dict(self) -> dict:
+        total = self.total or (time.perf_counter() - self.start)
+        return {
+            "name": self.name,
+            "total_ms": round(total * 1000, 3),
+            "stages": [
+                {"stage": s.name, "offset_ms": round((s.start - self.start) * 1000, 3),
+                 "duration_ms": round(s.duration * 1000, 3), "size_in": s.size_in, "size_out": s.size_out,
+                 "cache_hit": s.cache_hit}
+                for s in sorted(self.spans, key=lambda s: s.start)
+            ],
+        }
+
+    def waterfall(self, width: int = 40) -> str:
+        return format_waterfall(self.to_dict(), width)
+
+
+def format_waterfall(trace: dict, width: int = 40) -> str:
+    """Waterfall dạng text từ Trace.to_dict(): mỗi stage 1 dòng, thanh ngang theo offset/duration"""
+    total = trace["total_ms"] or 1.0
+    name_w = max([len(s["stage"]) for s in trace["stages"]] + [len(trace["name"])])
+    lines = []
+    for s in trace["stages"]:
+        left = min(width - 1, int(s["offset_ms"] / total * width))
+        bar = max(1, min(width - left, round(s["duration_ms"] / total * width)))
+        hit = " (cache hit)" if s["cache_hit"] else ""
+        lines.append(f"{s['stage']:<{name_w}} |{' ' * left}{'█' * bar:<{width - left}}| "
+                     f"{s['duration_ms']:>9.3f} ms{hit}")
+    lines.append(f"{trace['name']:<{name_w}}  {'':<{width}}  {total:>9.3f} ms total")
+    return "\n".join(lines)
+
+
+_log_lock = threading.Lock()
+
+
+def start_trace(name: str) -> Trace:
+    return Trace(name)
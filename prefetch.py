@@ -0,0 +1,174 @@
+"""
+Prefetch suy đoán: sinh email ở nền trong lúc user còn chỉnh settings.
+
+Khi input (tham số của generate_email) đứng yên đủ debounce giây - hoặc ngay khi load preset -
+Prefetcher chạy generate_email trong thread nền và giữ kết quả. Bấm "Generate" với đúng input đó
+thì lấy kết quả ngay (hoặc chờ phần còn lại nếu request đang chạy). Input đổi → prefetch cũ bị
+hủy (nếu chưa chạy) hoặc bỏ kết quả (nếu đang chạy).
+
+Lời gọi model của prefetch tính vào budget của chính user trong scheduler (app chừa lại vài lượt cuối
+cho request thật); ngoài ra số prefetch của cả process bị giới hạn theo ngày:
+    EMAILGEN_PREFETCH_BUDGET    = số prefetch tối đa mỗi ngày cho cả process (mặc định 50, 0 = tắt)
+    EMAILGEN_PREFETCH_DEBOUNCE  = số giây input phải đứng yên trước khi prefetch (mặc định 1.5)
+"""
+import os, json, hashlib, threading
+from datetime import date
+
+
+def request_key(kwargs: dict) -> str:
+    """Key ổn định cho 1 bộ tham số generate_email"""
+    payload = json.dumps(kwargs, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PrefetchBudget:
+    """Bộ đếm số prefetch theo ngày (thread-safe); try_acquire() không chặn"""
+
+    def __init__(self, daily_limit: int = 50):
+        self.daily_limit = daily_limit
+        self.used_today = 0
+        self._day = date.today()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            today = date.today()
+            if today != self._day:
+                self._day, self.used_today = today, 0
+            if self.used_today >= self.daily_limit:
+                return False
+            self.used_today += 1
+            return True
+
+    def remaining(self) -> int:
+        with self._lock:
+            if date.today() != self._day:
+                return self.daily_limit
+            return max(0, self.daily_limit - self.used_today)
+
+
+_executor = None
+_default_budget: PrefetchBudget | None = None
+_default_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _default_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="emailgen-prefetch")
+        return _executor
+
+
+def get_prefetch_budget() -> PrefetchBudget:
+    """Budget dùng chung cho mọi session trong process"""
+    global _default_budget
+    with _default_lock:
+        if _default_budget is None:
+            _default_budget = PrefetchBudget(int(os.getenv("EMAILGEN_PREFETCH_BUDGET", 50)))
+        return _default_budget
+
+
+class Prefetcher:
+    """
+    Prefetch cho 1 session: chỉ giữ 1 bộ input "hiện tại"
+    schedule() gọi mỗi lần input có thể đổi; take() gọi khi user bấm Generate
+    """
+
+    def __init__(self, fn, debounce: float | None = None, budget: PrefetchBudget | None = None):
+        self.fn = fn
+        self.debounce = float(os.getenv("EMAILGEN_PREFETCH_DEBOUNCE", 1.5)) if debounce is None else debounce
+        self.budget = budget or get_prefetch_budget()
+        self._key = None
+        self._timer = None
+        self._future = None
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.counters = {"started": 0, "hits": 0, "misses": 0, "discarded": 0, "over_budget": 0}
+
+    def _discard(self):
+        # _seq đổi → timer đã bắn nhưng chưa kịp lấy lock cũng không khởi chạy nữa
+        self._seq += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._future is not None:
+            # Chưa chạy thì hủy hẳn; đang chạy thì chỉ bỏ kết quả
+            self._future.cancel()
+            self._future = None
+            self.counters["discarded"] += 1
+
+    def schedule(self, kwargs: dict, immediate: bool = False):
+        """Input hiện tại; prefetch sau debounce giây nếu input không đổi nữa (immediate: chạy ngay)"""
+        key = request_key(kwargs)
+        with self._lock:
+            if key == self._key:
+                # Cùng input: đang chờ/đang chạy/đã dùng → giữ nguyên, chỉ rút ngắn debounce khi immediate
+                if immediate and self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                    self._seq += 1
+                    self._launch(kwargs)
+                return
+            self._discard()
+            self._key = key
+            if immediate or self.debounce <= 0:
+                self._launch(kwargs)
+                return
+            self._timer = threading.Timer(self.debounce, self._on_timer, args=(self._seq, kwargs))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self, seq: int, kwargs: dict):
+        with self._lock:
+            if seq != self._seq or self._timer is None:
+                return
+            self._timer = None
+            self._launch(kwargs)
+
+    def _launch(self, kwargs: dict):
+        if not self.budget.try_acquire():
+            self.counters["over_budget"] += 1
+            return
+        self.counters["started"] += 1
+        self._future = _get_executor().submit(self.fn, **kwargs)
+
+    def cancel(self):
+        with self._lock:
+            self._discard()
+            self._key = None
+
+    def take(self, kwargs: dict, timeout: float | None = None):
+        """
+        Kết quả prefetch nếu khớp input (chờ tối đa timeout giây nếu đang chạy), ngược lại None
+        Kết quả chỉ dùng 1 lần; input giữ nguyên sau đó sẽ không prefetch lại
+        """
+        key = request_key(kwargs)
+        with self._lock:
+            future = None
+            if key == self._key:
+                # Request thật sắp chạy → bỏ prefetch chưa kịp bắt đầu
+                self._seq += 1
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                future, self._future = self._future, None
+            if future is None:
+                self.counters["misses"] += 1
+                return None
+        try:
+            result = future.result(timeout=timeout)
+        except Exception:
+            # Lỗi/timeout → để request thật chạy lại như bình thường
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+        with self._lock:
+            self.counters["hits"] += 1
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "budget_remaining": self.budget.remaining()}
@@ -0,0 +1,134 @@
+"""
+Chọn model theo độ khó của email: email ngắn / đơn giản → model rẻ + nhanh nhất,
+email dài / khó (sales, hợp tác) → model mạnh hơn. Kết quả không qua được kiểm tra cục bộ
+(thiếu subject, còn [placeholder], decode fallback, số từ lệch xa mục tiêu) → gọi lại ở tier cao hơn.
+
+Tier: lite → flash → pro. Latency theo từng model nằm ở histogram "call_gemini:<model>" của metrics;
+số lời gọi / số lần escalate theo tier: ModelRouter.stats().
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_ROUTING                  = "1" để bật (mặc định tắt: mọi request dùng MODEL_NAME)
+    EMAILGEN_MODEL_TIERS              = ghi đè model của tier, vd. "lite=gemini-2.5-flash-lite,pro=gemini-2.5-pro"
+    EMAILGEN_ROUTING_MAX_ESCALATIONS  = số lần escalate tối đa mỗi request (mặc định 1)
+"""
+import os, re, threading
+
+from metrics import get_metrics
+from rules import is_vi
+
+TIER_ORDER = ("lite", "flash", "pro")
+DEFAULT_TIER_MODELS = {
+    "lite": "gemini-2.5-flash-lite",
+    "flash": "gemini-2.5-flash",
+    "pro": "gemini-2.5-pro",
+}
+
+# So khớp theo chuỗi con (chữ thường) của purpose, vd. "Leave request / Xin nghỉ phép"
+SIMPLE_PURPOSES = ("leave request", "status update", "event invitation", "feedback request")
+COMPLEX_PURPOSES = ("sales", "partnership")
+
+_PLACEHOLDER = re.compile(r"\[[^\]\n]{1,60}\]")
+# Số từ chấp nhận được so với mục tiêu (body thô của model, trước hậu xử lý)
+WORDS_TOLERANCE = (0.5, 1.6)
+
+
+def check_candidates(candidates: list[dict], words: int) -> list[str]:
+    """Kiểm tra cục bộ output thô của model → danh sách lỗi (rỗng = đạt)"""
+    issues = []
+    for c in candidates:
+        subject = (c.get("subject") or "").strip()
+        body = c.get("body") or ""
+        if subject == "Generated Email":
+            issues.append("decode_fallback")
+            continue
+        if not subject:
+            issues.append("missing_subject")
+        if _PLACEHOLDER.search(subject) or _PLACEHOLDER.search(body):
+            issues.append("placeholder")
+        n_words = len(body.split())
+        if not WORDS_TOLERANCE[0] * words <= n_words <= WORDS_TOLERANCE[1] * words:
+            issues.append("word_count")
+    return sorted(set(issues))
+
+
+class ModelRouter:
+    def __init__(self, tier_models: dict | None = None, max_escalations: int = 1):
+        self.tier_models = {**DEFAULT_TIER_MODELS, **(tier_models or {})}
+        self.max_escalations = max_escalations
+        self._lock = threading.Lock()
+        self._counts = {tier: {"calls": 0, "escalated": 0} for tier in TIER_ORDER}
+
+    def pick(self, purpose: str, lang: str, length: str) -> str:
+        """Tier xuất phát cho 1 request"""
+        p = (purpose or "").lower()
+        if length == "Chi tiết" or any(k in p for k in COMPLEX_PURPOSES):
+            return "flash"
+        if length == "Ngắn":
+            return "lite"
+        # Độ dài vừa: chỉ email đơn giản tiếng Anh xuống lite, tiếng Việt cần model mạnh hơn để văn tự nhiên
+        if any(k in p for k in SIMPLE_PURPOSES) and not is_vi(lang):
+            return "lite"
+        return "flash"
+
+    def model(self, tier: str) -> str:
+        return self.tier_models[tier]
+
+    def next_tier(self, tier: str) -> str | None:
+        i = TIER_ORDER.index(tier)
+        return TIER_ORDER[i + 1] if i + 1 < len(TIER_ORDER) else None
+
+    def record(self, tier: str, issues: list[str], escalated: bool):
+        with self._lock:
+            self._counts[tier]["calls"] += 1
+            self._counts[tier]["escalated"] += escalated
+        metrics = get_metrics()
+        metrics.count("route_call", tier)
+        if escalated:
+            metrics.count("route_escalate", tier)
+            for issue in issues:
+                metrics.count("route_issue", issue)
+
+    def stats(self) -> dict:
+        """{tier: calls, escalated, escalation_rate, model, p50_ms, p95_ms}"""
+        latency = get_metrics().summary()
+        with self._lock:
+            counts = {tier: dict(c) for tier, c in self._counts.items()}
+        out = {}
+        for tier, c in counts.items():
+            model = self.tier_models[tier]
+            hist = latency.get(f"call_gemini:{model}", {})
+            out[tier] = {
+                **c,
+                "escalation_rate": round(c["escalated"] / c["calls"], 3) if c["calls"] else 0.0,
+                "model": model,
+                "p50_ms": hist.get("p50_ms"),
+                "p95_ms": hist.get("p95_ms"),
+            }
+        return out
+
+
+_router: ModelRouter | None = None
+_router_lock = threading.Lock()
+
+
+def _parse_tiers(spec: str) -> dict:
+    tiers = {}
+    for item in (spec or "").split(","):
+        tier, sep, model = item.partition("=")
+        if sep and tier.strip() in TIER_ORDER and model.strip():
+            tiers[tier.strip()] = model.strip()
+    return tiers
+
+
+def get_router() -> ModelRouter | None:
+    """Router dùng chung (None khi EMAILGEN_ROUTING chưa bật)"""
+    global _router
+    if os.getenv("EMAILGEN_ROUTING", "0") != "1":
+        return None
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(
+                tier_models=_parse_tiers(os.getenv("EMAILGEN_MODEL_TIERS", "")),
+                max_escalations=int(os.getenv("EMAILGEN_ROUTING_MAX_ESCALATIONS", 1)),
+            )
+        return _router
@@ -0,0 +1,321 @@
+"""
+Rule engine cho hậu xử lý. Rule của từng ngôn ngữ nằm trong language pack
+(lang_packs/<code>.json): pattern CTA, pleasantries, soften, audience, câu CTA mẫu,
+gợi ý subject, lời chào...
+
+- Pack chỉ được đọc + compile lần đầu ngôn ngữ đó được dùng (thêm ngôn ngữ không tốn gì cho
+  người dùng ngôn ngữ khác, khởi động không đọc pack nào).
+- Pack đã compile được cache; file đổi (mtime) thì compile lại, không cần restart process.
+  Pack mới bị lỗi → giữ bản cũ đang chạy.
+- Các check chỉ-phát-hiện (CTA, lời mời hẹn lịch) được gộp thành 1 alternation
+  để quét text 1 lần thay vì 1 lần cho mỗi pattern.
+- Rule chạy trên output của model (không tin cậy) nên phải có thời gian chạy tuyến tính theo độ dài text:
+  không dùng wildcard không giới hạn (`.*`, `.*?`) hay 2 quantifier chồng nhau (`\s*\s*`, `\n\s*` đầu pattern);
+  dùng khoảng có giới hạn (`[^\n]{0,80}?`, `\s{0,8}`). benchmarks/bench_pathological.py kiểm tra mọi rule
+  (kể cả pack mới) trên input xấu nhất.
+- Chi phí được chặn bởi pattern tuyến tính + giới hạn độ dài body (email_core.MAX_BODY_CHARS); stage nào vẫn
+  tốn CPU quá ngân sách chỉ được đếm (event rule_budget) để phát hiện pack chậm, output không đổi.
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_LANG_PACKS        = thư mục pack (mặc định lang_packs/ cạnh file này)
+    EMAILGEN_LANG_PACK_RELOAD  = số giây giữa 2 lần kiểm tra file đổi (mặc định 2; < 0 = không reload)
+    EMAILGEN_RULE_BUDGET_MS    = ngân sách CPU mỗi stage rule để đếm vượt (mặc định 250ms; <= 0 = không đo)
+"""
+import os, re, json, time, threading
+
+DEFAULT_LANG = "en"
+PACK_DIR = os.getenv("EMAILGEN_LANG_PACKS") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "lang_packs")
+RELOAD_INTERVAL = float(os.getenv("EMAILGEN_LANG_PACK_RELOAD", 2.0))
+STAGE_BUDGET = float(os.getenv("EMAILGEN_RULE_BUDGET_MS", 250)) / 1000
+
+
+def is_vi(lang: str) -> bool:
+    return str(lang).lower().startswith("vi")
+
+
+def _any_of(patterns: list[str], flags: int = re.IGNORECASE) -> re.Pattern | None:
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns), flags)
+
+
+def _subs(rules: list, flags: int = re.IGNORECASE) -> list[tuple[re.Pattern, str]]:
+    return [(re.compile(p, flags), repl) for p, repl in rules]
+
+
+def _apply(subs: list[tuple[re.Pattern, str]], s: str, stage: str) -> str:
+    """
+    Chạy lần lượt các rule thay thế. Thời gian CPU của thread (không phải wall-clock: tranh GIL khi nhiều
+    request song song không tính) vượt STAGE_BUDGET → đếm event rule_budget; kết quả luôn giữ nguyên
+    """
+    if STAGE_BUDGET <= 0:
+        for pattern, repl in subs:
+            s = pattern.sub(repl, s)
+        return s
+    started = time.thread_time()
+    for pattern, repl in subs:
+        s = pattern.sub(repl, s)
+    if time.thread_time() - started > STAGE_BUDGET:
+        _count("rule_budget", stage)
+    return s
+
+
+# ---- Rule không phụ thuộc ngôn ngữ ----
+
+class _BracketSpan:
+    """
+    Tương đương `\\[.*?kw1.*?kw2.*?\\]` (IGNORECASE; không keyword = `\\[.*?\\]`) nhưng chạy tuyến tính:
+    từ mỗi "[" tìm keyword sớm nhất rồi "]" sớm nhất trong cùng dòng. Không khớp từ 1 "[" thì mọi "["
+    sau đó trong dòng cũng không khớp → nhảy sang dòng sau, thay vì regex quét lại tới cuối dòng cho mỗi "["
+    """
+
+    def __init__(self, *keywords: str):
+        self.keywords = [re.compile(re.escape(k), re.IGNORECASE) for k in keywords]
+        self.pattern = r"\[" + "".join(f".*?{k}" for k in keywords) + r".*?\]"
+
+    def _end(self, text: str, start: int, eol: int) -> int:
+        pos = start + 1
+        for keyword in self.keywords:
+            m = keyword.search(text, pos, eol)
+            if m is None:
+                return -1
+            pos = m.end()
+        end = text.find("]", pos, eol)
+        return end + 1 if end != -1 else -1
+
+    def sub(self, repl: str, text: str) -> str:
+        out, pos = [], 0
+        start = text.find("[")
+        while start != -1:
+            eol = text.find("\n", start)
+            if eol == -1:
+                eol = len(text)
+            end = self._end(text, start, eol)
+            if end == -1:
+                start = text.find("[", eol)
+                continue
+            out += (text[pos:start], repl)
+            pos = end
+            start = text.find("[", end)
+        if not out:
+            return text
+        out.append(text[pos:])
+        return "".join(out)
+
+
+# Xóa placeholder (thứ tự quan trọng: pattern cụ thể trước, generic sau)
+_PLACEHOLDER_SUBS = [
+    (_BracketSpan("link", "biểu mẫu"), ""),
+    (_BracketSpan("địa chỉ", "form"), ""),
+    # Neo ở "[Link" nên không dùng được _BracketSpan; giới hạn độ dài để mỗi "[Link" chỉ quét tối đa 200 ký tự
+    (re.compile(r"\[Link[^\]\n]{0,200}\]", re.IGNORECASE), ""),
+    (_BracketSpan("form"), ""),
+    (_BracketSpan(), ""),
+]
+_DANGLING_LINK_SUBS = [
+    (re.compile(r"tại đây:\s*\.\s*", re.IGNORECASE), ""),
+    (re.compile(r"tại đây\s*:\s*$", re.IGNORECASE | re.MULTILINE), ""),
+    (re.compile(r"here:\s*\.\s*", re.IGNORECASE), ""),
+    (re.compile(r"here\s*:\s*$", re.IGNORECASE | re.MULTILINE), ""),
+]
+_BLANK_LINES = re.compile(r"\n\n+")
+
+
+class LanguageRules:
+    """Bộ matcher đã compile cho 1 ngôn ngữ (từ 1 language pack)"""
+
+    def __init__(self, pack: dict):
+        self.key = pack["code"]
+        self.name = pack.get("name", self.key)
+        self.cta_body = _any_of(pack.get("cta_body", []))
+        self.cta_invite = _any_of(pack.get("cta_invite", []))
+        self.pleasantries = _subs([(p, "\n") for p in pack.get("pleasantries", [])])
+        self.soften = _subs(pack.get("soften", []))
+        self.audience = {aud: _subs(pack.get("audience", {}).get(aud, [])) for aud in ("B2B", "B2C")}
+        self.foreign_cta = _subs([(p, "") for p in pack.get("foreign_cta", [])])
+        greetings = pack.get("greetings", [])
+        self.greeting = re.compile(rf"^({'|'.join(map(re.escape, greetings))})\b", re.IGNORECASE) if greetings else None
+        self.salutation_template = pack.get("salutation", "{name},")
+        self.pronouns = pack.get("pronouns", {})
+        self.cta_templates = pack.get("cta_templates", {})
+        self.subjects = [(tuple(s["match"]), s["suggest"], tuple(s["variants"])) for s in pack.get("subjects", [])]
+        default = pack.get("default_subject", {})
+        self.default_subject = (default.get("suggest", ""), tuple(default.get("variants", ())))
+        self.variable_lines = pack.get("variable_lines", {})
+
+    def has_cta(self, body: str) -> bool:
+        return self.cta_body is not None and self.cta_body.search((body or "").lower()) is not None
+
+    def has_cta_invite(self, body: str) -> bool:
+        return self.cta_invite is not None and self.cta_invite.search((body or "").lower()) is not None
+
+    def trim_pleasantries(self, s: str) -> str:
+        s = _apply(self.pleasantries, s, "trim_pleasantries")
+        # Xóa dòng trống thừa
+        return _BLANK_LINES.sub("\n\n", s)
+
+    def soften_claims(self, s: str) -> str:
+        return _apply(self.soften, s, "soften_claims")
+
+    def tune_audience(self, s: str, audience: str) -> str:
+        # Audience khác B2B được xử lý như B2C (giống logic if/else cũ)
+        return _apply(self.audience["B2B" if audience == "B2B" else "B2C"], s, "tune_audience")
+
+    def strip_foreign_cta(self, body: str) -> str:
+        # Gỡ CTA của ngôn ngữ khác (vd. câu CTA tiếng Anh khi đang viết tiếng Việt)
+        return _apply(self.foreign_cta, body, "strip_foreign_cta")
+
+    def starts_with_greeting(self, body: str) -> bool:
+        return self.greeting is not None and self.greeting.match(body or "") is not None
+
+    def salutation(self, name: str) -> str:
+        return self.salutation_template.format(name=name)
+
+    def cta_line(self, template: str | None, audience: str = "B2B", link: str = "") -> str:
+        """Câu CTA mẫu theo CTA template (không có → "default"); template có/không link"""
+        text = self.cta_templates.get(template) or self.cta_templates.get("default", "")
+        if isinstance(text, dict):
+            text = text["link"] if link else text["no_link"]
+        pronoun = self.pronouns.get("B2B" if audience == "B2B" else "B2C", "")
+        return text.format(pronoun=pronoun, link=link)
+
+    def _subject_entry(self, purpose: str) -> tuple[str, tuple]:
+        p = (purpose or "").lower()
+        for keys, suggest, variants in self.subjects:
+            if any(k in p for k in keys):
+                return suggest, variants
+        return self.default_subject
+
+    def suggest_subject(self, purpose: str) -> str:
+        return self._subject_entry(purpose)[0]
+
+    def subject_variants(self, purpose: str) -> tuple:
+        return self._subject_entry(purpose)[1]
+
+    def variable_line(self, key: str, value: str) -> str:
+        return self.variable_lines.get(key, "{}").format(value)
+
+    def patterns(self) -> list[tuple[str, re.Pattern]]:
+        """Mọi regex đã compile của pack: [(nhãn, pattern)] (cho benchmark input xấu nhất)"""
+        out = [("cta_body", self.cta_body), ("cta_invite", self.cta_invite), ("greeting", self.greeting)]
+        out += [(f"pleasantries[{i}]", p) for i, (p, _) in enumerate(self.pleasantries)]
+        out += [(f"soften[{i}]", p) for i, (p, _) in enumerate(self.soften)]
+        for aud, subs in self.audience.items():
+            out += [(f"audience.{aud}[{i}]", p) for i, (p, _) in enumerate(subs)]
+        out += [(f"foreign_cta[{i}]", p) for i, (p, _) in enumerate(self.foreign_cta)]
+        return [(label, p) for label, p in out if p is not None]
+
+
+# ---- Nạp pack: lazy theo ngôn ngữ, cache theo mtime ----
+
+class _PackEntry:
+    __slots__ = ("rules", "mtime", "checked")
+
+    def __init__(self, rules: LanguageRules, mtime: float):
+        self.rules = rules
+        self.mtime = mtime
+        self.checked = time.monotonic()
+
+
+_packs: dict[str, _PackEntry] = {}
+_pack_errors: dict[str, str] = {}
+_packs_lock = threading.Lock()
+
+
+def _pack_path(code: str) -> str:
+    return os.path.join(PACK_DIR, f"{code}.json")
+
+
+def _count(event: str, outcome: str):
+    # Import muộn: rules được import sớm bởi nhiều module, metrics chỉ cần khi nạp pack / vượt ngân sách
+    from metrics import get_metrics
+
+    get_metrics().count(event, outcome)
+
+
+def _load_pack(code: str) -> _PackEntry:
+    path = _pack_path(code)
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf-8") as f:
+        pack = json.load(f)
+    pack.setdefault("code", code)
+    return _PackEntry(LanguageRules(pack), mtime)
+
+
+def _rules_for(code: str) -> _PackEntry:
+    # Nạp lần đầu hoặc kiểm tra mtime (đã qua RELOAD_INTERVAL kể từ lần kiểm tra trước)
+    with _packs_lock:
+        entry = _packs.get(code)
+        if entry is None:
+            _packs[code] = entry = _load_pack(code)
+            _count("lang_pack", "load")
+            return entry
+        entry.checked = time.monotonic()
+        try:
+            mtime = os.stat(_pack_path(code)).st_mtime
+            if mtime != entry.mtime:
+                _packs[code] = entry = _load_pack(code)
+                _pack_errors.pop(code, None)
+                _count("lang_pack", "reload")
+        except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+            # File đang sửa dở / regex lỗi → tiếp tục dùng bản đã compile
+            _pack_errors[code] = f"{type(e).__name__}: {e}"
+            _count("lang_pack", "error")
+        return entry
+
+
+def available_languages() -> list[str]:
+    """Mã ngôn ngữ có pack (tên file trong PACK_DIR, chưa đọc nội dung)"""
+    try:
+        return sorted(n[:-5] for n in os.listdir(PACK_DIR) if n.endswith(".json"))
+    except OSError:
+        return []
+
+
+def resolve_lang(lang: str) -> str:
+    """
+    Tên ngôn ngữ → mã pack: khớp đúng mã ("vi", "ja") hoặc tên bắt đầu bằng mã
+    ("Vietnamese" → vi, "English" → en, "Japanese" → ja, "zh-CN" → zh); không có pack → DEFAULT_LANG
+    """
+    key = str(lang or "").strip().lower()
+    codes = available_languages()
+    if key in codes:
+        return key
+    for code in codes:
+        if key.startswith(code):
+            return code
+    return DEFAULT_LANG
+
+
+# Tên ngôn ngữ (như caller truyền vào) → pack; hết RELOAD_INTERVAL thì resolve + kiểm tra file lại
+_by_lang: dict[str, _PackEntry] = {}
+
+
+def get_rules(lang: str) -> LanguageRules:
+    entry = _by_lang.get(lang)
+    if entry is not None and (RELOAD_INTERVAL < 0 or time.monotonic() - entry.checked < RELOAD_INTERVAL):
+        return entry.rules
+    entry = _by_lang[lang] = _rules_for(resolve_lang(lang))
+    return entry.rules
+
+
+def pack_stats() -> dict:
+    """Pack đã nạp: {code: {name, mtime, error}}"""
+    with _packs_lock:
+        return {code: {"name": e.rules.name, "mtime": e.mtime, "error": _pack_errors.get(code)}
+                for code, e in _packs.items()}
+
+
+def global_patterns() -> list[tuple[str, re.Pattern | _BracketSpan]]:
+    """Regex không phụ thuộc ngôn ngữ: [(nhãn, pattern)]"""
+    return ([(f"placeholder[{i}]", p) for i, (p, _) in enumerate(_PLACEHOLDER_SUBS)]
+            + [(f"dangling_link[{i}]", p) for i, (p, _) in enumerate(_DANGLING_LINK_SUBS)]
+            + [("blank_lines", _BLANK_LINES)])
+
+
+def clean_placeholders(body: str) -> str:
+    # Không có "[" thì không pattern placeholder nào match được → bỏ qua cả nhóm
+    if "[" in body:
+        body = _apply(_PLACEHOLDER_SUBS, body, "clean_placeholders")
+    body = _apply(_DANGLING_LINK_SUBS, body, "clean_placeholders")
+    return _BLANK_LINES.sub("\n\n", body)
@@ -0,0 +1,330 @@
+"""
+Scheduler dùng chung cả process, đứng trước Gemini client (nhiều session Streamlit cùng 1 quota).
+
+- Weighted fair queuing theo user/session: mỗi request được gắn finish tag
+  max(virtual_time, finish tag trước đó của user) + cost/weight; luôn cho chạy request có tag nhỏ nhất
+  → 1 người bấm Generate liên tục không chặn được người khác
+- Giới hạn số request đang chạy (in flight)
+- Budget tính theo request API: lời gọi đầu của 1 slot tính lúc acquire, mỗi lần gửi thêm dưới slot đó
+  (retry, hedge) tính thêm qua charge() - gemini_client gọi trước mỗi lần gửi (call_charger)
+- Budget theo ngày cho từng user + trần chung cả process (quota API dùng chung, vd. 250/ngày của free tier)
+  + trần thô theo nhóm (tùy chọn, vd. nhiều user chung 1 IP client)
+- Backpressure: hàng đợi có giới hạn; trong lúc chờ, on_wait(position, waited_s) được gọi định kỳ
+- stats(): độ sâu hàng đợi, in flight, thời gian chờ p50/p95/max, số liệu từng user
+
+Request chỉ đi qua scheduler khi caller đã gắn user bằng use_scheduler(); batch/CLI không bị ảnh hưởng.
+Cấu hình qua biến môi trường:
+    EMAILGEN_SCHED_MAX_IN_FLIGHT  = số request chạy đồng thời (mặc định 4)
+    EMAILGEN_SCHED_USER_DAILY     = số request/ngày cho mỗi user, 0 = không giới hạn (mặc định 50)
+    EMAILGEN_SCHED_DAILY          = số request/ngày cho cả process (mọi user), 0 = không giới hạn (mặc định 250)
+    EMAILGEN_SCHED_GROUP_DAILY    = số request/ngày cho mỗi nhóm (app: mỗi IP client), 0 = không giới hạn (mặc định 0)
+    EMAILGEN_SCHED_MAX_QUEUE      = số request chờ tối đa (mặc định 64)
+    EMAILGEN_SCHED_MAX_WAIT       = thời gian chờ tối đa (giây, mặc định 120)
+"""
+import os, time, heapq, itertools, threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+
+
+class SchedulerError(Exception):
+    """Request không được scheduler cho chạy"""
+
+
+class UserQuotaExceeded(SchedulerError):
+    """User đã dùng hết budget trong ngày"""
+
+
+class DailyQuotaExceeded(SchedulerError):
+    """Cả process đã dùng hết quota chung trong ngày"""
+
+
+class QueueFull(SchedulerError):
+    """Hàng đợi đầy"""
+
+
+class QueueTimeout(SchedulerError):
+    """Chờ quá lâu trong hàng đợi"""
+
+
+class Ticket:
+    __slots__ = ("user", "group", "finish", "seq", "enqueued_at", "admitted", "day", "calls")
+
+    def __init__(self, user: str, finish: float, seq: int, group: str | None = None):
+        self.user = user
+        self.group = group
+        self.finish = finish
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.day = date.today()
+        self.calls = 0
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+
+class FairScheduler:
+    def __init__(self, max_in_flight: int = 4, user_daily_budget: int | None = 50,
+                 max_queue: int = 64, max_wait: float | None = 120, poll_interval: float = 0.5,
+                 daily_budget: int | None = None, group_daily_budget: int | None = None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.user_daily_budget = user_daily_budget or None
+        self.daily_budget = daily_budget or None
+        self.group_daily_budget = group_daily_budget or None
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._heap: list[Ticket] = []
+        self._seq = itertools.count()
+        self._vtime = 0.0
+        self._last_finish: dict[str, float] = {}
+        self._in_flight = 0
+        self._user_in_flight = defaultdict(int)
+        self._used: dict[str, int] = defaultdict(int)
+        self._used_total = 0
+        self._group_used: dict[str, int] = defaultdict(int)
+        self._day = date.today()
+        self._waits = deque(maxlen=500)
+        self.counters = {"admitted": 0, "completed": 0, "rejected_quota": 0, "rejected_daily": 0,
+                         "rejected_full": 0, "timeouts": 0, "abandoned": 0,
+                         "extra_calls": 0}
+
+    # ---- Budget theo ngày ----
+    def _roll_day(self):
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._used.clear()
+            self._group_used.clear()
+            self._used_total = 0
+
+    def remaining(self, user: str, group: str | None = None) -> int | None:
+        """Số lượt còn lại hôm nay của user (tính cả trần nhóm, trần chung); None = không giới hạn"""
+        with self._cond:
+            self._roll_day()
+            left = []
+            if self.user_daily_budget is not None:
+                left.append(self.user_daily_budget - self._used[user])
+            if self.group_daily_budget is not None and group is not None:
+                left.append(self.group_daily_budget - self._group_used[group])
+            if self.daily_budget is not None:
+                left.append(self.daily_budget - self._used_total)
+            return max(0, min(left)) if left else None
+
+    # ---- Hàng đợi ----
+    def _position(self, ticket: Ticket) -> int:
+        """Vị trí trong hàng (1 = chạy tiếp theo)"""
+        return 1 + sum(1 for t in self._heap if t < ticket)
+
+    def _dispatch(self):
+        while self._heap and self._in_flight < self.max_in_flight:
+            ticket = heapq.heappop(self._heap)
+            self._vtime = max(self._vtime, ticket.finish)
+            ticket.admitted = True
+            self._in_flight += 1
+            self._user_in_flight[ticket.user] += 1
+            self._waits.append(time.monotonic() - ticket.enqueued_at)
+            self.counters["admitted"] += 1
+        self._cond.notify_all()
+
+    def _release_slot(self, ticket: Ticket):
+        self._in_flight -= 1
+        self._user_in_flight[ticket.user] -= 1
+        if not self._user_in_flight[ticket.user]:
+            del self._user_in_flight[ticket.user]
+
+    def _abandon(self, ticket: Ticket):
+        """Caller bỏ cuộc trước khi gọi model (giữ lock): gỡ ticket khỏi hàng hoặc trả slot, hoàn budget"""
+        if ticket.admitted:
+            self._release_slot(ticket)
+        else:
+            self._heap.remove(ticket)
+            heapq.heapify(self._heap)
+        if ticket.day == self._day:
+            self._used[ticket.user] -= 1
+            self._used_total -= 1
+            if ticket.group is not None:
+                self._group_used[ticket.group] -= 1
+        self._dispatch()
+
+    def acquire(self, user: str, weight: float = 1.0, cost: float = 1.0,
+                timeout: float | None = None, on_wait=None, group: str | None = None) -> Ticket:
+        """
+        Chặn đến khi được chạy; on_wait(position, waited_s) gọi trong thread của caller
+        group: nhóm của user (vd. IP client) cho trần thô group_daily_budget; fair queuing vẫn theo user
+        """
+        timeout = self.max_wait if timeout is None else timeout
+        with self._cond:
+            self._roll_day()
+            if self.user_daily_budget is not None and self._used[user] >= self.user_daily_budget:
+                self.counters["rejected_quota"] += 1
+                raise UserQuotaExceeded(f"Daily budget of {self.user_daily_budget} requests reached for {user}")
+            if (self.group_daily_budget is not None and group is not None
+                    and self._group_used[group] >= self.group_daily_budget):
+                self.counters["rejected_quota"] += 1
+                raise UserQuotaExceeded(f"Daily budget of {self.group_daily_budget} requests reached for {group}")
+            if self.daily_budget is not None and self._used_total >= self.daily_budget:
+                self.counters["rejected_daily"] += 1
+                raise DailyQuotaExceeded(f"Shared daily budget of {self.daily_budget} requests reached")
+            if len(self._heap) >= self.max_queue:
+                self.counters["rejected_full"] += 1
+                raise QueueFull(f"Scheduler queue is full ({self.max_queue} waiting)")
+            start = max(self._vtime, self._last_finish.get(user, 0.0))
+            ticket = Ticket(user, start + cost / max(weight, 1e-6), next(self._seq), group)
+            self._last_finish[user] = ticket.finish
+            self._used[user] += 1
+            self._used_total += 1
+            if group is not None:
+                self._group_used[group] += 1
+            heapq.heappush(self._heap, ticket)
+            self._dispatch()
+
+            deadline = None if timeout is None else ticket.enqueued_at + timeout
+            try:
+                while not ticket.admitted:
+                    if on_wait is not None:
+                        position, waited = self._position(ticket), time.monotonic() - ticket.enqueued_at
+                        # Callback có thể chậm (render UI) → không giữ lock
+                        self._cond.release()
+                        try:
+                            on_wait(position, waited)
+                        finally:
+                            self._cond.acquire()
+                        if ticket.admitted:
+                            break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise QueueTimeout(f"Waited more than {timeout:.0f}s in the scheduler queue")
+                    self._cond.wait(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+            except BaseException as e:
+                # Timeout, hoặc on_wait raise (vd. Streamlit dừng/rerun script khi user bấm nút lúc đang chờ):
+                # chưa gọi model → không để ticket mồ côi trong hàng / giữ slot in flight, hoàn budget
+                if not isinstance(e, QueueTimeout):
+                    self.counters["abandoned"] += 1
+                self._abandon(ticket)
+                raise
+            return ticket
+
+    def charge(self, ticket: Ticket):
+        """
+        Tính 1 request API gửi dưới slot của ticket: request đầu tiên đã tính lúc acquire, mỗi request sau
+        (retry, hedge) tính thêm 1 vào budget của user / nhóm / cả process; hết budget → raise, không gửi
+        """
+        with self._cond:
+            if ticket.calls == 0:
+                ticket.calls = 1
+                return
+            self._roll_day()
+            if self.user_daily_budget is not None and self._used[ticket.user] >= self.user_daily_budget:
+                self.counters["rejected_quota"] += 1
+                raise UserQuotaExceeded(f"Daily budget of {self.user_daily_budget} requests reached for {ticket.user}")
+            if (self.group_daily_budget is not None and ticket.group is not None
+                    and self._group_used[ticket.group] >= self.group_daily_budget):
+                self.counters["rejected_quota"] += 1
+                raise UserQuotaExceeded(f"Daily budget of {self.group_daily_budget} requests reached for {ticket.group}")
+            if self.daily_budget is not None and self._used_total >= self.daily_budget:
+                self.counters["rejected_daily"] += 1
+                raise DailyQuotaExceeded(f"Shared daily budget of {self.daily_budget} requests reached")
+            ticket.calls += 1
+            self._used[ticket.user] += 1
+            self._used_total += 1
+            if ticket.group is not None:
+                self._group_used[ticket.group] += 1
+            self.counters["extra_calls"] += 1
+
+    def release(self, ticket: Ticket):
+        with self._cond:
+            self._release_slot(ticket)
+            self.counters["completed"] += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user: str, weight: float = 1.0, timeout: float | None = None, on_wait=None,
+             group: str | None = None):
+        ticket = self.acquire(user, weight=weight, timeout=timeout, on_wait=on_wait, group=group)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._roll_day()
+            waits = sorted(self._waits)
+
+            def pct(p):
+                return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+
+            queued = defaultdict(int)
+            for t in self._heap:
+                queued[t.user] += 1
+            users = set(queued) | set(self._user_in_flight) | set(self._used)
+            return {
+                **self.counters,
+                "queue_depth": len(self._heap),
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "used_today": self._used_total,
+                "daily_budget": self.daily_budget,
+                "group_daily_budget": self.group_daily_budget,
+                "wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": round(waits[-1] * 1000, 1) if waits else 0.0},
+                "users": {
+                    u: {"queued": queued[u], "in_flight": self._user_in_flight.get(u, 0), "used_today": self._used[u]}
+                    for u in sorted(users)
+                },
+            }
+
+
+_default_scheduler: FairScheduler | None = None
+_default_lock = threading.Lock()
+_current: ContextVar = ContextVar("emailgen_scheduler_user", default=None)
+
+
+def get_scheduler() -> FairScheduler:
+    """Scheduler dùng chung trong process (tạo 1 lần, cấu hình từ biến môi trường)"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = FairScheduler(
+                max_in_flight=int(os.getenv("EMAILGEN_SCHED_MAX_IN_FLIGHT", 4)),
+                user_daily_budget=int(os.getenv("EMAILGEN_SCHED_USER_DAILY", 50)),
+                max_queue=int(os.getenv("EMAILGEN_SCHED_MAX_QUEUE", 64)),
+                max_wait=float(os.getenv("EMAILGEN_SCHED_MAX_WAIT", 120)),
+                daily_budget=int(os.getenv("EMAILGEN_SCHED_DAILY", 250)),
+                group_daily_budget=int(os.getenv("EMAILGEN_SCHED_GROUP_DAILY", 0)),
+            )
+        return _default_scheduler
+
+
+@contextmanager
+def use_scheduler(user: str, weight: float = 1.0, on_wait=None, group: str | None = None):
+    """Mọi lời gọi model trong block này đi qua scheduler dưới tên user (group: trần thô theo nhóm)"""
+    token = _current.set((user, weight, on_wait, group))
+    try:
+        yield get_scheduler()
+    finally:
+        _current.reset(token)
+
+
+def call_charger(ticket: Ticket | None):
+    """before_call cho gemini_client: mỗi request gửi dưới slot của ticket đều tính vào budget (None → không làm gì)"""
+    if ticket is None:
+        return None
+    scheduler = get_scheduler()
+    return lambda: scheduler.charge(ticket)
+
+
+@contextmanager
+def scheduled():
+    """Giữ 1 slot của scheduler nếu caller đã gắn user (use_scheduler), ngược lại không làm gì"""
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    user, weight, on_wait, group = current
+    with get_scheduler().slot(user, weight=weight, on_wait=on_wait, group=group) as ticket:
+        yield ticket
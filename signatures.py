@@ -0,0 +1,222 @@
+"""
+Xử lý signature ở cuối body: chuẩn hóa theo ngôn ngữ, so khớp canonical, xóa/thêm.
+
+SignatureMatcher canonicalize signature 1 lần (cache theo signature) rồi quét ngược
+từ cuối body theo chỉ số dòng - xóa mọi bản sao signature ở cuối trong 1 lượt,
+không cắt/copy lại list dòng ở mỗi vòng lặp.
+"""
+import re
+from functools import lru_cache
+
+from rules import is_vi
+
+_SALUTATIONS = r"(Best regards|Warm regards|Sincerely|Trân trọng)"
+_INLINE_SIG = re.compile(rf"^{_SALUTATIONS},?\s+(.+)$", re.IGNORECASE)
+_INLINE_SIG_MULTILINE = re.compile(rf"^{_SALUTATIONS},?\s+(.+)$", re.IGNORECASE | re.MULTILINE)
+_SALUTATION_PREFIX = re.compile(r"^(Best regards|Trân trọng|Warm regards|Sincerely)", re.IGNORECASE)
+_EN_SALUTATION = re.compile(r"^(Best regards|Warm regards|Sincerely)", re.IGNORECASE)
+_VI_SALUTATION = re.compile(r"^Trân trọng", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=256)
+def normalize_signature_text(sig: str, lang: str) -> str:
+    """
+    Chuẩn hóa signature theo ngôn ngữ
+    LUÔN trả về format: "Salutation,\nName" (xuống hàng)
+    """
+    if not sig or not sig.strip():
+        return ""
+
+    sig = sig.strip()
+    lines = sig.split('\n')
+
+    # Lấy salutation (dòng đầu) và name (phần còn lại)
+    salutation = lines[0].strip() if lines else ""
+    name_part = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ""
+
+    # Nếu chỉ có 1 dòng, cố gắng tách salutation và name
+    if not name_part and salutation:
+        # Pattern: "Best regards, Name" hoặc "Trân trọng, Name"
+        match = _INLINE_SIG.match(salutation)
+        if match:
+            salutation = match.group(1)
+            name_part = match.group(2)
+
+    # Chuẩn hóa salutation theo ngôn ngữ
+    if is_vi(lang):
+        # EN → VI
+        if _EN_SALUTATION.match(salutation):
+            salutation = "Trân trọng"
+        # Giữ nguyên nếu đã là VI
+    else:
+        # VI → EN
+        if _VI_SALUTATION.match(salutation):
+            salutation = "Best regards"
+        # Giữ nguyên nếu đã là EN
+
+    # Trả về format chuẩn: "Salutation,\nName"
+    if name_part:
+        return f"{salutation},\n{name_part}"
+    else:
+        return salutation
+
+
+def get_signature_canonical(sig: str) -> str:
+    """
+    Tạo dạng chuẩn để so sánh (loại bỏ noise nhưng GIỮ CẤU TRÚC)
+    Xử lý cả 2 format: "Salutation, Name" (cùng dòng) và "Salutation,\nName" (xuống dòng)
+    """
+    if not sig:
+        return ""
+
+    sig = sig.strip()
+
+    # Xử lý format cùng dòng: "Best regards, Name" → "Best regards,\nName"
+    sig = _INLINE_SIG_MULTILINE.sub(r'\1,\n\2', sig)
+
+    canonical = []
+    for line in sig.split('\n'):
+        # Chuẩn hóa whitespace
+        line = _WHITESPACE.sub(' ', line.strip())
+
+        # Loại bỏ dấu câu cuối dòng (nhưng GIỮ dấu phẩy sau salutation)
+        if not _SALUTATION_PREFIX.match(line):
+            line = line.rstrip('.,;:')
+
+        # Lowercase để so sánh không phân biệt hoa thường
+        if line:
+            canonical.append(line.lower())
+
+    return '||'.join(canonical)  # Dùng delimiter rõ ràng
+
+
+def _canonicalize_signature_lines(lines: list[str]) -> list[str]:
+    canon = []
+    for line in lines:
+        simplified = _WHITESPACE.sub(" ", line.strip())
+        simplified = simplified.strip(" ,.;:-")
+        if not simplified:
+            continue
+        canon.append(simplified.lower())
+    return canon
+
+
+class SignatureMatcher:
+    """Signature đã canonicalize sẵn, dùng lại cho mọi body"""
+
+    def __init__(self, signature: str):
+        self.signature = signature or ""
+        self.canonical = get_signature_canonical(self.signature)
+        # Số dòng không rỗng của signature = kích thước cửa sổ so khớp ở cuối body
+        self.num_lines = len([l for l in self.signature.strip().split('\n') if l.strip()])
+        sig_lines = [line for line in self.signature.strip().splitlines() if line.strip()]
+        self.dedupe_min_lines = len(sig_lines)
+        self.line_canon = _canonicalize_signature_lines(sig_lines)
+        self.formatted = self.signature.strip()
+
+    def _window_matches(self, lines: list[str], end: int) -> bool:
+        # Chỉ ghép cửa sổ num_lines dòng (không phải cả body) để so canonical
+        return get_signature_canonical('\n'.join(lines[end - self.num_lines:end])) == self.canonical
+
+    def present(self, body: str) -> bool:
+        """Body đã kết thúc bằng signature chưa"""
+        if not body or not self.canonical:
+            return False
+        # rsplit giới hạn: chỉ tách phần đuôi, không tách cả body
+        tail = body.rstrip().rsplit('\n', self.num_lines)
+        if len(tail) < self.num_lines:
+            return False
+        return self._window_matches(tail, len(tail))
+
+    def strip(self, body: str) -> str:
+        """Xóa mọi bản sao signature ở cuối body trong 1 lượt quét ngược"""
+        if not body or not self.signature or not self.canonical:
+            return body
+        lines = body.rstrip().split('\n')
+        end = len(lines)
+        while end >= self.num_lines and self._window_matches(lines, end):
+            end -= self.num_lines
+            # Bỏ dòng trống thừa
+            while end and not lines[end - 1].strip():
+                end -= 1
+        return '\n'.join(lines[:end])
+
+    def dedupe(self, body: str) -> str:
+        """Xóa các block cuối trùng signature (so khớp theo dòng không rỗng)"""
+        if not body or not self.line_canon:
+            return body
+        lines = body.rstrip().splitlines()
+        end = len(lines)
+        need = len(self.line_canon)
+        while end >= self.dedupe_min_lines:
+            # Gom `need` dòng không rỗng cuối cùng (bỏ qua dòng trống)
+            idx, collected = end - 1, []
+            while idx >= 0 and len(collected) < need:
+                if lines[idx].strip():
+                    collected.append(lines[idx])
+                idx -= 1
+            if len(collected) < need:
+                break
+            collected.reverse()
+            if _canonicalize_signature_lines(collected) != self.line_canon:
+                break
+            end = idx + 1
+            while end and not lines[end - 1].strip():
+                end -= 1
+        return "\n".join(lines[:end]).rstrip()
+
+    def append(self, body: str) -> str:
+        """Thêm signature vào cuối body (chỉ khi chưa có)"""
+        if not self.signature:
+            return body
+        if self.present(body):
+            return body
+        # Format chuẩn: body + 2 dòng trống + signature
+        body = body.rstrip()
+        return f"{body}\n\n{self.formatted}" if body else self.formatted
+
+
+@lru_cache(maxsize=64)
+def get_signature_matcher(signature: str) -> SignatureMatcher:
+    return SignatureMatcher(signature)
+
+
+@lru_cache(maxsize=64)
+def signature_matcher_for(signature: str, lang: str) -> SignatureMatcher:
+    """Matcher cho signature đã chuẩn hóa theo ngôn ngữ (cache theo (signature, lang))"""
+    return get_signature_matcher(normalize_signature_text(signature, lang))
+
+
+def dedupe_signature(body: str, normalized_sig: str) -> str:
+    if not body or not normalized_sig:
+        return body
+    return get_signature_matcher(normalized_sig).dedupe(body)
+
+
+def has_signature(body: str, signature: str) -> bool:
+    """
+    Kiểm tra xem body ĐÃ CÓ signature chưa (so sánh canonical)
+    """
+    if not body or not signature:
+        return False
+    return get_signature_matcher(signature).present(body)
+
+
+def remove_signature(body: str, signature: str) -> str:
+    """
+    Xóa signature khỏi body (nếu có) - dùng canonical matching
+    """
+    if not body or not signature:
+        return body
+    return get_signature_matcher(signature).strip(body)
+
+
+def add_signature(body: str, signature: str) -> str:
+    """
+    Thêm signature vào body (CHỈ KHI chưa có)
+    Format: body + 2 dòng trống + signature (với xuống hàng)
+    """
+    if not signature:
+        return body
+    return get_signature_matcher(signature).append(body)
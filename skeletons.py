@@ -0,0 +1,171 @@
+"""
+Skeleton cache cho chiến dịch: gọi model 1 lần cho mỗi cấu hình, cá nhân hóa từng người nhận tại chỗ.
+
+Model được yêu cầu viết 1 email "khung" giữ nguyên các token {{recipient}}, {{order_id}},
+{{delivery_date}}, {{hotline}}, {{meeting_link}} và KHÔNG có lời chào. Với mỗi người nhận:
+build_salutation + interpolate_variables + chuỗi hậu xử lý (postprocess_email) chạy cục bộ.
+
+Key của skeleton = hash(prompt skeleton, temperature) - prompt chỉ phụ thuộc purpose, tone, lang,
+length, CTA, details và tập biến được dùng (không phụ thuộc người nhận / giá trị biến / audience /
+signature) → N người nhận cùng cấu hình chỉ tốn 1 lời gọi model. Các thread cùng key chờ chung
+1 lời gọi (single-flight).
+"""
+import hashlib, threading
+from collections import OrderedDict
+
+from email_core import (
+    MODEL_NAME, PROMPT_VARIANT, TONE_TEMPERATURE, WORDS_BY_LENGTH, build_request_prompt, build_salutation,
+    build_vars_map, call_gemini_json, interpolate_variables, postprocess_email,
+)
+from gemini_client import before_each_call
+from token_usage import token_tags
+
+SKELETON_VARIABLES = ("order_id", "delivery_date", "hotline", "meeting_link")
+
+_SKELETON_RULES = """
+This email is a TEMPLATE reused for many recipients:
+- Do NOT write a greeting/salutation line and do NOT name the recipient; it is added per recipient.
+- Where a value belongs, keep these tokens verbatim (they are filled in later): {tokens}
+""".rstrip()
+
+
+def skeleton_variables(variables: dict | None) -> dict:
+    """Biến cho prompt skeleton: giá trị thật được thay bằng token {{key}}"""
+    variables = variables or {}
+    skeleton = {k: "{{" + k + "}}" for k in SKELETON_VARIABLES if variables.get(k)}
+    skeleton["_cta_template"] = variables.get("_cta_template")
+    return skeleton
+
+
+def build_skeleton_prompt(purpose: str, tone: str, lang: str, details: str = "", length: str = "Trung bình",
+                          require_cta: bool = False, variables: dict | None = None) -> str:
+    skeleton_vars = skeleton_variables(variables)
+    tokens = ", ".join(["{{recipient}}"] + [v for k, v in skeleton_vars.items() if k in SKELETON_VARIABLES])
+    # recipient rỗng → không có salutation line; details giữ nguyên token (không interpolate giá trị thật)
+    prompt = build_request_prompt(purpose, tone, "", details, lang, words=WORDS_BY_LENGTH.get(length, 120),
+                                  require_cta=require_cta, variables=skeleton_vars)
+    return prompt + "\n" + _SKELETON_RULES.format(tokens=tokens)
+
+
+class SkeletonCache:
+    """LRU trong bộ nhớ: key → response JSON của skeleton; 1 lời gọi model cho mỗi key"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._inflight: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get_or_create(self, key: str, create, valid=None) -> dict:
+        """valid(data) False → trả về nhưng không cache (vd. response không phải JSON)"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._entries[key]
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+        with key_lock:
+            # Thread khác có thể vừa tạo xong trong lúc chờ
+            with self._lock:
+                if key in self._entries:
+                    self.counters["hits"] += 1
+                    return self._entries[key]
+            try:
+                data = create()
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+            with self._lock:
+                self.counters["misses"] += 1
+                if valid is None or valid(data):
+                    self._entries[key] = data
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "entries": len(self._entries)}
+
+
+_default_cache = SkeletonCache()
+
+
+def get_skeleton_cache() -> SkeletonCache:
+    return _default_cache
+
+
+def _is_valid_skeleton(data: dict) -> bool:
+    # Response fallback (model không trả JSON) không được dùng lại cho cả chiến dịch
+    return bool(data.get("body")) and data.get("subject") != "Generated Email"
+
+
+def generate_skeleton(purpose: str, tone: str, lang: str, details: str = "", length: str = "Trung bình",
+                      require_cta: bool = False, variables: dict | None = None,
+                      temperature: float | None = None, before_call=None) -> dict:
+    """
+    Skeleton cho 1 cấu hình (cache + single-flight)
+    before_call: gọi ngay trước mỗi request API thật, kể cả retry (vd. rate limiter), không gọi khi trúng cache
+    Trả về {"key", "prompt", "data"}
+    """
+    if temperature is None:
+        temperature = TONE_TEMPERATURE.get(tone, 0.6)
+    prompt = build_skeleton_prompt(purpose, tone, lang, details, length, require_cta, variables)
+    key = hashlib.sha256(f"{MODEL_NAME}\x00{temperature:.3f}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def create():
+        with before_each_call(before_call), token_tags(purpose=purpose, lang=lang, length=length,
+                                                       prompt_variant=PROMPT_VARIANT, skeleton=True):
+            return call_gemini_json(prompt, temperature=temperature)
+
+    data = get_skeleton_cache().get_or_create(key, create, valid=_is_valid_skeleton)
+    return {"key": key, "prompt": prompt, "data": data}
+
+
+def _drop_greeting(body: str) -> str:
+    # Model vẫn viết lời chào có {{recipient}} → bỏ dòng đó, salutation được dựng lại cục bộ
+    lines = body.lstrip().split("\n")
+    if lines and "{{recipient}}" in lines[0]:
+        lines = lines[1:]
+        while lines and not lines[0].strip():
+            lines = lines[1:]
+    return "\n".join(lines)
+
+
+def render_skeleton(data: dict, purpose: str, lang: str, recipient: str = "", signature: str = "",
+                    audience: str = "B2B", require_cta: bool = False,
+                    variables: dict | None = None) -> tuple[str, str]:
+    """Cá nhân hóa skeleton cho 1 người nhận (không gọi model) → (subject, body)"""
+    variables = variables or build_vars_map()
+    fill = {**{k: variables.get(k, "") for k in SKELETON_VARIABLES}, "recipient": (recipient or "").strip()}
+    body = interpolate_variables(_drop_greeting(data.get("body", "")), fill)
+    salutation = build_salutation(recipient, lang)
+    if salutation:
+        body = f"{salutation}\n\n{body}"
+    personalized = {"subject": interpolate_variables(data.get("subject", ""), fill), "body": body}
+    return postprocess_email(personalized, purpose, lang, audience=audience, signature=signature,
+                             require_cta=require_cta, variables=variables)
+
+
+def generate_email_from_skeleton(purpose: str, tone: str, lang: str, recipient: str = "", details: str = "",
+                                 signature: str = "", audience: str = "B2B", length: str = "Trung bình",
+                                 require_cta: bool = False, variables: dict | None = None,
+                                 temperature: float | None = None, before_call=None) -> dict:
+    """
+    Như generate_email nhưng dùng skeleton chung cho cấu hình → chỉ gọi model ở người nhận đầu tiên
+    Trả về dict như generate_email + "skeleton_key"
+    """
+    variables = variables or build_vars_map()
+    skeleton = generate_skeleton(purpose, tone, lang, details, length, require_cta, variables,
+                                 temperature=temperature, before_call=before_call)
+    subject, body = render_skeleton(skeleton["data"], purpose, lang, recipient=recipient, signature=signature,
+                                    audience=audience, require_cta=require_cta, variables=variables)
+    return {
+        "subject": subject,
+        "body": body,
+        "subject_raw": skeleton["data"].get("subject", ""),
+        "prompt": skeleton["prompt"],
+        "data": skeleton["data"],
+        "skeleton_key": skeleton["key"],
+    }
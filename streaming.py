@@ -0,0 +1,149 @@
+"""
+Parser JSON tăng dần cho response dạng {"subject": "...", "body": "..."} khi stream.
+Mỗi lần feed() chỉ xử lý phần text mới nhận, trả về giá trị (có thể chưa hoàn chỉnh)
+của các field string đã thấy.
+"""
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# Trạng thái
+_BEFORE_OBJECT, _SEEK_KEY, _IN_KEY, _SEEK_COLON, _SEEK_VALUE, _IN_VALUE, _SKIP_VALUE, _DONE = range(8)
+
+
+class PartialEmailParser:
+    def __init__(self):
+        self.fields: dict[str, str] = {}
+        self._state = _BEFORE_OBJECT
+        self._key: list[str] = []
+        self._value: list[str] = []
+        self._current_key = ""
+        self._escape = False
+        self._unicode: str | None = None   # đang đọc \uXXXX
+        self._high_surrogate: int | None = None
+        # Bỏ qua giá trị không phải string: độ sâu {}/[] và trạng thái chuỗi lồng bên trong
+        self._skip_depth = 0
+        self._skip_in_string = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    @property
+    def subject(self) -> str:
+        return self.fields.get("subject", "")
+
+    @property
+    def body(self) -> str:
+        return self.fields.get("body", "")
+
+    def _emit_char(self, ch: str):
+        code = ord(ch)
+        if self._high_surrogate is not None:
+            high, self._high_surrogate = self._high_surrogate, None
+            if 0xDC00 <= code <= 0xDFFF:
+                ch = chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00))
+            else:
+                self._value.append(chr(high))
+        elif 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+            return
+        self._value.append(ch)
+
+    def _read_string_char(self, ch: str, buf_is_key: bool) -> bool:
+        """Xử lý 1 ký tự trong chuỗi JSON; trả về True khi gặp dấu " đóng chuỗi"""
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) == 4:
+                try:
+                    decoded = chr(int(self._unicode, 16))
+                except ValueError:
+                    decoded = ""
+                self._unicode = None
+                if buf_is_key:
+                    self._key.append(decoded)
+                elif decoded:
+                    self._emit_char(decoded)
+            return False
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = ""
+                return False
+            decoded = _ESCAPES.get(ch, ch)
+        elif ch == "\\":
+            self._escape = True
+            return False
+        elif ch == '"':
+            return True
+        else:
+            decoded = ch
+        if buf_is_key:
+            self._key.append(decoded)
+        else:
+            self._emit_char(decoded)
+        return False
+
+    def feed(self, chunk: str) -> dict[str, str]:
+        for ch in chunk or "":
+            state = self._state
+            if state == _DONE:
+                break
+            if state == _BEFORE_OBJECT:
+                # Bỏ qua code fence / text thừa trước "{"
+                if ch == "{":
+                    self._state = _SEEK_KEY
+            elif state == _SEEK_KEY:
+                if ch == '"':
+                    self._key = []
+                    self._state = _IN_KEY
+                elif ch == "}":
+                    self._state = _DONE
+            elif state == _IN_KEY:
+                if self._read_string_char(ch, buf_is_key=True):
+                    self._current_key = "".join(self._key)
+                    self._state = _SEEK_COLON
+            elif state == _SEEK_COLON:
+                if ch == ":":
+                    self._state = _SEEK_VALUE
+            elif state == _SEEK_VALUE:
+                if ch == '"':
+                    self._value = []
+                    self.fields[self._current_key] = ""
+                    self._state = _IN_VALUE
+                elif not ch.isspace():
+                    self._skip_depth = 1 if ch in "{[" else 0
+                    self._skip_in_string = False
+                    self._escape = False
+                    self._state = _SKIP_VALUE
+            elif state == _IN_VALUE:
+                if self._read_string_char(ch, buf_is_key=False):
+                    if self._high_surrogate is not None:
+                        self._value.append(chr(self._high_surrogate))
+                        self._high_surrogate = None
+                    self.fields[self._current_key] = "".join(self._value)
+                    self._state = _SEEK_KEY
+            elif state == _SKIP_VALUE:
+                # Giá trị không phải string (number, null, object, array...) - bỏ qua tới "," / "}" ở cấp ngoài cùng;
+                # "," "}" "]" nằm trong object/array/chuỗi lồng không kết thúc giá trị
+                if self._skip_in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == "\\":
+                        self._escape = True
+                    elif ch == '"':
+                        self._skip_in_string = False
+                elif ch == '"':
+                    self._skip_in_string = True
+                elif ch in "{[":
+                    self._skip_depth += 1
+                elif self._skip_depth:
+                    if ch in "}]":
+                        self._skip_depth -= 1
+                elif ch == ",":
+                    self._state = _SEEK_KEY
+                elif ch == "}":
+                    self._state = _DONE
+
+        if self._state == _IN_VALUE:
+            self.fields[self._current_key] = "".join(self._value)
+        return self.fields
@@ -1,15 +1,15 @@
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
+import gemini_client
 
 # Load .env
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 assert api_key, "Missing GEMINI_API_KEY in .env"
 
-# Cấu hình Gemini
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel("gemini-1.5-flash")  # nhanh, rẻ; có thể đổi sang 1.5-pro nếu muốn
+# Cấu hình Gemini (client dùng chung: timeout + retry/backoff)
+gemini_client.configure(api_key)
+MODEL_NAME = "gemini-1.5-flash"  # nhanh, rẻ; có thể đổi sang 1.5-pro nếu muốn
 
 # Prompt test: viết email xin nghỉ phép
 prompt = """You are an assistant that writes concise, professional business emails in English.
@@ -19,5 +19,4 @@ Subject: ...
 Body:
 ..."""
 
-resp = model.generate_content(prompt)
-print(resp.text.strip())
+print(gemini_client.generate_text(prompt, MODEL_NAME))
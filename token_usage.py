@@ -0,0 +1,136 @@
+"""
+Đếm token cho mọi lời gọi Gemini.
+
+Lấy số token từ usage metadata của response (prompt_token_count / candidates_token_count);
+thiếu metadata thì ước lượng cục bộ bằng estimate_tokens(). Mỗi lời gọi được gắn tag
+(purpose, lang, length, prompt_variant...) qua token_tags() để làm báo cáo theo nhóm.
+
+Cấu hình qua biến môi trường:
+    EMAILGEN_TOKEN_LOG  = file JSONL ghi từng lời gọi (mặc định .cache/token_usage.jsonl, rỗng = chỉ giữ trong bộ nhớ)
+
+Báo cáo: python tools/token_report.py
+"""
+import os, json, time, threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_tags: ContextVar = ContextVar("emailgen_token_tags", default=None)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Ước lượng số token khi response không có usage metadata
+    ~4 ký tự ASCII / token; ký tự có dấu (tiếng Việt) tách token dày hơn, ~2 ký tự / token
+    """
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return max(1, round((len(text) - non_ascii) / 4 + non_ascii / 2))
+
+
+def usage_counts(usage) -> tuple[int, int] | None:
+    """(prompt tokens, output tokens) từ usage_metadata của SDK/REST, None nếu không có"""
+    if usage is None:
+        return None
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    output_tokens = getattr(usage, "candidates_token_count", None)
+    if not prompt_tokens:
+        return None
+    return int(prompt_tokens), int(output_tokens or 0)
+
+
+@contextmanager
+def token_tags(**tags):
+    """Gắn tag cho mọi lời gọi model trong block (gộp với tag bên ngoài)"""
+    token = _tags.set({**(_tags.get() or {}), **tags})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+class TokenLedger:
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._groups: dict[tuple, dict] = defaultdict(
+            lambda: {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "estimated": 0})
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def record(self, prompt_tokens: int, output_tokens: int, estimated: bool, tags: dict | None = None):
+        tags = tags or {}
+        entry = {"ts": round(time.time(), 3), **tags, "prompt_tokens": prompt_tokens,
+                 "output_tokens": output_tokens, "estimated": estimated}
+        with self._lock:
+            group = self._groups[tuple(sorted(tags.items()))]
+            group["calls"] += 1
+            group["prompt_tokens"] += prompt_tokens
+            group["output_tokens"] += output_tokens
+            group["estimated"] += int(estimated)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+    def summary(self) -> dict:
+        """Tổng số token trong process (từ lúc khởi động)"""
+        with self._lock:
+            calls = sum(g["calls"] for g in self._groups.values())
+            prompt_tokens = sum(g["prompt_tokens"] for g in self._groups.values())
+            output_tokens = sum(g["output_tokens"] for g in self._groups.values())
+            estimated = sum(g["estimated"] for g in self._groups.values())
+        return {
+            "calls": calls,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "avg_prompt_tokens": round(prompt_tokens / calls, 1) if calls else 0.0,
+            "avg_output_tokens": round(output_tokens / calls, 1) if calls else 0.0,
+            "estimated_calls": estimated,
+        }
+
+
+def aggregate(entries, group_by=("purpose", "lang", "length")) -> list[dict]:
+    """Gộp các entry (dict như TokenLedger.record trả về) theo các tag trong group_by"""
+    groups: dict[tuple, dict] = {}
+    for e in entries:
+        key = tuple(e.get(k, "") for k in group_by)
+        g = groups.setdefault(key, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "estimated": 0})
+        g["calls"] += 1
+        g["prompt_tokens"] += int(e.get("prompt_tokens") or 0)
+        g["output_tokens"] += int(e.get("output_tokens") or 0)
+        g["estimated"] += int(bool(e.get("estimated")))
+    rows = []
+    for key, g in sorted(groups.items(), key=lambda kv: -kv[1]["prompt_tokens"]):
+        rows.append({
+            **dict(zip(group_by, key)),
+            **g,
+            "avg_prompt_tokens": round(g["prompt_tokens"] / g["calls"], 1),
+            "avg_output_tokens": round(g["output_tokens"] / g["calls"], 1),
+        })
+    return rows
+
+
+_default_ledger: TokenLedger | None = None
+_default_lock = threading.Lock()
+
+
+def get_token_ledger() -> TokenLedger:
+    """Ledger dùng chung trong process (tạo 1 lần, cấu hình từ biến môi trường)"""
+    global _default_ledger
+    with _default_lock:
+        if _default_ledger is None:
+            _default_ledger = TokenLedger(
+                os.getenv("EMAILGEN_TOKEN_LOG", os.path.join(".cache", "token_usage.jsonl")) or None)
+        return _default_ledger
+
+
+def record_call(prompt: str, text: str, usage=None) -> dict:
+    """Ghi 1 lời gọi model: dùng usage metadata nếu có, ngược lại ước lượng"""
+    counts = usage_counts(usage)
+    if counts is None:
+        counts, estimated = (estimate_tokens(prompt), estimate_tokens(text)), True
+    else:
+        estimated = False
+    return get_token_ledger().record(counts[0], counts[1], estimated, _tags.get())
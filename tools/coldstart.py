@@ -0,0 +1,69 @@
+"""
+Đo cold start của các entry point CLI/worker (mỗi lần chạy là 1 process Python mới)
+và kiểm tra ngân sách thời gian + danh sách module nặng không được import sớm.
+
+    python tools/coldstart.py            # exit code 1 nếu vượt ngân sách
+    python tools/coldstart.py --runs 20
+"""
+import os, sys, json, argparse, statistics, subprocess, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Ngân sách (ms) tính THÊM so với lúc khởi động interpreter rỗng (`python -c pass`)
+BUDGETS_MS = {
+    "import email_core": 60,
+    "batch.py --help": 100,
+}
+ENTRY_POINTS = {
+    "import email_core": ["-c", "import email_core"],
+    "batch.py --help": ["batch.py", "--help"],
+}
+# Module không được xuất hiện sau khi import lõi (chỉ load khi thực sự gọi Gemini / chạy UI)
+HEAVY_MODULES = ["streamlit", "google.generativeai", "google.api_core", "grpc",
+                 "urllib.request", "sqlite3", "concurrent.futures"]
+
+
+def time_process(args: list[str], runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def heavy_modules_loaded() -> list[str]:
+    code = ("import sys, json, email_core; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start budget check for CLI/worker entry points")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    baseline = time_process(["-c", "pass"], args.runs)
+    print(f"{'interpreter baseline':<24} {baseline:8.1f} ms")
+    failed = False
+    for name, cmd in ENTRY_POINTS.items():
+        extra = time_process(cmd, args.runs) - baseline
+        budget = BUDGETS_MS[name]
+        status = "ok" if extra <= budget else "OVER BUDGET"
+        failed |= extra > budget
+        print(f"{name:<24} {extra:+8.1f} ms  (budget {budget} ms)  {status}")
+
+    loaded = heavy_modules_loaded()
+    if loaded:
+        failed = True
+        print(f"Heavy modules imported by email_core: {', '.join(loaded)}")
+    else:
+        print("No heavy modules imported by email_core")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
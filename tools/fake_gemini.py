@@ -0,0 +1,237 @@
+"""
+Server giả lập Gemini REST API (không tốn quota, không cần network) để load-test.
+
+Hỗ trợ:
+    POST /v1beta/models/{model}:generateContent
+    POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+Prompt yêu cầu nhiều phương án ("Write N distinct variants") → trả {"variants": [...]}.
+
+Cấu hình latency, tỉ lệ lỗi và tỉ lệ các loại response:
+    json       - JSON hợp lệ
+    fenced     - JSON bọc trong ```json ... ```       (decoder bỏ fence → outcome "recovered")
+    prose      - có câu dẫn/giải thích quanh JSON     (decoder bỏ câu dẫn → outcome "recovered")
+    broken     - dạng "Subject: ...\nBody: ..."       (không phải JSON → outcome "labeled")
+Khi request có generationConfig.responseMimeType = "application/json" (structured output),
+fenced/prose trả JSON sạch như API thật; broken thành JSON bị cắt giữa chừng (như MAX_TOKENS).
+
+    python tools/fake_gemini.py --port 8765 --latency-ms 800 --jitter-ms 400 \\
+        --error-rate 0.05 --mix json=80,fenced=10,prose=5,broken=5
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8765 streamlit run app.py
+"""
+import re, json, time, random, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+CANNED = {
+    "vi": [
+        {"subject": "Mời demo giải pháp quản lý bán hàng",
+         "body": "Kính gửi anh Minh,\n\nHy vọng anh có một ngày tốt lành.\n\nChúng tôi xin giới thiệu phần mềm "
+                 "quản lý bán hàng giúp doanh nghiệp anh tiết kiệm lên đến 30% thời gian xử lý đơn hàng. "
+                 "Anh có thể xem thêm tại [Link tài liệu].\n\nAnh có thể cho tôi biết thời gian phù hợp để "
+                 "trao đổi ngắn 15–20 phút trong tuần tới không?\n\nTrân trọng,\nPhuoc Doan"},
+        {"subject": "Thư xin lỗi về việc giao hàng trễ",
+         "body": "Kính gửi chị Lan,\n\nChúng tôi thành thật xin lỗi vì đơn hàng của chị được giao trễ 2 ngày. "
+                 "Để bù đắp, chúng tôi xin gửi tặng chị voucher 10% cho lần mua tiếp theo.\n\n"
+                 "Hy vọng chị sẽ tiếp tục ủng hộ chúng tôi."},
+    ],
+    "en": [
+        {"subject": "Project status update",
+         "body": "Dear Sarah,\n\nI hope this email finds you well.\n\nMilestone 1 is done, Milestone 2 is in QA "
+                 "and Milestone 3 is expected by Friday.\n\nPlease reply to confirm the review slot.\n\n"
+                 "Best regards,\nPhuoc Doan"},
+        {"subject": "Quick 15-20 min demo next week?",
+         "body": "Dear Alex,\n\nOur platform helps your team cut order handling time by up to 20%. "
+                 "Would you be open to a quick 15-min demo next week? Book here: [Link to calendar]."},
+    ],
+}
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            kind, weight = item.split("=", 1)
+            mix[kind.strip()] = float(weight)
+    return mix or {"json": 1.0}
+
+
+class FakeGeminiConfig:
+    def __init__(self, latency_ms: float = 500, jitter_ms: float = 200, distribution: str = "lognormal",
+                 error_rate: float = 0.0, mix: dict | None = None, chunk_chars: int = 40, seed: int | None = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.mix = mix or {"json": 1.0}
+        self.chunk_chars = chunk_chars
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, **{k: 0 for k in self.mix}}
+
+    def sample_latency(self) -> float:
+        with self.lock:
+            if self.distribution == "fixed":
+                ms = self.latency_ms
+            elif self.distribution == "uniform":
+                ms = self.rng.uniform(self.latency_ms - self.jitter_ms, self.latency_ms + self.jitter_ms)
+            else:
+                # lognormal: median = latency_ms, đuôi dài điều chỉnh theo jitter_ms
+                sigma = max(self.jitter_ms, 1) / max(self.latency_ms, 1)
+                ms = self.latency_ms * self.rng.lognormvariate(0, sigma)
+        return max(0.0, ms) / 1000
+
+    def pick_outcome(self) -> tuple[bool, str]:
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.rng.random() < self.error_rate:
+                self.counters["errors"] += 1
+                return True, ""
+            kind = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            self.counters[kind] += 1
+            return False, kind
+
+
+def render_text(kind: str, prompt: str, rng: random.Random, structured: bool = False) -> str:
+    lang = "vi" if "Language: Vietnamese" in prompt else "en"
+    email = rng.choice(CANNED[lang])
+    payload = json.dumps(email, ensure_ascii=False)
+    n_variants = re.search(r"Write (\d+) distinct variants", prompt)
+    if n_variants:
+        variants = [dict(rng.choice(CANNED[lang])) for _ in range(int(n_variants.group(1)))]
+        payload = json.dumps({"variants": variants}, ensure_ascii=False)
+    if structured:
+        return payload[:len(payload) // 2] if kind == "broken" else payload
+    if kind == "fenced":
+        return f"```json\n{payload}\n```"
+    if kind == "prose":
+        return f"Here is the email you asked for:\n{payload}\nLet me know if you need changes."
+    if kind == "broken":
+        return f"Subject: {email['subject']}\nBody:\n{email['body']}"
+    return payload
+
+
+def _usage(prompt: str, text: str) -> dict:
+    # Xấp xỉ tokenizer: ~4 ký tự / token
+    prompt_tokens, output_tokens = max(1, len(prompt) // 4), max(1, len(text) // 4)
+    return {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens}
+
+
+def _candidate(text: str, finish: str | None = "STOP", usage: dict | None = None) -> dict:
+    cand = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish:
+        cand["finishReason"] = finish
+    payload = {"candidates": [cand]}
+    if usage:
+        payload["usageMetadata"] = usage
+    return payload
+
+
+def make_handler(config: FakeGeminiConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, payload: dict):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/stats":
+                with config.lock:
+                    return self._send_json(200, dict(config.counters))
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+                prompt = "".join(p.get("text", "") for c in body.get("contents", []) for p in c.get("parts", []))
+                structured = (body.get("generationConfig") or {}).get("responseMimeType") == "application/json"
+            except ValueError:
+                return self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON",
+                                                       "status": "INVALID_ARGUMENT"}})
+            if not path.startswith("/v1beta/models/"):
+                return self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+            time.sleep(config.sample_latency())
+            is_error, kind = config.pick_outcome()
+            if is_error:
+                code = config.rng.choice([429, 503])
+                status = "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"
+                return self._send_json(code, {"error": {"code": code, "message": "Simulated error", "status": status}})
+
+            text = render_text(kind, prompt, config.rng, structured)
+            if path.endswith(":streamGenerateContent"):
+                return self._stream(text, _usage(prompt, text))
+            self._send_json(200, _candidate(text, usage=_usage(prompt, text)))
+
+        def _stream(self, text: str, usage: dict):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            step = max(1, config.chunk_chars)
+            pieces = [text[i:i + step] for i in range(0, len(text), step)]
+            for i, piece in enumerate(pieces):
+                last = i == len(pieces) - 1
+                chunk = _candidate(piece, "STOP" if last else None, usage if last else None)
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+                                 .encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(0.02)
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(config: FakeGeminiConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Chạy server trong thread nền; port=0 để OS chọn port trống (xem server.server_address)"""
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    server.fake_config = config
+    threading.Thread(target=server.serve_forever, daemon=True, name="fake-gemini").start()
+    return server
+
+
+def add_config_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=500, help="Latency trung vị (ms)")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="Độ dao động latency (ms)")
+    parser.add_argument("--distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ trả 429/503 (0-1)")
+    parser.add_argument("--mix", default="json=85,fenced=5,prose=5,broken=5",
+                        help="Tỉ lệ loại response: json,fenced,prose,broken")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args) -> FakeGeminiConfig:
+    return FakeGeminiConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            distribution=args.distribution, error_rate=args.error_rate,
+                            mix=parse_mix(args.mix), seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Gemini stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_args(parser)
+    args = parser.parse_args(argv)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config_from_args(args)))
+    server.daemon_threads = True
+    print(f"Fake Gemini listening on http://{args.host}:{args.port} (GET /stats for counters)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Load driver: chạy trọn pipeline generate (prompt → Gemini → hậu xử lý) với N user đồng thời
+và báo cáo p50/p95/p99 latency, throughput, số lỗi.
+
+Mặc định tự bật server giả lập (tools/fake_gemini.py) trong process → không tốn quota:
+    python tools/loadtest.py --users 20 --requests 500 --latency-ms 800 --error-rate 0.05
+Trỏ tới endpoint có sẵn:
+    python tools/loadtest.py --endpoint http://127.0.0.1:8765 --users 50 --duration 60
+"""
+import os, sys, json, time, random, argparse, threading
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gemini_client  # noqa: E402
+from cache import get_response_cache  # noqa: E402
+from email_core import generate_email, stream_generate_email  # noqa: E402
+from fake_gemini import add_config_args, config_from_args, start_server  # noqa: E402
+from token_usage import get_token_ledger  # noqa: E402
+from metrics import get_metrics  # noqa: E402
+from routing import get_router  # noqa: E402
+
+SCENARIOS = [
+    {"purpose": "Sales outreach / Chào hàng", "tone": "Friendly", "lang": "Vietnamese", "audience": "B2B",
+     "length": "Trung bình", "recipient": "Nguyễn Văn A", "require_cta": True,
+     "details": "Giới thiệu phần mềm quản lý bán hàng; đề nghị demo 15–20 phút trong tuần tới."},
+    {"purpose": "Customer reply / Phản hồi khách hàng", "tone": "Apologetic", "lang": "Vietnamese",
+     "audience": "B2C", "length": "Ngắn", "recipient": "Chị Lan",
+     "details": "Xin lỗi khách hàng vì giao hàng trễ 2 ngày; tặng voucher 10% cho lần sau."},
+    {"purpose": "Status update / Cập nhật tiến độ", "tone": "Formal", "lang": "English", "audience": "B2B",
+     "length": "Trung bình", "recipient": "Sarah",
+     "details": "Milestone 1 done, Milestone 2 in QA, Milestone 3 expected by Friday."},
+    {"purpose": "Partnership inquiry / Hợp tác", "tone": "Formal", "lang": "English", "audience": "B2B",
+     "length": "Chi tiết", "recipient": "Sarah Johnson", "require_cta": True,
+     "details": "Explore collaboration on AI solutions for your Southeast Asia expansion."},
+]
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.errors = Counter()
+        self.fallback_subjects = 0
+
+    def record(self, latency: float, error: str | None = None, fallback: bool = False):
+        with self.lock:
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            if fallback:
+                self.fallback_subjects += 1
+
+    def report(self, wall_s: float) -> dict:
+        lat = sorted(self.latencies)
+        total = len(lat)
+        failed = sum(self.errors.values())
+        return {
+            "requests": total,
+            "ok": total - failed,
+            "errors": dict(self.errors),
+            "decode_fallbacks": self.fallback_subjects,
+            "wall_s": round(wall_s, 2),
+            "throughput_rps": round(total / wall_s, 2) if wall_s else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(lat, 50) * 1000, 1),
+                "p95": round(percentile(lat, 95) * 1000, 1),
+                "p99": round(percentile(lat, 99) * 1000, 1),
+                "max": round(lat[-1] * 1000, 1) if lat else 0.0,
+            },
+        }
+
+
+def user_loop(user_id: int, stats: LoadStats, stop_at: float | None, budget: list[int],
+              budget_lock: threading.Lock, unique: bool, stream: bool):
+    rng = random.Random(user_id)
+    while True:
+        if stop_at is not None and time.monotonic() >= stop_at:
+            return
+        with budget_lock:
+            if budget[0] <= 0:
+                return
+            budget[0] -= 1
+            seq = budget[0]
+        scenario = dict(rng.choice(SCENARIOS))
+        if unique:
+            # Details khác nhau → prompt khác nhau → không trúng cache
+            scenario["details"] += f" (ref #{user_id}-{seq})"
+        started = time.perf_counter()
+        try:
+            if stream:
+                result = None
+                for kind, payload in stream_generate_email(signature="Best regards,\nPhuoc Doan", **scenario):
+                    if kind == "result":
+                        result = payload
+            else:
+                result = generate_email(signature="Best regards,\nPhuoc Doan", **scenario)
+            stats.record(time.perf_counter() - started,
+                         fallback=result["subject_raw"] == "Generated Email")
+        except Exception as e:
+            stats.record(time.perf_counter() - started, error=type(e).__name__)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test for the generate pipeline")
+    parser.add_argument("--endpoint", help="Endpoint có sẵn; bỏ trống để tự bật server giả lập")
+    parser.add_argument("--users", type=int, default=10, help="Số user đồng thời")
+    parser.add_argument("--requests", type=int, default=200, help="Tổng số request")
+    parser.add_argument("--duration", type=float, default=None, help="Giới hạn thời gian chạy (giây)")
+    parser.add_argument("--unique-prompts", action="store_true", help="Mỗi request 1 prompt khác (bỏ qua cache)")
+    parser.add_argument("--no-cache", action="store_true", help="Tắt response cache")
+    parser.add_argument("--stream", action="store_true", help="Dùng streaming generate")
+    parser.add_argument("--json", help="Ghi báo cáo ra file JSON")
+    add_config_args(parser)
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.endpoint:
+        endpoint = args.endpoint
+    else:
+        server = start_server(config_from_args(args))
+        endpoint = "http://%s:%d" % server.server_address[:2]
+    os.environ["GEMINI_API_ENDPOINT"] = endpoint
+    os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+    # Cache chỉ trong bộ nhớ để không ghi vào cache trên đĩa của app
+    os.environ.setdefault("EMAILGEN_CACHE_PATH", "")
+    os.environ.setdefault("EMAILGEN_TOKEN_LOG", "")
+    if args.no_cache:
+        os.environ["EMAILGEN_CACHE"] = "0"
+
+    gemini_client.configure(os.environ["GEMINI_API_KEY"])
+
+    stats = LoadStats()
+    budget, budget_lock = [args.requests], threading.Lock()
+    stop_at = time.monotonic() + args.duration if args.duration else None
+    print(f"Load test → {endpoint}: {args.users} users, {args.requests} requests", flush=True)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user_loop, args=(i, stats, stop_at, budget, budget_lock,
+                                                        args.unique_prompts, args.stream))
+               for i in range(args.users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    report = stats.report(time.perf_counter() - started)
+
+    report["tokens"] = get_token_ledger().summary()
+    report["stages"] = get_metrics().summary()
+    report["json_decode"] = get_metrics().events().get("json_decode", {})
+    report["repair"] = get_metrics().events().get("repair", {})
+    if gemini_client.get_hedge_policy() is not None:
+        report["hedge"] = gemini_client.get_hedge_policy().stats()
+    if get_router() is not None:
+        report["routing"] = get_router().stats()
+    cache = get_response_cache()
+    if cache is not None:
+        report["cache"] = cache.stats()
+    if server is not None:
+        with server.fake_config.lock:
+            report["server"] = dict(server.fake_config.counters)
+        server.shutdown()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
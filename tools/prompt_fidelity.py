@@ -0,0 +1,129 @@
+"""
+So sánh biến thể prompt "compact" với prompt "full" hiện tại: số input token và độ tuân thủ
+ràng buộc của output (JSON hợp lệ, subject ≤ 60 ký tự, độ dài body, CTA, không signature,
+không placeholder, salutation đúng).
+
+Chỉ đếm token (offline, không gọi model):
+    python tools/prompt_fidelity.py --offline
+Chạy thật (mỗi scenario × mỗi biến thể × --runs lần; cache bị bỏ qua):
+    python tools/prompt_fidelity.py --runs 5
+    python tools/prompt_fidelity.py --fake     # server giả lập: chỉ kiểm tra đường chạy, output là mẫu cố định
+Exit code 1 khi compact kém full quá --tolerance ở bất kỳ tiêu chí nào.
+"""
+import os, re, sys, json, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gemini_client  # noqa: E402
+from email_core import (  # noqa: E402
+    PROMPT_BUILDERS, TONE_TEMPERATURE, WORDS_BY_LENGTH, build_request_prompt, build_salutation,
+    build_vars_map, call_gemini_json, has_cta_in_body,
+)
+from loadtest import SCENARIOS  # noqa: E402
+from token_usage import estimate_tokens, get_token_ledger, token_tags  # noqa: E402
+
+_CLOSING = re.compile(r"^(Best regards|Warm regards|Sincerely|Regards|Trân trọng)\b", re.IGNORECASE | re.MULTILINE)
+CHECKS = ("json_ok", "subject_len", "body_length", "cta", "no_signature", "no_placeholder", "salutation")
+
+
+def check_output(data: dict, scenario: dict) -> dict:
+    subject = (data.get("subject") or "").strip()
+    body = (data.get("body") or "").strip()
+    target = WORDS_BY_LENGTH.get(scenario.get("length", "Trung bình"), 120)
+    salutation = build_salutation(scenario.get("recipient", ""), scenario["lang"])
+    return {
+        "json_ok": bool(subject) and subject != "Generated Email",
+        "subject_len": 0 < len(subject) <= 60,
+        "body_length": 0.6 * target <= len(body.split()) <= 1.4 * target,
+        "cta": has_cta_in_body(body, scenario["lang"]) == bool(scenario.get("require_cta")),
+        "no_signature": not _CLOSING.search("\n".join(body.splitlines()[-3:])),
+        "no_placeholder": "[" not in body,
+        "salutation": not salutation or body.startswith(salutation),
+    }
+
+
+def prompt_for(scenario: dict, variant: str) -> str:
+    return build_request_prompt(
+        scenario["purpose"], scenario["tone"], scenario.get("recipient", ""), scenario["details"],
+        scenario["lang"], words=WORDS_BY_LENGTH.get(scenario.get("length"), 120),
+        require_cta=scenario.get("require_cta", False),
+        variables=build_vars_map(hotline="1900 1234"), prompt_variant=variant,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare compact vs full prompt: tokens and output fidelity")
+    parser.add_argument("--runs", type=int, default=3, help="Số lần gọi cho mỗi scenario × biến thể")
+    parser.add_argument("--offline", action="store_true", help="Chỉ so số input token (không gọi model)")
+    parser.add_argument("--fake", action="store_true", help="Dùng server giả lập tools/fake_gemini.py")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Mức tụt pass rate tối đa cho phép")
+    parser.add_argument("--json", help="Ghi báo cáo ra file JSON")
+    args = parser.parse_args(argv)
+
+    variants = list(PROMPT_BUILDERS)
+    report = {"estimated_prompt_tokens": {}, "fidelity": {}}
+    for variant in variants:
+        tokens = [estimate_tokens(prompt_for(s, variant)) for s in SCENARIOS]
+        report["estimated_prompt_tokens"][variant] = round(sum(tokens) / len(tokens), 1)
+    print("Estimated input tokens / email:", report["estimated_prompt_tokens"])
+
+    if not args.offline:
+        server = None
+        if args.fake:
+            from fake_gemini import FakeGeminiConfig, start_server
+
+            server = start_server(FakeGeminiConfig(latency_ms=50, jitter_ms=10, seed=0))
+            os.environ["GEMINI_API_ENDPOINT"] = "http://%s:%d" % server.server_address[:2]
+            os.environ.setdefault("GEMINI_API_KEY", "fake-key")
+        os.environ.setdefault("EMAILGEN_TOKEN_LOG", "")
+        gemini_client.configure()
+
+        for variant in variants:
+            passed = dict.fromkeys(CHECKS, 0)
+            before = get_token_ledger().summary()
+            total = 0
+            for scenario in SCENARIOS:
+                prompt = prompt_for(scenario, variant)
+                for _ in range(args.runs):
+                    with token_tags(purpose=scenario["purpose"], lang=scenario["lang"],
+                                    length=scenario.get("length"), prompt_variant=variant):
+                        data = call_gemini_json(prompt, TONE_TEMPERATURE.get(scenario["tone"], 0.6),
+                                                use_cache=False)
+                    for name, ok in check_output(data, scenario).items():
+                        passed[name] += ok
+                    total += 1
+            after = get_token_ledger().summary()
+            calls = after["calls"] - before["calls"]
+            report["fidelity"][variant] = {
+                "pass_rate": {k: round(v / total, 3) for k, v in passed.items()},
+                "avg_prompt_tokens": round((after["prompt_tokens"] - before["prompt_tokens"]) / calls, 1),
+                "avg_output_tokens": round((after["output_tokens"] - before["output_tokens"]) / calls, 1),
+            }
+        if server is not None:
+            server.shutdown()
+
+        full, compact = report["fidelity"]["full"], report["fidelity"]["compact"]
+        print(f"{'check':<16}{'full':>8}{'compact':>10}")
+        regressions = []
+        for name in CHECKS:
+            a, b = full["pass_rate"][name], compact["pass_rate"][name]
+            flag = ""
+            if a - b > args.tolerance:
+                regressions.append(name)
+                flag = "  << regression"
+            print(f"{name:<16}{a:>8.2f}{b:>10.2f}{flag}")
+        print(f"{'prompt tokens':<16}{full['avg_prompt_tokens']:>8}{compact['avg_prompt_tokens']:>10}")
+        print(f"{'output tokens':<16}{full['avg_output_tokens']:>8}{compact['avg_output_tokens']:>10}")
+        report["regressions"] = regressions
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Đo thời gian Streamlit chạy lại app.py cho các tương tác sau khi đã có kết quả (chọn tiêu đề, chọn phương án,
+bật/tắt tự chọn tiêu đề) bằng streamlit.testing (AppTest) + server Gemini giả lập.
+Kiểm tra 2 điều: p95 mỗi tương tác ≤ ngân sách và các tương tác đó KHÔNG gọi model.
+
+    python tools/rerun_bench.py                    # exit code 1 nếu vượt ngân sách hoặc có lời gọi model
+    python tools/rerun_bench.py --rounds 50 --target-ms 150
+"""
+import os, sys, json, argparse, statistics, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_gemini import FakeGeminiConfig, start_server  # noqa: E402
+
+# p95 (ms) cho 1 lần rerun do tương tác (đo qua AppTest nên đã gồm overhead của harness)
+TARGET_MS = 100
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def timed_run(widget_action) -> float:
+    started = time.perf_counter()
+    widget_action.run()
+    return (time.perf_counter() - started) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-interaction rerun time of the Streamlit page")
+    parser.add_argument("--rounds", type=int, default=20, help="Số lần lặp mỗi tương tác")
+    parser.add_argument("--target-ms", type=float, default=TARGET_MS, help="Ngân sách p95 mỗi tương tác (ms)")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args(argv)
+
+    from streamlit.testing.v1 import AppTest
+
+    server = start_server(FakeGeminiConfig(latency_ms=50, jitter_ms=5, distribution="fixed"))
+    tmp = tempfile.mkdtemp(prefix="emailgen-rerun-")
+    os.environ.update({
+        "GEMINI_API_ENDPOINT": "http://%s:%d" % server.server_address[:2],
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY") or "fake-key",
+        "EMAILGEN_CACHE_PATH": "",
+        "EMAILGEN_TOKEN_LOG": "",
+        "EMAILGEN_HISTORY_PATH": os.path.join(tmp, "history.sqlite3"),
+    })
+
+    app = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    app.session_state["stream_mode"] = False
+    app.session_state["n_variants"] = 3
+    app.run()
+    app.text_area(key="details").input("Giới thiệu phần mềm quản lý bán hàng; đề nghị demo 15 phút.")
+    next(b for b in app.button if b.label == "Generate Email").click()
+    generate_ms = timed_run(app)
+    if app.exception:
+        print(app.exception)
+        return 1
+    with server.fake_config.lock:
+        calls_before = server.fake_config.counters["requests"]
+
+    samples = {"subject_pick": [], "variant_pick": [], "auto_subject": []}
+    for i in range(args.rounds):
+        variants = app.radio(key="variant_pick")
+        samples["variant_pick"].append(timed_run(variants.set_value(i % len(variants.options))))
+        subjects = app.radio(key="subject_pick")
+        samples["subject_pick"].append(timed_run(subjects.set_value(subjects.options[i % len(subjects.options)])))
+        # Bật tự chọn tiêu đề (đo) rồi tắt lại để vòng sau còn hộp chọn tiêu đề
+        samples["auto_subject"].append(timed_run(app.checkbox(key="auto_subject").check()))
+        app.checkbox(key="auto_subject").uncheck().run()
+
+    with server.fake_config.lock:
+        model_calls = server.fake_config.counters["requests"] - calls_before
+    server.shutdown()
+
+    report = {"generate_ms": round(generate_ms, 1), "model_calls_during_interactions": model_calls,
+              "target_p95_ms": args.target_ms, "interactions": {}}
+    failed = model_calls > 0
+    print(f"{'generate (model call)':<24} {generate_ms:8.1f} ms")
+    for name, values in samples.items():
+        p50, p95 = statistics.median(values), percentile(values, 0.95)
+        report["interactions"][name] = {"p50_ms": round(p50, 1), "p95_ms": round(p95, 1), "runs": len(values)}
+        status = "ok" if p95 <= args.target_ms else "OVER BUDGET"
+        failed |= p95 > args.target_ms
+        print(f"{name:<24} p50 {p50:7.1f} ms  p95 {p95:7.1f} ms  (target {args.target_ms:.0f} ms)  {status}")
+    print(f"Model calls during interactions: {model_calls}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
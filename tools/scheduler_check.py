@@ -0,0 +1,163 @@
+"""
+Kiểm tra các bất biến của FairScheduler (không gọi model, không cần API key):
+slot in flight luôn được trả, budget tính đúng số request thực sự gửi đi (kể cả retry), hàng đợi không còn ticket mồ côi.
+
+    python tools/scheduler_check.py      # exit code 1 nếu có kịch bản sai
+"""
+import os, sys, threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from scheduler import DailyQuotaExceeded, FairScheduler, QueueTimeout, UserQuotaExceeded  # noqa: E402
+
+
+class Interrupted(BaseException):
+    """Giống exception Streamlit raise khi dừng/rerun script (không kế thừa Exception)"""
+
+
+def _expect(cond: bool, message: str):
+    if not cond:
+        raise AssertionError(message)
+
+
+def _idle(sched: FairScheduler, label: str):
+    stats = sched.stats()
+    _expect(stats["in_flight"] == 0 and stats["queue_depth"] == 0,
+            f"{label}: in_flight={stats['in_flight']} queue_depth={stats['queue_depth']}")
+    # Hàng đã trống → request tiếp theo phải được chạy ngay
+    sched.release(sched.acquire("probe", timeout=0.3))
+    return stats
+
+
+def check_on_wait_raises_while_queued():
+    sched = FairScheduler(max_in_flight=1, poll_interval=0.01)
+    holder = sched.acquire("a")
+
+    def on_wait(position, waited):
+        raise Interrupted()
+
+    try:
+        sched.acquire("b", on_wait=on_wait)
+        raise AssertionError("on_wait exception was swallowed")
+    except Interrupted:
+        pass
+    sched.release(holder)
+    stats = _idle(sched, "on_wait raised while queued")
+    _expect(stats["users"]["b"]["used_today"] == 0, "budget of the interrupted request was not refunded")
+    _expect(stats["abandoned"] == 1, f"abandoned={stats['abandoned']}")
+
+
+def check_on_wait_raises_after_admission():
+    # Slot được cấp đúng lúc on_wait đang chạy (ngoài lock) rồi on_wait raise → slot phải được trả
+    sched = FairScheduler(max_in_flight=1, poll_interval=0.01)
+    holder = sched.acquire("a")
+
+    def on_wait(position, waited):
+        sched.release(holder)
+        raise Interrupted()
+
+    try:
+        sched.acquire("b", on_wait=on_wait)
+        raise AssertionError("on_wait exception was swallowed")
+    except Interrupted:
+        pass
+    stats = _idle(sched, "on_wait raised after admission")
+    _expect(stats["users"]["b"]["used_today"] == 0, "budget of the interrupted request was not refunded")
+
+
+def check_timeout_refunds():
+    sched = FairScheduler(max_in_flight=1, poll_interval=0.01, user_daily_budget=2, daily_budget=2)
+    holder = sched.acquire("a")
+    try:
+        sched.acquire("b", timeout=0.05)
+        raise AssertionError("expected QueueTimeout")
+    except QueueTimeout:
+        pass
+    sched.release(holder)
+    stats = _idle(sched, "queue timeout")
+    _expect(stats["users"]["b"]["used_today"] == 0, "budget of the timed-out request was not refunded")
+
+
+def check_concurrent_interrupts():
+    # Nhiều session bị ngắt lúc đang chờ: không được giữ lại slot nào
+    sched = FairScheduler(max_in_flight=2, poll_interval=0.005, user_daily_budget=None)
+    holders = [sched.acquire("a"), sched.acquire("a")]
+
+    def worker(i):
+        def on_wait(position, waited):
+            if waited > 0.01 * (i % 5):
+                raise Interrupted()
+        try:
+            sched.release(sched.acquire(f"u{i}", on_wait=on_wait))
+        except Interrupted:
+            pass
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for ticket in holders:
+        sched.release(ticket)
+    for t in threads:
+        t.join()
+    _idle(sched, "concurrent interrupts")
+
+
+def check_group_cap():
+    # Trần nhóm (vd. chung IP) áp cho mọi user trong nhóm; mỗi user vẫn có budget riêng
+    sched = FairScheduler(user_daily_budget=2, group_daily_budget=3)
+    for user in ("a", "a", "b"):
+        sched.release(sched.acquire(user, group="ip-1"))
+    try:
+        sched.acquire("c", group="ip-1")
+        raise AssertionError("group budget was not enforced")
+    except UserQuotaExceeded:
+        pass
+    sched.release(sched.acquire("c", group="ip-2"))
+    _expect(sched.remaining("b", "ip-1") == 0, f"remaining={sched.remaining('b', 'ip-1')}")
+    _expect(sched.remaining("b", "ip-2") == 1, f"remaining={sched.remaining('b', 'ip-2')}")
+
+
+def check_retries_are_charged():
+    # Request đầu của slot đã tính lúc acquire; retry dưới cùng slot tính thêm, hết budget thì không gửi
+    sched = FairScheduler(user_daily_budget=None, daily_budget=3)
+    ticket = sched.acquire("a")
+    sched.charge(ticket)
+    sched.charge(ticket)
+    _expect(sched.stats()["used_today"] == 2, f"used_today={sched.stats()['used_today']}")
+    sched.charge(ticket)
+    try:
+        sched.charge(ticket)
+        raise AssertionError("charge beyond the daily budget was allowed")
+    except DailyQuotaExceeded:
+        pass
+    sched.release(ticket)
+    stats = sched.stats()
+    _expect(stats["used_today"] == 3 and stats["extra_calls"] == 2,
+            f"used_today={stats['used_today']} extra_calls={stats['extra_calls']}")
+
+
+CHECKS = [
+    check_on_wait_raises_while_queued,
+    check_on_wait_raises_after_admission,
+    check_timeout_refunds,
+    check_concurrent_interrupts,
+    check_group_cap,
+    check_retries_are_charged,
+]
+
+
+def main() -> int:
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"ok    {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {check.__name__}: {e}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Báo cáo token theo nhóm từ log của token_usage (mặc định .cache/token_usage.jsonl):
+    python tools/token_report.py
+    python tools/token_report.py --by purpose,prompt_variant --since-hours 24 --json report.json
+"""
+import os, sys, json, time, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from token_usage import aggregate  # noqa: E402
+
+
+def read_log(path: str, since: float | None = None):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if since is None or entry.get("ts", 0) >= since:
+                yield entry
+
+
+def format_table(rows: list[dict], group_by: list[str]) -> str:
+    cols = group_by + ["calls", "avg_prompt_tokens", "avg_output_tokens", "prompt_tokens", "output_tokens",
+                       "estimated"]
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in rows)) for c in cols}
+    lines = ["  ".join(c.ljust(widths[c]) for c in cols)]
+    for r in rows:
+        lines.append("  ".join(str(r.get(c, "")).ljust(widths[c]) for c in cols))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Token usage report per purpose/lang/length")
+    parser.add_argument("--log", default=os.getenv("EMAILGEN_TOKEN_LOG") or os.path.join(ROOT, ".cache", "token_usage.jsonl"))
+    parser.add_argument("--by", default="purpose,lang,length", help="Các tag để gộp, cách nhau dấu phẩy")
+    parser.add_argument("--since-hours", type=float, default=None, help="Chỉ tính các lời gọi trong N giờ gần nhất")
+    parser.add_argument("--json", help="Ghi báo cáo ra file JSON")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.log):
+        parser.error(f"Không tìm thấy log: {args.log}")
+    group_by = [k.strip() for k in args.by.split(",") if k.strip()]
+    since = time.time() - args.since_hours * 3600 if args.since_hours else None
+    rows = aggregate(read_log(args.log, since), group_by)
+    if not rows:
+        print("Chưa có lời gọi nào trong log.")
+        return
+
+    print(format_table(rows, group_by))
+    total_calls = sum(r["calls"] for r in rows)
+    total_in = sum(r["prompt_tokens"] for r in rows)
+    total_out = sum(r["output_tokens"] for r in rows)
+    print(f"\nTotal: {total_calls} calls · {total_in} input tokens ({total_in / total_calls:.1f}/email) · "
+          f"{total_out} output tokens")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"group_by": group_by, "rows": rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()